@@ -0,0 +1,110 @@
+import functools
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+from emails import cache as generations
+
+
+def entity_tag(request, *parts):
+    """Strong ETag of a representation identified by ``parts``.
+
+    The user, the URL and the rendered format are always part of it.
+    """
+    renderer = getattr(request, 'accepted_renderer', None)
+    key = ':'.join(str(part) for part in (
+        request.user.id, request.build_absolute_uri(),
+        getattr(renderer, 'format', ''), *parts
+    ))
+    return quote_etag(hashlib.sha1(key.encode()).hexdigest())
+
+
+def set_validators(response, etag, last_modified=None):
+    """Add ETag and Last-Modified, and make clients revalidate before reuse."""
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def not_modified(request, etag, last_modified=None):
+    """A 304 response if ``If-None-Match`` or ``If-Modified-Since`` show the
+    client's copy is current, otherwise None."""
+    response = get_conditional_response(
+        request,
+        etag=etag,
+        last_modified=int(last_modified.timestamp()) if last_modified else None
+    )
+    if response is not None:
+        set_validators(response, etag, last_modified)
+    return response
+
+
+def cached_data(request, name, compute, generation=None):
+    """Return ``(data, hit)`` for a read-only request of the user.
+
+    ``compute`` returns a ``(data, cacheable)`` pair. Entries are keyed per
+    user, cache generation and full URL, so query parameters, pages and
+    cursors are cached separately.
+    """
+    timeout = getattr(settings, 'RESPONSE_CACHE_TIMEOUT', 3600)
+    if not timeout or not request.user.is_authenticated:
+        return compute()[0], None
+
+    if generation is None:
+        generation, _ = generations.generation(request.user.id)
+    url = hashlib.md5(request.build_absolute_uri().encode()).hexdigest()
+    key = f'response-cache:{request.user.id}:{generation}:{name}:{url}'
+    data = cache.get(key)
+    if data is not None:
+        generations.record(hit=True)
+        return data, True
+
+    generations.record(hit=False)
+    data, cacheable = compute()
+    if cacheable:
+        cache.set(key, data, timeout)
+    return data, False
+
+
+def cached_response(name):
+    """Serve a read-only view conditionally and from the cache.
+
+    The ETag and Last-Modified come from the user's cache generation, so a
+    client revalidating data that has not changed since the last sync gets
+    a 304 without the view running. Otherwise the data is taken from
+    ``cached_data``, only successful responses are stored. The ``X-Cache``
+    header tells whether a response came from the cache.
+    """
+    def decorator(view_method):
+        @functools.wraps(view_method)
+        def wrapper(self, request, *args, **kwargs):
+            generation, updated_at = generations.generation(request.user.id)
+            etag = entity_tag(request, name, generation)
+            response = not_modified(request, etag, updated_at)
+            if response is not None:
+                return response
+
+            response = None
+
+            def compute():
+                nonlocal response
+                response = view_method(self, request, *args, **kwargs)
+                return response.data, response.status_code == status.HTTP_200_OK
+
+            data, hit = cached_data(request, name, compute, generation)
+            if response is None:
+                response = Response(data)
+            if hit is not None:
+                response['X-Cache'] = 'HIT' if hit else 'MISS'
+            if response.status_code == status.HTTP_200_OK:
+                set_validators(response, etag, updated_at)
+            return response
+        return wrapper
+    return decorator
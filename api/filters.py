@@ -0,0 +1,22 @@
+from rest_framework.filters import BaseFilterBackend, OrderingFilter
+
+from emails.search import search_emails
+
+
+class EmailSearchFilter(BaseFilterBackend):
+    """Full-text search of emails through the ``q`` parameter.
+
+    ``search`` is accepted as well for older clients. Results come best
+    match first, unless an explicit ``ordering`` is requested.
+    """
+    search_params = ('q', 'search')
+
+    def filter_queryset(self, request, queryset, view):
+        query = next(
+            (request.query_params[p] for p in self.search_params if request.query_params.get(p)),
+            ''
+        )
+        if not query.strip():
+            return queryset
+        ranked = not request.query_params.get(OrderingFilter.ordering_param)
+        return search_emails(queryset, query, ranked=ranked)
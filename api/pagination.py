@@ -0,0 +1,142 @@
+import base64
+import json
+from collections import OrderedDict
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """Cursor pagination on ``(date, id)``.
+
+    Each page continues after the last row of the previous one with a
+    ``WHERE (date, id) < (...)`` condition on an indexed column pair, so no
+    ``COUNT(*)`` is run and deep pages cost as much as the first one.
+
+    Querysets ordered on anything but one of ``cursor_fields`` (search
+    results ranked by relevance, ``ordering=created_at``) and requests
+    with the ``page`` parameter of older clients are paginated by page
+    number instead.
+    """
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    cursor_fields = ('date', 'last_date')
+    fallback_class = PageNumberPagination
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.fallback = None
+        self.field, self.descending = self._keyset_ordering(queryset)
+        if self.field is None or request.query_params.get(self.fallback_class.page_query_param):
+            self.fallback = self.fallback_class()
+            self.fallback.page_size = self.get_page_size(request)
+            return self.fallback.paginate_queryset(queryset, request, view)
+
+        self.page_size = self.get_page_size(request)
+        position = self.decode_cursor(request)
+        self.reverse = bool(position and position['reverse'])
+        descending = self.descending != self.reverse
+        sign = '-' if descending else ''
+        queryset = queryset.order_by(f'{sign}{self.field}', f'{sign}id')
+
+        if position is not None:
+            # (field, id) past the cursor, spelled with a bound on the field
+            # alone so the database can start the index scan at the cursor
+            lookup = 'lt' if descending else 'gt'
+            queryset = queryset.filter(
+                Q(**{f'{self.field}__{lookup}e': position['value']}),
+                Q(**{f'{self.field}__{lookup}': position['value']}) |
+                Q(**{f'id__{lookup}': position['id']})
+            )
+
+        rows = list(queryset[:self.page_size + 1])
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if self.reverse:
+            rows.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, position is not None
+        self.page = rows
+        return rows
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(size, 1), self.max_page_size)
+
+    def _keyset_ordering(self, queryset):
+        ordering = list(queryset.query.order_by)
+        if not ordering or len(ordering) > 2 or not isinstance(ordering[0], str):
+            return None, False
+        descending = ordering[0].startswith('-')
+        field = ordering[0].lstrip('-')
+        if field not in self.cursor_fields:
+            return None, False
+        if len(ordering) == 2 and ordering[1] != ('-id' if descending else 'id'):
+            return None, False
+        return field, descending
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            data = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')))
+            position = {
+                'value': parse_datetime(data['v']),
+                'id': int(data['i']),
+                'reverse': bool(data.get('r')),
+            }
+        except (TypeError, ValueError, KeyError, UnicodeEncodeError):
+            raise NotFound('Invalid cursor')
+        if position['value'] is None:
+            raise NotFound('Invalid cursor')
+        return position
+
+    def encode_cursor(self, row, reverse):
+        data = {'v': getattr(row, self.field).isoformat(), 'i': row.pk}
+        if reverse:
+            data['r'] = 1
+        encoded = base64.urlsafe_b64encode(json.dumps(data).encode('ascii')).decode('ascii')
+        url = remove_query_param(self.request.build_absolute_uri(), self.fallback_class.page_query_param)
+        return replace_query_param(url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        if self.fallback is not None:
+            return self.fallback.get_paginated_response(data)
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
@@ -0,0 +1,19 @@
+import json
+
+from rest_framework import renderers
+
+
+class DownloadRenderer(renderers.BaseRenderer):
+    """Accepts any media type for views streaming files themselves.
+
+    Content negotiation then succeeds whatever the client asks for, errors
+    raised before the download starts are rendered as JSON.
+    """
+    media_type = '*/*'
+    format = 'download'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return json.dumps(data).encode()
@@ -1,6 +1,9 @@
 from rest_framework import serializers
-from emails.models import IMAPServer, Email
+from emails.models import IMAPServer, Attachment, Email, MailboxStats, SyncJob, Thread
+from emails.threads import thread_members
 from django.contrib.auth.models import User
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -13,6 +16,7 @@ class IMAPServerSerializer(serializers.ModelSerializer):
         fields = (
             'id', 'name', 'host', 'port', 'username', 'password',
             'use_ssl', 'sync_limit_type', 'sync_limit_value',
+            'fetch_mode', 'max_body_size', 'max_connections',
             'folders_to_sync', 'exclude_trash', 'last_sync'
         )
         extra_kwargs = {
@@ -36,6 +40,18 @@ class IMAPServerSerializer(serializers.ModelSerializer):
                 'sync_limit_value': 'Sync limit value must be positive'
             })
 
+        max_connections = data.get('max_connections')
+        if max_connections is not None and not 1 <= max_connections <= 10:
+            raise serializers.ValidationError({
+                'max_connections': 'Max connections must be between 1 and 10'
+            })
+
+        max_body_size = data.get('max_body_size')
+        if max_body_size is not None and max_body_size < 1:
+            raise serializers.ValidationError({
+                'max_body_size': 'Max body size must be positive'
+            })
+
         # Clean folders list
         folders_to_sync = data.get('folders_to_sync', '')
         if folders_to_sync:
@@ -51,6 +67,39 @@ class IMAPServerSerializer(serializers.ModelSerializer):
             validated_data.pop('password', None)
         return super().update(instance, validated_data)
 
+class SyncJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = SyncJob
+        fields = (
+            'id', 'imap_server', 'status', 'full', 'folders_total',
+            'folders_done', 'messages_processed', 'inserted', 'updated',
+            'error', 'created_at', 'started_at', 'finished_at'
+        )
+        read_only_fields = fields
+
+def sync_age(last_sync):
+    """Seconds since a sync time, as a datetime or its serialized form"""
+    if not last_sync:
+        return None
+    if isinstance(last_sync, str):
+        last_sync = parse_datetime(last_sync)
+    return int((timezone.now() - last_sync).total_seconds())
+
+class MailboxStatsSerializer(serializers.ModelSerializer):
+    last_sync_age = serializers.SerializerMethodField()
+
+    class Meta:
+        model = MailboxStats
+        fields = (
+            'imap_server', 'folder', 'message_count', 'unread_count',
+            'total_size', 'last_sync', 'last_sync_age'
+        )
+        read_only_fields = fields
+
+    def get_last_sync_age(self, obj):
+        """Seconds since the folder was last synced"""
+        return sync_age(obj.last_sync)
+
 class ThreadEmailSerializer(serializers.ModelSerializer):
     """Serializer for emails within a thread"""
     class Meta:
@@ -60,31 +109,44 @@ class ThreadEmailSerializer(serializers.ModelSerializer):
             'date', 'body_text', 'body_html', 'folder'
         )
 
+class AttachmentSerializer(serializers.ModelSerializer):
+    """Attachment metadata, the content is at /api/emails/{id}/attachments/{index}/"""
+    class Meta:
+        model = Attachment
+        fields = ('index', 'filename', 'content_type', 'size', 'content_id')
+
 class EmailSerializer(serializers.ModelSerializer):
     thread_emails = serializers.SerializerMethodField()
+    attachments = AttachmentSerializer(many=True, read_only=True)
     
     class Meta:
         model = Email
         fields = (
-            'id', 'message_id', 'subject', 'sender', 'recipient',
+            'id', 'message_id', 'rfc_message_id', 'subject', 'sender', 'recipient',
             'date', 'body_text', 'body_html', 'folder', 'created_at',
-            'updated_at', 'thread_id', 'in_reply_to', 'thread_emails'
+            'updated_at', 'thread_id', 'in_reply_to', 'thread_emails',
+            'size', 'body_pending', 'flags', 'attachments'
         )
         read_only_fields = (
-            'created_at', 'updated_at', 'thread_id',
-            'in_reply_to', 'thread_emails'
+            'rfc_message_id', 'created_at', 'updated_at', 'thread_id',
+            'in_reply_to', 'thread_emails', 'size', 'body_pending', 'flags',
+            'attachments'
         )
 
     def get_thread_emails(self, obj):
-        """Get all emails in the same thread, excluding the current one"""
+        """Get all emails in the same thread, excluding the current one
+
+        Uses the ``thread_members`` context (see ``emails.threads.thread_members``)
+        when given, so serializing many emails of a thread costs no queries.
+        """
         if not obj.thread_id:
             return []
-        
-        thread_emails = (Email.objects
-                        .filter(thread_id=obj.thread_id)
-                        .exclude(id=obj.id)
-                        .order_by('date'))
-        
+
+        members = self.context.get('thread_members')
+        if members is None or obj.thread_id not in members:
+            members = thread_members(obj.user_id, [obj.thread_id])
+        thread_emails = [e for e in members[obj.thread_id] if e.id != obj.id]
+
         return ThreadEmailSerializer(thread_emails, many=True).data
 
 class EmailListSerializer(serializers.ModelSerializer):
@@ -95,11 +157,40 @@ class EmailListSerializer(serializers.ModelSerializer):
         model = Email
         fields = (
             'id', 'subject', 'sender', 'recipient',
-            'date', 'folder', 'thread_id', 'thread_count'
+            'date', 'snippet', 'folder', 'thread_id', 'thread_count', 'flags'
         )
 
     def get_thread_count(self, obj):
         """Get the number of emails in the thread"""
+        if hasattr(obj, 'thread_count'):
+            # Annotated by EmailViewSet.get_queryset
+            return obj.thread_count
         if not obj.thread_id:
             return 1
-        return Email.objects.filter(thread_id=obj.thread_id).count()
+        count = (
+            Thread.objects
+            .filter(user_id=obj.user_id, thread_id=obj.thread_id)
+            .values_list('message_count', flat=True)
+            .first()
+        )
+        return count or 1
+
+class ThreadListSerializer(serializers.ModelSerializer):
+    """A thread shown as its first email with the thread's size and latest activity"""
+    id = serializers.IntegerField(source='root.id', read_only=True)
+    sender = serializers.CharField(source='root.sender', read_only=True)
+    recipient = serializers.CharField(source='root.recipient', read_only=True)
+    date = serializers.DateTimeField(source='first_date', read_only=True)
+    folder = serializers.CharField(source='root.folder', read_only=True)
+    flags = serializers.CharField(source='root.flags', read_only=True)
+    thread_count = serializers.IntegerField(source='message_count', read_only=True)
+    last_activity = serializers.DateTimeField(source='last_date', read_only=True)
+
+    class Meta:
+        model = Thread
+        fields = (
+            'id', 'subject', 'sender', 'recipient', 'date', 'folder',
+            'thread_id', 'thread_count', 'flags', 'last_activity',
+            'participants', 'folders'
+        )
+        read_only_fields = fields
@@ -1,3 +1,583 @@
-from django.test import TestCase
+import datetime
+import email
+import io
+import threading
+from email.message import EmailMessage
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APITestCase, APITransactionTestCase
+
+from emails.models import Email, SyncJob
+from emails.attachments import attachments_of
+from emails.search import index_emails
+from emails.stats import record_sync
+from emails.tasks import fetch_email_body
+from emails.testing import AccountTestMixin, FakeIMAPServer, create_account, make_message
+from emails.threads import delete_emails, refresh_threads
+from emails.writer import EmailWriter
+
+
+@override_settings(RESPONSE_CACHE_TIMEOUT=0)
+class EmailQueryCountTests(AccountTestMixin, APITestCase):
+    """Email endpoints must run a fixed number of queries however many rows they return
+
+    Lists read the user's cache generation first, details their ETag validators
+    and attachments.
+    """
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+        self.uid = 0
+
+    def create_thread(self, size, user=None, server=None, thread_id=None):
+        user = user or self.user
+        server = server or self.server
+        thread_id = thread_id or f'<thread-{self.uid}@example.com>'
+        start = timezone.now() - datetime.timedelta(days=30)
+        emails = []
+        for i in range(size):
+            self.uid += 1
+            emails.append(Email.objects.create(
+                user=user,
+                imap_server=server,
+                message_id=str(self.uid),
+                folder='INBOX',
+                subject=f'Message {self.uid}',
+                sender='sender@example.com',
+                recipient='reader@example.com',
+                date=start + datetime.timedelta(hours=self.uid),
+                thread_id=thread_id,
+                body_text=f'Body of message {self.uid}',
+            ))
+        refresh_threads(user.id, [thread_id])
+        return emails
+
+    def test_list_query_count(self):
+        for _ in range(3):
+            self.create_thread(3)
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/emails/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['thread_count'] for r in response.data['results']], [3] * 9)
+
+        for _ in range(20):
+            self.create_thread(4)
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/emails/')
+        self.assertEqual(len(response.data['results']), 50)
+        with self.assertNumQueries(2):
+            response = self.client.get(response.data['next'])
+        self.assertEqual(len(response.data['results']), 39)
+
+    def test_detail_query_count(self):
+        email_obj = self.create_thread(2)[0]
+        with self.assertNumQueries(4):
+            response = self.client.get(f'/api/emails/{email_obj.id}/')
+        self.assertEqual(len(response.data['thread_emails']), 1)
+
+        email_obj = self.create_thread(30)[0]
+        with self.assertNumQueries(4):
+            response = self.client.get(f'/api/emails/{email_obj.id}/')
+        self.assertEqual(len(response.data['thread_emails']), 29)
+
+    def test_thread_query_count(self):
+        email_obj = self.create_thread(2)[0]
+        with self.assertNumQueries(3):
+            response = self.client.get(f'/api/emails/{email_obj.id}/thread/')
+        self.assertEqual(len(response.data), 2)
+
+        email_obj = self.create_thread(30)[0]
+        with self.assertNumQueries(3):
+            response = self.client.get(f'/api/emails/{email_obj.id}/thread/')
+        self.assertEqual(len(response.data), 30)
+        self.assertEqual(len(response.data[0]['thread_emails']), 29)
+
+    def test_threads_query_count(self):
+        self.create_thread(2)
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/emails/threads/')
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertIsNone(response.data['next'])
+
+        for _ in range(60):
+            self.create_thread(2)
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/emails/threads/')
+        self.assertEqual(len(response.data['results']), 50)
+        with self.assertNumQueries(2):
+            response = self.client.get(response.data['next'])
+        self.assertEqual(len(response.data['results']), 11)
+        self.assertIsNone(response.data['next'])
+
+    def test_bodies_only_read_for_details(self):
+        email_obj = self.create_thread(2)[0]
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get('/api/emails/')
+        self.assertEqual(response.data['results'][-1]['snippet'], f'Body of message {email_obj.id}')
+        list_sql = captured.captured_queries[-1]['sql']
+        self.assertNotIn('emails_emailbody', list_sql)
+        self.assertNotIn('references', list_sql)
+
+        response = self.client.get(f'/api/emails/{email_obj.id}/')
+        self.assertEqual(response.data['body_text'], f'Body of message {email_obj.id}')
+        self.assertEqual(
+            [e['body_text'] for e in response.data['thread_emails']],
+            [f'Body of message {email_obj.id + 1}']
+        )
+
+    def test_thread_emails_scoped_to_user(self):
+        other, other_server = create_account('other', name='Other')
+        email_obj = self.create_thread(2, thread_id='<shared@example.com>')[0]
+        self.create_thread(3, user=other, server=other_server, thread_id='<shared@example.com>')
+
+        response = self.client.get(f'/api/emails/{email_obj.id}/')
+        self.assertEqual(len(response.data['thread_emails']), 1)
+        response = self.client.get(f'/api/emails/{email_obj.id}/thread/')
+        self.assertEqual(len(response.data), 2)
+        response = self.client.get('/api/emails/')
+        self.assertEqual([r['thread_count'] for r in response.data['results']], [2, 2])
+
+
+@override_settings(RESPONSE_CACHE_TIMEOUT=0)
+class EmailPaginationTests(AccountTestMixin, APITestCase):
+    """Email lists are paginated by a cursor on (date, id)"""
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+        # Several emails share each date, the id breaks the ties
+        start = timezone.now()
+        for i in range(25):
+            Email.objects.create(
+                user=self.user, imap_server=self.server, message_id=str(i),
+                folder='INBOX', subject=f'Message {i}', sender='sender@example.com',
+                recipient='reader@example.com', date=start - datetime.timedelta(hours=i // 3),
+            )
+
+    def walk(self, url, link='next'):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids.extend(r['id'] for r in response.data['results'])
+            url = response.data[link]
+        return ids
+
+    def test_walk_forward_and_back(self):
+        expected = list(Email.objects.order_by('-date', '-id').values_list('id', flat=True))
+        self.assertEqual(self.walk('/api/emails/?page_size=4'), expected)
+
+        first = self.client.get('/api/emails/?page_size=4')
+        second = self.client.get(first.data['next'])
+        back = self.client.get(second.data['previous'])
+        self.assertEqual(back.data['results'], first.data['results'])
+
+    def test_ascending_order(self):
+        expected = list(Email.objects.order_by('date', 'id').values_list('id', flat=True))
+        self.assertEqual(self.walk('/api/emails/?page_size=7&ordering=date'), expected)
+
+    def test_page_numbers_still_served(self):
+        response = self.client.get('/api/emails/?page=2&page_size=10')
+        self.assertEqual(response.data['count'], 25)
+        self.assertEqual(len(response.data['results']), 10)
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/emails/?cursor=garbage')
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(RESPONSE_CACHE_TIMEOUT=0)
+class EmailSearchTests(AccountTestMixin, APITestCase):
+    """Search goes through the full-text index kept by the sync writer"""
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+        self.uid = 0
+
+    def create_email(self, subject, sender='sender@example.com', body='', user=None, server=None):
+        self.uid += 1
+        with EmailWriter() as writer:
+            writer.add(Email(
+                user=user or self.user,
+                imap_server=server or self.server,
+                message_id=str(self.uid),
+                folder='INBOX',
+                subject=subject,
+                sender=sender,
+                recipient='reader@example.com',
+                date=timezone.now() - datetime.timedelta(hours=self.uid),
+                body_text=body,
+            ))
+        return Email.objects.get(message_id=str(self.uid))
+
+    def search(self, query, **params):
+        response = self.client.get('/api/emails/', {'q': query, **params})
+        self.assertEqual(response.status_code, 200)
+        return [r['subject'] for r in response.data['results']]
+
+    def test_ranked_search(self):
+        self.create_email('Weekly report', body='Nothing about invoices here')
+        self.create_email('Invoice 42', body='Please pay the invoice')
+        self.create_email('Lunch')
+        self.assertEqual(self.search('invoice'), ['Invoice 42'])
+        self.assertEqual(self.search('invoice*'), ['Invoice 42', 'Weekly report'])
+        self.assertEqual(self.search('invoice*', ordering='-date'), ['Weekly report', 'Invoice 42'])
+
+    def test_phrases_and_qualifiers(self):
+        self.create_email('Quarterly numbers', sender='alice@example.com', body='the sales figures')
+        self.create_email('Sales', sender='bob@example.org', body='figures of the sales team')
+        self.assertEqual(self.search('"sales figures"'), ['Quarterly numbers'])
+        self.assertEqual(self.search('from:bob figures'), ['Sales'])
+        self.assertEqual(self.search('subject:sales'), ['Sales'])
+        self.assertEqual(self.search('figures -from:alice@example.com'), ['Sales'])
+
+    def test_index_follows_updates_and_deletes(self):
+        email_obj = self.create_email('Draft', body='first version')
+        email_obj.body_text = 'second version'
+        index_emails([email_obj])
+        self.assertEqual(self.search('second'), ['Draft'])
+        self.assertEqual(self.search('first'), [])
+
+        delete_emails(Email.objects.filter(id=email_obj.id))
+        self.assertEqual(self.search('second'), [])
+
+    def test_search_scoped_to_user(self):
+        other, other_server = create_account('other', name='Other')
+        self.create_email('Secret plans', user=other, server=other_server)
+        self.create_email('Public plans')
+        self.assertEqual(self.search('plans'), ['Public plans'])
+
+
+@override_settings(RESPONSE_CACHE_TIMEOUT=0)
+class AttachmentTests(AccountTestMixin, APITestCase):
+    """Attachment metadata is indexed during sync, content is streamed on download"""
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+        self.pdf = bytes(range(256)) * 40
+
+        message = EmailMessage()
+        message['Subject'] = 'Invoice'
+        message.set_content('See attached')
+        message.add_attachment(
+            self.pdf, maintype='application', subtype='pdf', filename='invoice.pdf'
+        )
+        raw = message.as_bytes()
+        email_obj = Email(
+            user=self.user, imap_server=self.server, message_id='1', folder='INBOX',
+            subject='Invoice', sender='sender@example.com', recipient='reader@example.com',
+            date=timezone.now(), body_text='See attached', raw_message=raw, size=len(raw),
+        )
+        email_obj.pending_attachments = attachments_of(email.message_from_bytes(raw))
+        with EmailWriter() as writer:
+            writer.add(email_obj)
+        self.email = Email.objects.get()
+
+    def test_metadata(self):
+        response = self.client.get(f'/api/emails/{self.email.id}/')
+        self.assertEqual(response.data['attachments'], [{
+            'index': 0, 'filename': 'invoice.pdf', 'content_type': 'application/pdf',
+            'size': len(self.pdf), 'content_id': '',
+        }])
+        self.assertEqual(self.email.attachments.get().part, '2')
+
+    def test_download_from_stored_source(self):
+        response = self.client.get(
+            f'/api/emails/{self.email.id}/attachments/0/', HTTP_ACCEPT='application/pdf'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertIn('invoice.pdf', response['Content-Disposition'])
+        self.assertEqual(b''.join(response.streaming_content), self.pdf)
+
+        response = self.client.get(f'/api/emails/{self.email.id}/attachments/1/')
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(RESPONSE_CACHE_TIMEOUT=0)
+class PendingBodyTests(APITestCase):
+    """Bodies left on the server are downloaded in the background when opened"""
+
+    def setUp(self):
+        cache.clear()
+        self.imap = FakeIMAPServer()
+        self.addCleanup(self.imap.stop)
+        self.user, self.server = create_account(
+            fetch_mode='headers_first', max_body_size=1000, **self.imap.account_fields()
+        )
+        self.client.force_authenticate(self.user)
+        self.imap.folders['INBOX'].add(make_message('Large', body='Long text. ' * 200))
+        call_command('sync_emails', stdout=io.StringIO(), stderr=io.StringIO())
+        self.email = Email.objects.get()
+        self.url = f'/api/emails/{self.email.id}/'
+
+    def test_body_fetched_in_background(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.get(self.url)
+            self.client.get(self.url)
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(response.data['body_pending'])
+        self.assertEqual(response.data['subject'], 'Large')
+        self.assertIn('Retry-After', response)
+        # The second request does not queue another download
+        self.assertEqual(len(callbacks), 1)
+
+        fetch_email_body(self.email.id)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.data['body_pending'])
+        self.assertTrue(response.data['body_text'].startswith('Long text.'))
+
+    def test_failed_fetch_stays_pending(self):
+        self.imap.folders['INBOX'].expunge(1)
+        with self.captureOnCommitCallbacks():
+            self.client.get(self.url)
+        fetch_email_body(self.email.id)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(response.data['body_pending'])
+        self.assertEqual(len(callbacks), 1)
+
+
+@override_settings(RESPONSE_CACHE_TIMEOUT=0, SYNC_JOB_BACKEND='local')
+class SyncJobTests(APITransactionTestCase):
+    """Syncs requested through the API run as background jobs, one per server
+
+    Local jobs run in a thread with its own connection, the test data has to
+    be committed.
+    """
+
+    def setUp(self):
+        self.imap = FakeIMAPServer()
+        self.addCleanup(self.imap.stop)
+        self.imap.folders['INBOX'].add(make_message('First'))
+        self.imap.folders['INBOX'].add(make_message('Second'))
+        self.user, self.server = create_account(**self.imap.account_fields())
+        self.client.force_authenticate(self.user)
+        self.url = f'/api/imap-servers/{self.server.id}/sync/'
+
+    def wait_for_job(self, job_id):
+        for thread in threading.enumerate():
+            if thread.name == f'sync-job-{job_id}':
+                thread.join(30)
+
+    def test_sync_runs_in_background(self):
+        response = self.client.post(self.url)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['status'], 'queued')
+        job_id = response.data['job_id']
+        self.wait_for_job(job_id)
+
+        response = self.client.get(f'/api/sync-jobs/{job_id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], 'success')
+        self.assertEqual(
+            (response.data['folders_done'], response.data['folders_total'],
+             response.data['messages_processed'], response.data['inserted']),
+            (1, 1, 2, 2)
+        )
+        self.assertEqual(Email.objects.filter(imap_server=self.server).count(), 2)
+
+        # Jobs of other users are not visible
+        other, _ = create_account('other', name='Other')
+        self.client.force_authenticate(other)
+        self.assertEqual(self.client.get(f'/api/sync-jobs/{job_id}/').status_code, 404)
+
+    def test_one_active_job_per_server(self):
+        with mock.patch('emails.tasks._dispatch') as dispatch:
+            job_id = self.client.post(self.url).data['job_id']
+            # The partial unique constraint rejects a second pending job
+            response = self.client.post(self.url, {'full': 'true'})
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(response.data['status'], 'already_running')
+            self.assertEqual(response.data['job_id'], job_id)
+
+            SyncJob.objects.filter(id=job_id).update(status='running')
+            response = self.client.post(self.url)
+            self.assertEqual(response.data['status'], 'already_running')
+            self.assertEqual(response.data['job_id'], job_id)
+        dispatch.assert_called_once_with(job_id)
+        self.assertEqual(SyncJob.objects.count(), 1)
+
+    @override_settings(SYNC_JOB_STALE_AFTER=60)
+    def test_stale_job_expired(self):
+        with mock.patch('emails.tasks._dispatch'):
+            job_id = self.client.post(self.url).data['job_id']
+            # The worker died, the job stopped reporting
+            SyncJob.objects.filter(id=job_id).update(
+                status='running', updated_at=timezone.now() - datetime.timedelta(minutes=5)
+            )
+            response = self.client.post(self.url)
+        self.assertEqual(response.data['status'], 'queued')
+        self.assertNotEqual(response.data['job_id'], job_id)
+        stale = SyncJob.objects.get(id=job_id)
+        self.assertEqual((stale.status, stale.error), ('failed', 'Job stopped reporting progress'))
+
+
+@override_settings(RESPONSE_CACHE_TIMEOUT=0)
+class EmailStatisticsTests(AccountTestMixin, APITestCase):
+    """Statistics are read from counters the writer keeps in step with the emails"""
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+
+    def write(self, uid, folder='INBOX', flags='', size=100):
+        with EmailWriter() as writer:
+            writer.add(Email(
+                user=self.user, imap_server=self.server, message_id=str(uid),
+                folder=folder, subject=f'Message {uid}', sender='sender@example.com',
+                recipient='reader@example.com', date=timezone.now(), flags=flags, size=size,
+            ))
+
+    def test_statistics_endpoint(self):
+        self.write(1)
+        self.write(2, folder='Sent', flags='\\Seen')
+        self.write(3, folder='Sent', flags='\\Seen')
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/emails/statistics/')
+        self.assertEqual(response.data['total_emails'], 3)
+        self.assertEqual(response.data['total_unread'], 1)
+        self.assertEqual(response.data['total_size'], 300)
+        self.assertEqual(response.data['total_threads'], 3)
+        self.assertEqual(response.data['folders'], {'Sent': 2, 'INBOX': 1})
+        self.assertEqual(len(response.data['mailboxes']), 2)
+
+
+@override_settings(RESPONSE_CACHE_TIMEOUT=60)
+class ResponseCacheTests(AccountTestMixin, APITestCase):
+    """Read-only endpoints are cached until a sync changes the user's data"""
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_authenticate(self.user)
+        self.uid = 0
+
+    def write(self, user=None, server=None):
+        self.uid += 1
+        with self.captureOnCommitCallbacks(execute=True):
+            with EmailWriter() as writer:
+                writer.add(Email(
+                    user=user or self.user, imap_server=server or self.server,
+                    message_id=str(self.uid), folder='INBOX', subject=f'Message {self.uid}',
+                    sender='sender@example.com', recipient='reader@example.com',
+                    date=timezone.now(),
+                ))
+
+    def test_cached_until_sync_writes(self):
+        self.write()
+        # Only the generation is read, and the sync times for statistics
+        for url, queries in (('/api/emails/', 1), ('/api/emails/threads/', 1),
+                             ('/api/emails/folders/', 1), ('/api/emails/statistics/', 2)):
+            response = self.client.get(url)
+            self.assertEqual(response['X-Cache'], 'MISS')
+            with self.assertNumQueries(queries):
+                response = self.client.get(url)
+            self.assertEqual(response['X-Cache'], 'HIT')
+
+        self.write()
+        response = self.client.get('/api/emails/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(len(response.data['results']), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            delete_emails(Email.objects.filter(message_id='1'))
+        response = self.client.get('/api/emails/statistics/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['total_emails'], 1)
+
+    def test_sync_times_not_cached(self):
+        self.write()
+        self.client.get('/api/emails/statistics/')
+        synced_at = timezone.now()
+        with self.captureOnCommitCallbacks(execute=True):
+            record_sync(self.server, 'INBOX', synced_at)
+        response = self.client.get('/api/emails/statistics/')
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(response.data['last_sync'], synced_at)
+        self.assertEqual(response.data['mailboxes'][0]['last_sync'], synced_at)
+
+    def test_generations_are_per_user(self):
+        other, other_server = create_account('other', name='Other')
+        self.write()
+        self.client.get('/api/emails/')
+        self.write(user=other, server=other_server)
+        response = self.client.get('/api/emails/')
+        self.assertEqual(response['X-Cache'], 'HIT')
+
+    def test_counters(self):
+        self.write()
+        self.client.get('/api/emails/')
+        self.client.get('/api/emails/')
+        self.client.force_authenticate(User.objects.create_superuser(username='admin'))
+        response = self.client.get('/api/cache-stats/')
+        self.assertEqual(response.data, {'hits': 1, 'misses': 1, 'hit_rate': 0.5})
+
+
+class ConditionalRequestTests(AccountTestMixin, APITestCase):
+    """Unchanged emails and lists are answered with 304 Not Modified"""
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+        self.uid = 0
+
+    def write(self, uid=None, subject='Message'):
+        if uid is None:
+            self.uid += 1
+            uid = self.uid
+        with self.captureOnCommitCallbacks(execute=True):
+            with EmailWriter() as writer:
+                writer.add(Email(
+                    user=self.user, imap_server=self.server, message_id=str(uid),
+                    folder='INBOX', subject=subject, sender='sender@example.com',
+                    recipient='reader@example.com', date=timezone.now(), body_text='Body',
+                ))
+        return Email.objects.get(message_id=str(uid))
+
+    def test_detail(self):
+        email_obj = self.write()
+        url = f'/api/emails/{email_obj.id}/'
+        response = self.client.get(url)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+
+        # One query reads the validators, nothing is serialized
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        self.write(uid=self.uid, subject='Edited')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['subject'], 'Edited')
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_list(self):
+        self.write()
+        response = self.client.get('/api/emails/')
+        etag = response['ETag']
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/emails/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # Other URLs are other representations
+        response = self.client.get('/api/emails/?folder=INBOX', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        self.write()
+        response = self.client.get('/api/emails/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 2)
+
+    def test_missing_email(self):
+        response = self.client.get('/api/emails/999/', HTTP_IF_NONE_MATCH='"x"')
+        self.assertEqual(response.status_code, 404)
@@ -5,7 +5,9 @@ from . import views
 router = DefaultRouter()
 router.register(r'imap-servers', views.IMAPServerViewSet, basename='imap-server')
 router.register(r'emails', views.EmailViewSet, basename='email')
+router.register(r'sync-jobs', views.SyncJobViewSet, basename='sync-job')
 
 urlpatterns = [
     path('', include(router.urls)),
+    path('cache-stats/', views.cache_stats, name='cache-stats'),
 ]
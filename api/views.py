@@ -1,21 +1,37 @@
 from rest_framework import viewsets, permissions, filters, status
-from rest_framework.decorators import action
+from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework.generics import get_object_or_404
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from django_filters.rest_framework import DjangoFilterBackend
-from emails.models import IMAPServer, Email
+from emails.attachments import iter_chunks, local_content
+from emails.models import IMAPServer, Attachment, Email, MailboxStats, SyncJob, Thread
+from emails import cache as response_cache
+from emails.cache import annotate_generation
+from emails.tasks import enqueue_body_fetch, enqueue_sync
+from emails.threads import annotate_thread_count, delete_emails, thread_members
+from .cache import cached_data, cached_response, entity_tag, not_modified, set_validators
+from .filters import EmailSearchFilter
+from .pagination import KeysetPagination
+from .renderers import DownloadRenderer
 from .serializers import (
     IMAPServerSerializer, EmailSerializer, 
-    EmailListSerializer, ThreadEmailSerializer
+    EmailListSerializer, SyncJobSerializer,
+    ThreadListSerializer, MailboxStatsSerializer, sync_age
 )
-from django.utils import timezone
-from django.db.models import Q, Count
-from imap_tools import MailBox, AND
-import datetime
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.utils.cache import patch_cache_control
+from django.utils.http import content_disposition_header
+from django.db.models import prefetch_related_objects
 import logging
 from emails.management.commands.sync_emails import Command as SyncCommand
 
 logger = logging.getLogger(__name__)
 
+# Seconds a client should wait before asking again for a pending body
+BODY_RETRY_AFTER = 2
+
 class IMAPServerViewSet(viewsets.ModelViewSet):
     serializer_class = IMAPServerSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -28,60 +44,141 @@ class IMAPServerViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
 
+    def perform_destroy(self, instance):
+        # Keep the user's thread summaries in step with the removed emails
+        delete_emails(Email.objects.filter(imap_server=instance))
+        instance.delete()
+
     @action(detail=True, methods=['post'])
     def sync(self, request, pk=None):
+        """Queue a background sync, or return the one already in progress"""
         imap_server = self.get_object()
-        sync_command = SyncCommand()
-        
+        full = str(request.data.get('full', '')).lower() in ('1', 'true')
+
         try:
-            sync_command.sync_server(imap_server)
-            return Response({'status': 'success', 'message': 'Email sync completed'})
+            job, created = enqueue_sync(imap_server, full=full)
         except Exception as e:
-            logger.error(f"Error during sync: {str(e)}")
+            logger.error(f"Error queueing sync: {str(e)}")
             return Response(
                 {'status': 'error', 'message': str(e)},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+        return Response(
+            {
+                'status': 'queued' if created else 'already_running',
+                'job_id': job.id,
+                'job': SyncJobSerializer(job).data
+            },
+            status=status.HTTP_202_ACCEPTED
+        )
+
+class SyncJobViewSet(viewsets.ReadOnlyModelViewSet):
+    serializer_class = SyncJobSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    filter_backends = [DjangoFilterBackend]
+    filterset_fields = ['imap_server', 'status']
+
+    def get_queryset(self):
+        return SyncJob.objects.filter(user=self.request.user)
+
 class EmailViewSet(viewsets.ReadOnlyModelViewSet):
     permission_classes = [permissions.IsAuthenticated]
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
+    # EmailSearchFilter comes last so its ranking replaces the default ordering
+    filter_backends = [DjangoFilterBackend, filters.OrderingFilter, EmailSearchFilter]
     filterset_fields = ['imap_server', 'folder', 'date']
-    search_fields = ['subject', 'sender', 'recipient', 'body_text']
+    pagination_class = KeysetPagination
     ordering_fields = ['date', 'created_at']
     ordering = ['-date']
 
     def get_queryset(self):
-        return Email.objects.filter(user=self.request.user)
+        queryset = Email.objects.filter(user=self.request.user)
+        if self.action == 'list':
+            # Metadata only, bodies are joined for single emails and threads
+            queryset = annotate_thread_count(queryset.only(*Email.LIST_FIELDS))
+        else:
+            queryset = queryset.select_related('body__text', 'body__html')
+            if self.action == 'retrieve':
+                queryset = queryset.prefetch_related('attachments')
+        return queryset
 
     def get_serializer_class(self):
         if self.action == 'list':
             return EmailListSerializer
         return EmailSerializer
 
+    @cached_response('list')
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        # Validators are read first without the body columns, an unchanged
+        # email is answered with 304 before it is loaded and serialized
+        validators = self._detail_validators(kwargs[self.lookup_field])
+        if validators is not None and not validators[2]:
+            response = not_modified(request, *validators[:2])
+            if response is not None:
+                return response
+
+        email_obj = self.get_object()
+        if email_obj.body_pending:
+            # Body was skipped during a headers first sync. It is downloaded
+            # in the background, the client asks again for the full email
+            enqueue_body_fetch(email_obj)
+            response = Response(
+                self.get_serializer(email_obj).data, status=status.HTTP_202_ACCEPTED
+            )
+            response['Retry-After'] = str(BODY_RETRY_AFTER)
+            return response
+        serializer = self.get_serializer(email_obj)
+        response = Response(serializer.data)
+        if validators is not None:
+            set_validators(response, *validators[:2])
+        return response
+
+    def _detail_validators(self, pk):
+        """``(etag, last_modified, body_pending)`` of one of the user's emails.
+
+        The ETag covers the email's updated_at and the user's cache
+        generation, which changes whenever a sync touches the email's thread.
+        """
+        try:
+            row = (
+                annotate_generation(Email.objects.filter(user=self.request.user, pk=pk))
+                .values('id', 'updated_at', 'body_pending', 'cache_generation', 'cache_updated_at')
+                .first()
+            )
+        except (TypeError, ValueError):
+            return None
+        if row is None:
+            return None
+        etag = entity_tag(self.request, 'detail', row['id'], row['updated_at'].isoformat(),
+                          row['cache_generation'] or 0)
+        last_modified = max(filter(None, (row['updated_at'], row['cache_updated_at'])))
+        return etag, last_modified, row['body_pending']
+
     @action(detail=False)
+    @cached_response('threads')
     def threads(self, request):
-        """Get all email threads"""
+        """Get email threads, most recently active first
+
+        Each thread is represented by its first email, with the number of
+        emails and the date of the latest one. Reads the Thread table
+        maintained during sync, paginated by a cursor on (last_date, id).
+        """
         threads = (
-            Email.objects
-            .filter(user=self.request.user)
-            .exclude(thread_id='')
-            .values('thread_id')
-            .distinct()
+            Thread.objects
+            .filter(user=self.request.user, root__isnull=False, last_date__isnull=False)
+            .select_related('root')
+            .order_by('-last_date', '-id')
         )
-        
-        thread_emails = []
-        for thread in threads:
-            thread_id = thread['thread_id']
-            emails = (
-                Email.objects
-                .filter(thread_id=thread_id)
-                .order_by('date')
-            )
-            if emails:
-                thread_emails.append(emails[0])  # Add the first email of each thread
 
-        serializer = EmailListSerializer(thread_emails, many=True)
+        page = self.paginate_queryset(threads)
+        if page is not None:
+            serializer = ThreadListSerializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+
+        serializer = ThreadListSerializer(threads, many=True)
         return Response(serializer.data)
 
     @action(detail=True)
@@ -89,17 +186,61 @@ class EmailViewSet(viewsets.ReadOnlyModelViewSet):
         """Get all emails in a thread"""
         email_obj = self.get_object()
         if not email_obj.thread_id:
+            prefetch_related_objects([email_obj], 'attachments')
             return Response([EmailSerializer(email_obj).data])
-        
-        thread_emails = (
-            Email.objects
-            .filter(thread_id=email_obj.thread_id)
-            .order_by('date')
+
+        # One query loads the thread, each email's thread_emails reuse it
+        members = thread_members(request.user.id, [email_obj.thread_id])
+        prefetch_related_objects(members[email_obj.thread_id], 'attachments')
+        serializer = EmailSerializer(
+            members[email_obj.thread_id],
+            many=True,
+            context={**self.get_serializer_context(), 'thread_members': members}
         )
-        serializer = EmailSerializer(thread_emails, many=True)
         return Response(serializer.data)
 
+    @action(
+        detail=True,
+        url_path=r'attachments/(?P<index>\d+)',
+        renderer_classes=[JSONRenderer, DownloadRenderer]
+    )
+    def attachment(self, request, pk=None, index=None):
+        """Download an attachment
+
+        Read from the stored message source when the message is small
+        enough, otherwise streamed from the IMAP server in chunks.
+        """
+        attachment = get_object_or_404(
+            Attachment.objects.select_related('email__imap_server', 'email__body'),
+            email__user=request.user, email_id=pk, index=index
+        )
+
+        content = local_content(attachment)
+        if content is not None:
+            chunk_size = getattr(settings, 'ATTACHMENT_CHUNK_SIZE', 1024 * 1024)
+            response = StreamingHttpResponse(
+                iter_chunks(content, chunk_size), content_type=attachment.content_type
+            )
+            response['Content-Length'] = len(content)
+        else:
+            try:
+                chunks = SyncCommand().stream_attachment(attachment)
+            except Exception as e:
+                logger.error(f"Error fetching attachment {index} of email {pk}: {str(e)}")
+                return Response(
+                    {'status': 'error', 'message': str(e)},
+                    status=status.HTTP_502_BAD_GATEWAY
+                )
+            response = StreamingHttpResponse(chunks, content_type=attachment.content_type)
+
+        response['Content-Disposition'] = content_disposition_header(
+            True, attachment.filename or f'attachment-{attachment.index}'
+        )
+        patch_cache_control(response, private=True)
+        return response
+
     @action(detail=False)
+    @cached_response('folders')
     def folders(self, request):
         """Get list of available folders"""
         folders = (
@@ -113,29 +254,54 @@ class EmailViewSet(viewsets.ReadOnlyModelViewSet):
 
     @action(detail=False)
     def statistics(self, request):
-        """Get email statistics"""
-        total_emails = Email.objects.filter(user=self.request.user).count()
-        total_threads = (
-            Email.objects
-            .filter(user=self.request.user)
-            .exclude(thread_id='')
-            .values('thread_id')
-            .distinct()
-            .count()
-        )
-        folders_count = (
-            Email.objects
+        """Get email statistics
+
+        Reads the per-folder counters maintained during sync instead of
+        counting emails. Counters are cached until the next sync changes
+        them, sync times are read and their ages computed on every request:
+        a sync finding nothing new does not invalidate the cache.
+        """
+        def compute():
+            mailboxes = list(MailboxStats.objects.filter(user=self.request.user))
+            folders = {}
+            for stats in mailboxes:
+                folders[stats.folder] = folders.get(stats.folder, 0) + stats.message_count
+            return {
+                'total_emails': sum(stats.message_count for stats in mailboxes),
+                'total_unread': sum(stats.unread_count for stats in mailboxes),
+                'total_size': sum(stats.total_size for stats in mailboxes),
+                'total_threads': Thread.objects.filter(user=self.request.user).count(),
+                'folders': dict(sorted(folders.items(), key=lambda item: -item[1])),
+                'mailboxes': [
+                    MailboxStatsSerializer(stats).data for stats in mailboxes
+                ],
+            }, True
+
+        data, hit = cached_data(request, 'statistics', compute)
+        synced = {
+            (server_id, folder): last_sync
+            for server_id, folder, last_sync in MailboxStats.objects
             .filter(user=self.request.user)
-            .values('folder')
-            .annotate(count=Count('id'))
-            .order_by('-count')
-        )
+            .order_by()
+            .values_list('imap_server_id', 'folder', 'last_sync')
+        }
+        data = dict(data)
+        data['mailboxes'] = [
+            {**mailbox, 'last_sync': synced.get((mailbox['imap_server'], mailbox['folder']))}
+            for mailbox in data['mailboxes']
+        ]
+        for mailbox in data['mailboxes']:
+            mailbox['last_sync_age'] = sync_age(mailbox['last_sync'])
+        last_sync = [value for value in synced.values() if value]
+        data['last_sync'] = max(last_sync) if last_sync else None
+        data['last_sync_age'] = sync_age(data['last_sync'])
+        response = Response(data)
+        if hit is not None:
+            response['X-Cache'] = 'HIT' if hit else 'MISS'
+        return response
 
-        return Response({
-            'total_emails': total_emails,
-            'total_threads': total_threads,
-            'folders': {
-                item['folder']: item['count'] 
-                for item in folders_count
-            }
-        })
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def cache_stats(request):
+    """Hit and miss counts of the response cache"""
+    return Response(response_cache.counters())
@@ -1,46 +1,81 @@
 from django.contrib import admin
-from .models import IMAPServer, Email
+from .models import IMAPServer, Attachment, Blob, Email, EmailBody, FolderSyncState, MailboxStats, SyncJob, Thread
+from .threads import annotate_thread_count
 
 @admin.register(IMAPServer)
 class IMAPServerAdmin(admin.ModelAdmin):
     list_display = ('name', 'host', 'username', 'user', 'sync_limit_type', 'last_sync')
-    list_filter = ('use_ssl', 'user', 'sync_limit_type', 'exclude_trash')
+    list_filter = ('use_ssl', 'user', 'sync_limit_type', 'fetch_mode', 'exclude_trash')
     search_fields = ('name', 'host', 'username', 'folders_to_sync')
     ordering = ('name',)
     fieldsets = (
         (None, {
-            'fields': ('user', 'name', 'host', 'port', 'username', 'password', 'use_ssl')
+            'fields': ('user', 'name', 'host', 'port', 'username', 'password', 'use_ssl',
+                       'max_connections')
         }),
         ('Sync Settings', {
-            'fields': ('sync_limit_type', 'sync_limit_value', 'folders_to_sync', 'exclude_trash')
+            'fields': ('sync_limit_type', 'sync_limit_value', 'fetch_mode', 'max_body_size',
+                       'folders_to_sync', 'exclude_trash')
         }),
         ('Status', {
             'fields': ('last_sync',)
         }),
     )
 
+class EmailBodyInline(admin.StackedInline):
+    model = EmailBody
+    can_delete = False
+    fields = ('body_text', 'body_html', 'raw_headers')
+    readonly_fields = fields
+
+    def body_text(self, obj):
+        return obj.email.body_text
+
+    def body_html(self, obj):
+        return obj.email.body_html
+
+    def raw_headers(self, obj):
+        return obj.email.raw_headers
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+class AttachmentInline(admin.TabularInline):
+    model = Attachment
+    can_delete = False
+    extra = 0
+    fields = ('index', 'filename', 'content_type', 'size', 'content_id', 'part', 'encoding')
+    readonly_fields = fields
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
 @admin.register(Email)
 class EmailAdmin(admin.ModelAdmin):
     list_display = ('subject', 'sender', 'recipient', 'date', 'folder', 'user', 'thread_status')
     list_filter = ('imap_server', 'date', 'user', 'folder')
-    search_fields = ('subject', 'sender', 'recipient', 'body_text', 'message_id', 'thread_id')
+    search_fields = ('subject', 'sender', 'recipient', 'snippet', 'message_id', 'rfc_message_id',
+                     'thread_id')
     ordering = ('-date',)
     date_hierarchy = 'date'
-    readonly_fields = ('thread_id', 'in_reply_to', 'references', 'message_id', 'created_at', 'updated_at')
+    inlines = [EmailBodyInline, AttachmentInline]
+    readonly_fields = ('snippet', 'thread_id', 'in_reply_to', 'references', 'message_id', 'rfc_message_id',
+                       'size', 'body_pending',
+                       'flags', 'created_at', 'updated_at')
     
     fieldsets = (
         (None, {
             'fields': ('user', 'imap_server', 'folder', 'subject', 'sender', 'recipient', 'date')
         }),
         ('Content', {
-            'fields': ('body_text', 'body_html')
+            'fields': ('snippet',)
         }),
         ('Threading Information', {
-            'fields': ('thread_id', 'in_reply_to', 'references'),
+            'fields': ('rfc_message_id', 'thread_id', 'in_reply_to', 'references'),
             'classes': ('collapse',)
         }),
         ('System Information', {
-            'fields': ('message_id', 'created_at', 'updated_at'),
+            'fields': ('message_id', 'size', 'body_pending', 'flags', 'created_at', 'updated_at'),
             'classes': ('collapse',)
         }),
     )
@@ -49,10 +84,59 @@ class EmailAdmin(admin.ModelAdmin):
         """Display thread status in admin list view"""
         if not obj.thread_id:
             return "Single"
-        thread_count = Email.objects.filter(thread_id=obj.thread_id).count()
-        return f"Thread ({thread_count} messages)"
+        return f"Thread ({obj.thread_count} messages)"
     thread_status.short_description = 'Thread Status'
+    thread_status.admin_order_field = 'thread_count'
 
     def get_queryset(self, request):
         """Optimize queryset for admin list view"""
-        return super().get_queryset(request).select_related('user', 'imap_server')
+        queryset = super().get_queryset(request).select_related('user', 'imap_server')
+        return annotate_thread_count(queryset)
+
+@admin.register(FolderSyncState)
+class FolderSyncStateAdmin(admin.ModelAdmin):
+    list_display = ('imap_server', 'folder', 'uidvalidity', 'last_uid', 'highestmodseq', 'last_sync')
+    list_filter = ('imap_server',)
+    search_fields = ('folder',)
+    ordering = ('imap_server', 'folder')
+
+@admin.register(SyncJob)
+class SyncJobAdmin(admin.ModelAdmin):
+    list_display = ('imap_server', 'user', 'status', 'folders_done', 'folders_total',
+                    'messages_processed', 'created_at', 'finished_at')
+    list_filter = ('status', 'imap_server')
+    readonly_fields = ('created_at', 'updated_at', 'started_at', 'finished_at')
+    ordering = ('-created_at',)
+
+@admin.register(Thread)
+class ThreadAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'user', 'message_count', 'first_date', 'last_date')
+    list_filter = ('user',)
+    search_fields = ('subject', 'thread_id')
+    ordering = ('-last_date',)
+    readonly_fields = ('root', 'participants', 'folders', 'message_count',
+                       'first_date', 'last_date', 'updated_at')
+
+@admin.register(MailboxStats)
+class MailboxStatsAdmin(admin.ModelAdmin):
+    list_display = ('imap_server', 'folder', 'user', 'message_count', 'unread_count',
+                    'total_size', 'last_sync')
+    list_filter = ('imap_server',)
+    ordering = ('imap_server', 'folder')
+    readonly_fields = ('message_count', 'unread_count', 'total_size', 'last_sync', 'updated_at')
+
+@admin.register(Blob)
+class BlobAdmin(admin.ModelAdmin):
+    list_display = ('digest', 'codec', 'size', 'stored_size', 'created_at')
+    list_filter = ('codec',)
+    search_fields = ('digest',)
+    fields = ('digest', 'codec', 'size', 'stored_size', 'created_at')
+    readonly_fields = fields
+
+    def stored_size(self, obj):
+        """Compressed size in bytes"""
+        return len(obj.data)
+    stored_size.short_description = 'Stored Size'
+
+    def has_add_permission(self, request):
+        return False
@@ -0,0 +1,179 @@
+"""Minimal asyncio IMAP4rev1 client used by the async sync engine.
+
+Only the commands needed to mirror a mailbox are implemented: LOGIN,
+LIST, SELECT, UID SEARCH, UID FETCH (with CONDSTORE CHANGEDSINCE) and
+LOGOUT. Every network read and
+write is bounded by the client's own timeout, so one stalled server never
+affects other connections in the same event loop.
+"""
+import asyncio
+import logging
+import re
+import ssl
+
+from imap_tools.imap_utf7 import utf7_decode, utf7_encode
+
+logger = logging.getLogger(__name__)
+
+LITERAL_RE = re.compile(rb'\{(\d+)\}\r\n$')
+FETCH_UID_RE = re.compile(rb'\bUID (\d+)')
+FETCH_FLAGS_RE = re.compile(rb'\bFLAGS \(([^)]*)\)')
+FETCH_SIZE_RE = re.compile(rb'\bRFC822\.SIZE (\d+)')
+LIST_RE = re.compile(rb'\* LIST \(([^)]*)\) (?:"(?:[^"\\]|\\.)*"|NIL) ?(.*)$')
+RESP_CODE_RE = re.compile(rb'\[(UIDVALIDITY|UIDNEXT|HIGHESTMODSEQ) (\d+)\]')
+
+
+class IMAPError(Exception):
+    """Raised when the server rejects a command or the connection breaks"""
+
+
+def quote(value):
+    """Quote a string argument for an IMAP command"""
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def unquote(value):
+    """Decode a quoted or atom folder name from a LIST response"""
+    if value.startswith(b'"') and value.endswith(b'"'):
+        value = re.sub(rb'\\(.)', rb'\1', value[1:-1])
+    return utf7_decode(value)
+
+
+class Response:
+    """One untagged response: its text lines and any literals it carried"""
+
+    def __init__(self):
+        self.text = b''
+        self.literals = []
+
+    def __repr__(self):
+        return f"Response({self.text[:60]!r}, {len(self.literals)} literals)"
+
+
+class AsyncIMAPClient:
+    def __init__(self, host, port=993, use_ssl=True, timeout=300):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self._reader = None
+        self._writer = None
+        self._tag = 0
+
+    async def connect(self):
+        ssl_context = ssl.create_default_context() if self.use_ssl else None
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=ssl_context),
+            self.timeout
+        )
+        greeting = await self._readline()
+        if not greeting.startswith(b'* OK') and not greeting.startswith(b'* PREAUTH'):
+            raise IMAPError(f"Unexpected greeting: {greeting!r}")
+        return self
+
+    async def _readline(self):
+        line = await asyncio.wait_for(self._reader.readline(), self.timeout)
+        if not line:
+            raise IMAPError("Connection closed by server")
+        return line
+
+    async def _read_response(self):
+        """Read one complete response line, including inline literals."""
+        response = Response()
+        while True:
+            line = await self._readline()
+            match = LITERAL_RE.search(line)
+            if not match:
+                response.text += line.rstrip(b'\r\n')
+                return response
+            response.text += line[:match.start()]
+            response.literals.append(await asyncio.wait_for(
+                self._reader.readexactly(int(match.group(1))), self.timeout
+            ))
+
+    async def command(self, name, *args):
+        """Send a command and return its untagged responses.
+
+        Raises IMAPError unless the tagged completion is OK.
+        """
+        self._tag += 1
+        tag = f'A{self._tag:04d}'.encode()
+        line = ' '.join([tag.decode(), name, *args]).encode() + b'\r\n'
+        self._writer.write(line)
+        await asyncio.wait_for(self._writer.drain(), self.timeout)
+
+        untagged = []
+        while True:
+            response = await self._read_response()
+            if response.text.startswith(tag + b' '):
+                status = response.text[len(tag) + 1:]
+                if not status.startswith(b'OK'):
+                    raise IMAPError(f"{name} failed: {status.decode(errors='replace')}")
+                return untagged
+            untagged.append(response)
+
+    async def login(self, username, password):
+        await self.command('LOGIN', quote(username), quote(password))
+
+    async def list_folders(self):
+        names = []
+        for response in await self.command('LIST', '""', '"*"'):
+            match = LIST_RE.match(response.text)
+            if not match:
+                continue
+            if b'\\noselect' in match.group(1).lower():
+                continue
+            if response.literals:
+                names.append(utf7_decode(response.literals[0]))
+            else:
+                names.append(unquote(match.group(2)))
+        return names
+
+    async def select(self, folder, readonly=True):
+        """Select a folder, returning UIDVALIDITY/UIDNEXT/EXISTS."""
+        name = quote(utf7_encode(folder).decode())
+        status = {}
+        for response in await self.command('EXAMINE' if readonly else 'SELECT', name):
+            for key, value in RESP_CODE_RE.findall(response.text):
+                status[key.decode()] = int(value)
+            if response.text.endswith(b' EXISTS'):
+                status['EXISTS'] = int(response.text.split()[1])
+        return status
+
+    async def uid_search(self, criteria='ALL'):
+        uids = []
+        for response in await self.command('UID SEARCH', criteria):
+            if response.text.startswith(b'* SEARCH'):
+                uids.extend(int(u) for u in response.text.split()[2:])
+        return uids
+
+    async def uid_fetch(self, uids, items):
+        """Fetch the given UIDs, a list or a UID set string like ``1:100``.
+
+        Returns ``(uid, flags, size, literal)`` tuples where ``literal`` is
+        the first literal of the response, usually the requested body.
+        """
+        uid_set = uids if isinstance(uids, str) else ','.join(str(u) for u in uids)
+        result = []
+        for response in await self.command('UID FETCH', uid_set, items):
+            uid_match = FETCH_UID_RE.search(response.text)
+            if b' FETCH ' not in response.text or not uid_match:
+                continue
+            flags_match = FETCH_FLAGS_RE.search(response.text)
+            size_match = FETCH_SIZE_RE.search(response.text)
+            result.append((
+                int(uid_match.group(1)),
+                flags_match.group(1).decode().split() if flags_match else [],
+                int(size_match.group(1)) if size_match else 0,
+                response.literals[0] if response.literals else b'',
+            ))
+        return result
+
+    async def logout(self):
+        try:
+            await self.command('LOGOUT')
+        except (IMAPError, asyncio.TimeoutError, OSError):
+            pass
+        finally:
+            if self._writer is not None:
+                self._writer.close()
@@ -0,0 +1,312 @@
+"""Asyncio sync engine multiplexing many IMAP accounts in one process.
+
+Each account is a coroutine talking to its server over an
+``AsyncIMAPClient`` with its own timeout. Fetched messages go through a
+bounded queue to a single consumer, which parses and stores them with the
+same code the threaded ``sync_emails`` engine uses, parsing in worker
+processes when ``--parse-workers`` is set. All ORM work runs in one
+dedicated thread.
+"""
+import asyncio
+import functools
+import logging
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .aioimap import AsyncIMAPClient, IMAPError
+from .messages import build_mail_message
+from .pipeline import ParsePipeline
+from .writer import EmailWriter
+
+logger = logging.getLogger(__name__)
+
+# Messages per UID FETCH command
+FETCH_BULK_SIZE = 100
+# Queue items handed to the database thread at once
+SAVE_BATCH_SIZE = 100
+
+
+class AsyncSyncEngine:
+    """Sync servers concurrently from a single event loop.
+
+    ``command`` is the ``sync_emails`` Command whose parsing and folder
+    state helpers are reused. ``concurrency`` caps accounts synced at once,
+    ``per_host`` caps connections to one host, and ``queue_size`` bounds
+    the number of fetched messages waiting to be stored.
+    """
+
+    def __init__(self, command, concurrency=100, per_host=2, queue_size=1000,
+                 full=False, timeout=None):
+        self.command = command
+        self.concurrency = max(1, concurrency)
+        self.per_host = max(1, per_host)
+        self.queue_size = queue_size
+        self.full = full
+        self.timeout = timeout or getattr(settings, 'EMAIL_SYNC_TIMEOUT', 300)
+
+    def run(self, servers):
+        """Sync the given servers, returning one result dict per server."""
+        return asyncio.run(self._run(list(servers)))
+
+    async def _run(self, servers):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._db = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sync-db')
+        self._accounts = asyncio.Semaphore(self.concurrency)
+        self._hosts = defaultdict(lambda: asyncio.Semaphore(self.per_host))
+
+        # Futures of servers waiting for the consumer to store their messages
+        self._waiting = set()
+        self._consumer = asyncio.create_task(self._consume())
+        self._producers = [asyncio.create_task(self._sync_server(s)) for s in servers]
+        self._consumer.add_done_callback(self._consumer_stopped)
+        try:
+            results = await asyncio.gather(*self._producers, return_exceptions=True)
+            if not self._consumer.done():
+                await self._queue.put(None)
+            # Raises the error the consumer stopped on, if any
+            await self._consumer
+        finally:
+            if not self._consumer.done():
+                self._consumer.cancel()
+            await self._db_call(self._close_connection)
+            self._db.shutdown()
+        return results
+
+    def _consumer_stopped(self, consumer):
+        """Release the producers when the consumer failed.
+
+        Nothing will store their messages any more: servers waiting for
+        their results get the consumer's error and every producer is
+        cancelled, including those blocked on the full queue.
+        """
+        if consumer.cancelled() or consumer.exception() is None:
+            return
+        logger.error(f"Storing synced emails failed: {consumer.exception()}")
+        for done in self._waiting:
+            if not done.done():
+                done.set_exception(consumer.exception())
+        for producer in self._producers:
+            producer.cancel()
+
+    @staticmethod
+    def _close_connection():
+        connection.close()
+
+    async def _db_call(self, func, *args):
+        return await self._loop.run_in_executor(self._db, functools.partial(func, *args))
+
+    async def _sync_server(self, server):
+        result = {'server': server, 'inserted': 0, 'updated': 0, 'error': None}
+        started = time.monotonic()
+        ok = False
+        try:
+            async with self._accounts, self._hosts[server.host.lower()]:
+                client = AsyncIMAPClient(
+                    server.host, server.port, server.use_ssl, self.timeout
+                )
+                await client.connect()
+                try:
+                    await client.login(server.username, server.password)
+                    folders = self.command._filter_folders(
+                        server, await client.list_folders()
+                    )
+                    for folder in folders:
+                        try:
+                            await self._sync_folder(client, server, folder)
+                        except (IMAPError, asyncio.TimeoutError, OSError) as e:
+                            error = str(e) or e.__class__.__name__
+                            logger.error(f"Error syncing folder {folder}: {error}")
+                finally:
+                    await client.logout()
+            ok = True
+        except Exception as e:
+            result['error'] = str(e) or e.__class__.__name__
+            logger.error(f"Error syncing server {server.name}: {result['error']}")
+        finally:
+            if not self._consumer.done():
+                # Let the consumer flush and close this server's writer
+                done = self._loop.create_future()
+                self._waiting.add(done)
+                try:
+                    await self._queue.put(('server', server, ok, done))
+                    result.update(await done)
+                finally:
+                    self._waiting.discard(done)
+            result['duration'] = time.monotonic() - started
+        return result
+
+    async def _sync_folder(self, client, server, folder):
+        status = await client.select(folder)
+        state = await self._db_call(
+            self.command._get_folder_state,
+            server, folder, status.get('UIDVALIDITY'), self.full
+        )
+
+        try:
+            await self._reconcile_folder(
+                client, server, folder, state, status.get('HIGHESTMODSEQ')
+            )
+        except (IMAPError, asyncio.TimeoutError, OSError) as e:
+            logger.error(f"Error reconciling folder {folder}: {str(e) or e.__class__.__name__}")
+
+        uidnext = status.get('UIDNEXT')
+        if uidnext and uidnext - 1 <= state.last_uid:
+            await self._db_call(self.command._save_folder_state, state)
+            return
+
+        criteria = str(self.command._build_search_criteria(server, state.last_uid))
+        uids = self.command._limit_uids(
+            server, await client.uid_search(criteria), state.last_uid
+        )
+
+        headers_first = server.fetch_mode == 'headers_first'
+        for i in range(0, len(uids), FETCH_BULK_SIZE):
+            chunk = uids[i:i + FETCH_BULK_SIZE]
+            full_uids, header_uids = chunk, []
+            if headers_first:
+                # Like Command._fetch_bodies: bodies already stored are not
+                # downloaded again, those above max_body_size are left pending
+                sizes = {
+                    uid: size for uid, _, size, _
+                    in await client.uid_fetch(chunk, '(UID RFC822.SIZE)')
+                }
+                stored = await self._db_call(
+                    self.command._stored_bodies, server, folder, chunk
+                )
+                full_uids = [
+                    u for u in chunk if u not in stored and (
+                        not server.max_body_size or sizes.get(u, 0) <= server.max_body_size
+                    )
+                ]
+                header_uids = [u for u in chunk if u not in stored and u not in full_uids]
+
+            for part_uids, section, body_pending in (
+                (full_uids, 'BODY.PEEK[]', False),
+                (header_uids, 'BODY.PEEK[HEADER]', True),
+            ):
+                if not part_uids:
+                    continue
+                fetched = await client.uid_fetch(
+                    part_uids, f'(UID FLAGS RFC822.SIZE {section})'
+                )
+                for uid, flags, size, raw in fetched:
+                    # Blocks while the queue is full, throttling the fetch
+                    await self._queue.put(
+                        ('message', server, folder, build_mail_message(uid, flags, size, raw),
+                         body_pending)
+                    )
+
+        last_uid = max(uids, default=state.last_uid)
+        await self._queue.put(('folder', server, state, last_uid))
+
+    async def _reconcile_folder(self, client, server, folder, state, highestmodseq):
+        """Async counterpart of ``sync_emails.Command._reconcile_folder``."""
+        if not state.last_uid:
+            state.highestmodseq = highestmodseq
+            return
+        if highestmodseq and state.highestmodseq == highestmodseq:
+            return
+
+        uid_range = f'1:{state.last_uid}'
+        if highestmodseq and state.highestmodseq:
+            fetched = await client.uid_fetch(
+                uid_range, f'(UID FLAGS) (CHANGEDSINCE {state.highestmodseq})'
+            )
+            present = set(await client.uid_search(f'UID {uid_range}'))
+        else:
+            fetched = await client.uid_fetch(uid_range, '(UID FLAGS)')
+            present = set(uid for uid, _, _, _ in fetched)
+        flags = {
+            uid: self.command._format_flags(names) for uid, names, _, _ in fetched
+        }
+
+        await self._db_call(
+            self.command._apply_reconciliation,
+            server, folder, state.last_uid, flags, present
+        )
+        state.highestmodseq = highestmodseq
+
+    async def _consume(self):
+        pipelines = {}
+        failed = set()
+        try:
+            while True:
+                items = [await self._queue.get()]
+                while len(items) < SAVE_BATCH_SIZE and not self._queue.empty():
+                    items.append(self._queue.get_nowait())
+                if await self._db_call(self._save_items, pipelines, failed, items):
+                    return
+        finally:
+            # Drop the messages of servers left unfinished
+            for pipeline in pipelines.values():
+                pipeline.close()
+
+    def _save_items(self, pipelines, failed, items):
+        """Store a batch of queue items. Runs in the database thread.
+
+        ``failed`` holds the ``(server id, folder)`` whose emails could not
+        be written, their position is left where it was.
+        """
+        for item in items:
+            if item is None:
+                return True
+            kind, server = item[0], item[1]
+            pipeline = pipelines.get(server.id)
+            if pipeline is None:
+                # This database thread already writes apart from the
+                # event loop, a second connection writing would only contend
+                pipeline = pipelines[server.id] = ParsePipeline(
+                    self.command,
+                    EmailWriter(batch_size=self.command.batch_size),
+                    self.command.parse_executor,
+                    self.queue_size,
+                    writer_thread=False,
+                )
+            writer = pipeline.writer
+
+            if kind == 'message':
+                _, _, folder, msg, body_pending = item
+                if (server.id, folder) in failed:
+                    continue
+                try:
+                    pipeline.add(msg, server, folder, body_pending)
+                except Exception as e:
+                    logger.error(f"Error saving folder {folder}: {str(e)}")
+                    failed.add((server.id, folder))
+                    writer.clear()
+
+            elif kind == 'folder':
+                _, _, state, last_uid = item
+                try:
+                    # Only advance the UID position once the messages are stored
+                    pipeline.drain()
+                    writer.flush()
+                    if (server.id, state.folder) not in failed:
+                        state.last_uid = last_uid
+                        self.command._save_folder_state(state)
+                except Exception as e:
+                    logger.error(f"Error saving folder {state.folder}: {str(e)}")
+                    writer.clear()
+                failed.discard((server.id, state.folder))
+
+            elif kind == 'server':
+                _, _, ok, done = item
+                pipelines.pop(server.id)
+                stats = {'inserted': 0, 'updated': 0}
+                try:
+                    pipeline.drain()
+                    if ok:
+                        writer.flush()
+                        server.last_sync = timezone.now()
+                        server.save(update_fields=['last_sync'])
+                    stats = writer.stats
+                except Exception as e:
+                    logger.error(f"Error saving server {server.name}: {str(e)}")
+                self._loop.call_soon_threadsafe(done.set_result, stats)
+        return False
@@ -0,0 +1,104 @@
+"""Attachments of synced emails.
+
+The sync records the metadata of every attachment with its IMAP body
+section, the content itself is not stored again. A download is read from
+the email's stored RFC822 source when the message is small enough to parse
+in memory (``ATTACHMENT_LOCAL_MAX_SIZE``). Larger ones are streamed from
+the IMAP server with partial ``BODY.PEEK[part]<offset.length>`` fetches,
+decoded chunk by chunk, see ``sync_emails.Command.stream_attachment``.
+"""
+import email
+import logging
+
+from django.conf import settings
+from imap_tools.message import MailAttachment
+
+from .messages import find_part, part_payload, walk_parts
+from .models import Attachment
+
+logger = logging.getLogger(__name__)
+
+
+def is_attachment(part):
+    """Same rule as imap_tools: named or referenced parts and attached messages."""
+    return (
+        part.get('Content-ID') is not None
+        or part.get_filename() is not None
+        or part.get_content_type() == 'message/rfc822'
+    )
+
+
+def _transfer_encoding(part):
+    return str(part.get('Content-Transfer-Encoding', '')).strip().lower()
+
+
+def _decoded_size(part):
+    """Size of the decoded content, counted without decoding base64."""
+    payload = part.get_payload()
+    if isinstance(payload, str) and _transfer_encoding(part) == 'base64':
+        data = ''.join(payload.split())
+        return len(data) // 4 * 3 - data[-2:].count('=')
+    return len(part_payload(part))
+
+
+def attachment_fields(message):
+    """Field values of the attachments of a parsed message, as plain dicts."""
+    attachments = []
+    for number, part in walk_parts(message):
+        if not is_attachment(part):
+            continue
+        info = MailAttachment(part)
+        attachments.append({
+            'index': len(attachments),
+            'part': number,
+            'filename': info.filename[:255],
+            'content_type': part.get_content_type()[:255],
+            'size': _decoded_size(part),
+            'content_id': info.content_id[:255],
+            'encoding': _transfer_encoding(part)[:50],
+        })
+    return attachments
+
+
+def attachments_of(message):
+    """Unsaved Attachment rows of a parsed message, without their email."""
+    return [Attachment(**fields) for fields in attachment_fields(message)]
+
+
+def save_attachments(emails):
+    """Replace the Attachment rows of saved emails with their parsed ones.
+
+    Emails without ``pending_attachments``, like those synced without their
+    body, keep the rows they have.
+    """
+    parsed = [e for e in emails if e.pk and getattr(e, 'pending_attachments', None) is not None]
+    if not parsed:
+        return
+    Attachment.objects.filter(email__in=[e.pk for e in parsed]).delete()
+    rows = []
+    for e in parsed:
+        for attachment in e.pending_attachments:
+            attachment.email = e
+            rows.append(attachment)
+    Attachment.objects.bulk_create(rows)
+
+
+def local_content(attachment):
+    """Content of the attachment from the stored source, None if the message
+    has no stored source or is too large to be parsed in memory."""
+    email_obj = attachment.email
+    if email_obj.size > getattr(settings, 'ATTACHMENT_LOCAL_MAX_SIZE', 10 * 1024 * 1024):
+        return None
+    body = email_obj._body()
+    if body is None or body.raw_id is None:
+        return None
+    part = find_part(email.message_from_bytes(body.raw.read()), attachment.part)
+    if part is None:
+        logger.error(f"Part {attachment.part} not found in the source of email {email_obj.id}")
+        return None
+    return part_payload(part)
+
+
+def iter_chunks(data, chunk_size):
+    for start in range(0, len(data), chunk_size):
+        yield data[start:start + chunk_size]
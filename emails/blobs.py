@@ -0,0 +1,63 @@
+"""Compression and addressing of stored email content.
+
+Bodies and message sources are kept in the Blob table, keyed by the
+SHA-256 of their uncompressed bytes: a message copied to several folders,
+or the same newsletter received by several accounts, is stored once and
+each EmailBody points at it. Blobs are compressed with zstd when the
+``zstandard`` package is installed and with zlib otherwise, the codec is
+stored with every blob so both can be read side by side.
+"""
+import hashlib
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZSTD_LEVEL = 3
+ZLIB_LEVEL = 6
+
+CODEC_NONE = 'none'
+CODEC_ZLIB = 'zlib'
+CODEC_ZSTD = 'zstd'
+
+
+def default_codec():
+    return CODEC_ZSTD if zstandard is not None else CODEC_ZLIB
+
+
+def content_digest(data):
+    """Hex SHA-256 of uncompressed bytes, the key of their blob."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def compress(data, codec=None):
+    """Compress bytes, returning ``(codec, data)``.
+
+    Content that does not get smaller is kept uncompressed.
+    """
+    codec = codec or default_codec()
+    if codec == CODEC_ZSTD:
+        packed = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    elif codec == CODEC_ZLIB:
+        packed = zlib.compress(data, ZLIB_LEVEL)
+    else:
+        return CODEC_NONE, data
+    if len(packed) >= len(data):
+        return CODEC_NONE, data
+    return codec, packed
+
+
+def decompress(codec, data):
+    """Bytes of a blob stored with ``codec``."""
+    data = bytes(data)
+    if codec == CODEC_NONE:
+        return data
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise Exception("The zstandard package is needed to read zstd compressed blobs")
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise Exception(f"Unknown blob codec {codec}")
@@ -0,0 +1,89 @@
+"""Per-user cache generations.
+
+Cached API responses and ETags are keyed by the user's current generation,
+a counter stored in CacheGeneration. Whenever the sync changes a user's
+emails it bumps the generation, so the next request misses and every older
+entry is left to expire: invalidation is exact without deleting keys one
+by one. Keeping the counter in the database makes it shared by every
+process, even when the cache itself is per-process local memory.
+
+Generations are bumped once the writing transaction commits, a request
+running meanwhile can only cache what it read under the old generation.
+"""
+import logging
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery
+from django.utils import timezone
+
+from .models import CacheGeneration
+
+logger = logging.getLogger(__name__)
+
+HITS_KEY = 'response-cache:hits'
+MISSES_KEY = 'response-cache:misses'
+
+
+def generation(user_id):
+    """``(generation, updated_at)`` of the user, ``(0, None)`` before the first bump."""
+    row = (
+        CacheGeneration.objects
+        .filter(user_id=user_id)
+        .values_list('generation', 'updated_at')
+        .first()
+    )
+    return row or (0, None)
+
+
+def annotate_generation(queryset):
+    """Annotate a queryset of the user's rows with ``cache_generation`` and
+    ``cache_updated_at``, to read them in the same query."""
+    generations = CacheGeneration.objects.filter(user_id=OuterRef('user_id'))
+    return queryset.annotate(
+        cache_generation=Subquery(generations.values('generation')[:1]),
+        cache_updated_at=Subquery(generations.values('updated_at')[:1]),
+    )
+
+
+def bump_generation(user_ids):
+    """Invalidate the cached responses of the given users once the current
+    transaction commits."""
+    user_ids = set(u for u in user_ids if u is not None)
+    if user_ids:
+        transaction.on_commit(lambda: _bump(user_ids))
+
+
+def _bump(user_ids):
+    CacheGeneration.objects.bulk_create(
+        [CacheGeneration(user_id=user_id) for user_id in user_ids],
+        ignore_conflicts=True
+    )
+    CacheGeneration.objects.filter(user_id__in=user_ids).update(
+        generation=F('generation') + 1,
+        updated_at=timezone.now()
+    )
+    logger.debug(f"Bumped cache generation of users {sorted(user_ids)}")
+
+
+def record(hit):
+    """Count a cache hit or miss."""
+    key = HITS_KEY if hit else MISSES_KEY
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, timeout=None)
+        cache.incr(key)
+
+
+def counters():
+    """Hit and miss counts since the cache was last cleared."""
+    values = cache.get_many([HITS_KEY, MISSES_KEY])
+    hits = values.get(HITS_KEY, 0)
+    misses = values.get(MISSES_KEY, 0)
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / total, 4) if total else None,
+    }
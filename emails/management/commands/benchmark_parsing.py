@@ -0,0 +1,143 @@
+from django.core.management.base import BaseCommand, CommandError
+from emails.messages import build_mail_message
+from emails.parsing import message_fields
+from emails.threads import parse_message_ids
+import chardet
+import html
+import os
+import statistics
+import time
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'testdata', 'eml')
+
+# Fields compared between the two runs, the others come from imap_tools
+DECODED_FIELDS = ['subject', 'body_text', 'body_html']
+
+
+def legacy_clean_text(text):
+    """The sync's text cleanup before the parse stage, for the "before" run."""
+    if not text:
+        return ""
+    if isinstance(text, bytes):
+        detected = chardet.detect(text)
+        try:
+            text = text.decode(detected['encoding'] or 'utf-8', errors='replace')
+        except Exception:
+            text = text.decode('utf-8', errors='replace')
+    text = html.unescape(text)
+    return text.replace('\x00', '').replace('\r', '\n')
+
+
+def legacy_fields(msg):
+    """Email field values as the sync built them before the parse stage."""
+    headers = {}
+    for header in msg.obj.items():
+        headers[header[0].lower()] = header[1]
+    rfc_message_id = (parse_message_ids(headers.get('message-id', '')) or [''])[0]
+    references = parse_message_ids(headers.get('references', ''))
+    in_reply_to = (parse_message_ids(headers.get('in-reply-to', '')) or [''])[0]
+    return {
+        'rfc_message_id': rfc_message_id[:255],
+        'subject': legacy_clean_text(msg.subject) or '(No Subject)',
+        'sender': str(msg.from_) or 'unknown',
+        'recipient': str(msg.to) or 'unknown',
+        'date': msg.date,
+        'body_text': legacy_clean_text(msg.text),
+        'body_html': legacy_clean_text(msg.html),
+        'in_reply_to': in_reply_to[:255],
+        'references': ' '.join(references),
+        'thread_id': (references or [in_reply_to or rfc_message_id])[0][:255],
+        'size': msg.size_rfc822,
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        'Time the MIME parsing and decoding of the sync on a corpus of .eml '
+        'files and report messages per second'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--corpus',
+            default=CORPUS_DIR,
+            help='Directory of .eml files (default: the bundled emails/testdata/eml)',
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=5,
+            help='Timed passes over the corpus, the median is reported',
+        )
+        parser.add_argument(
+            '--min-messages',
+            type=int,
+            default=500,
+            help='Messages parsed per pass, the corpus is cycled to reach it',
+        )
+        parser.add_argument(
+            '--compare',
+            action='store_true',
+            help='Also time the previous decoding (imap_tools bodies, chardet '
+                 'and unescaping of every text) and list messages decoded differently',
+        )
+
+    def handle(self, *args, **options):
+        corpus = self.load(options['corpus'])
+        passes = max(1, -(-options['min_messages'] // len(corpus)))
+        messages = [raw for _, raw in corpus] * passes
+        total_bytes = sum(len(raw) for raw in messages)
+        self.stdout.write(
+            f"{len(corpus)} messages in corpus, {len(messages)} parsed per pass "
+            f"({total_bytes / 1024 / 1024:.1f} MB)"
+        )
+
+        results = {}
+        if options['compare']:
+            results['before'] = self.run(messages, legacy_fields, options['repeat'])
+        results['after'] = self.run(messages, message_fields, options['repeat'])
+
+        self.stdout.write(f"\n{'run':<8} {'msg/s':>10} {'MB/s':>8}")
+        for name, seconds in results.items():
+            self.stdout.write(
+                f"{name:<8} {len(messages) / seconds:>10.0f} "
+                f"{total_bytes / 1024 / 1024 / seconds:>8.1f}"
+            )
+        if options['compare']:
+            self.stdout.write(self.style.SUCCESS(
+                f"Speedup: {results['before'] / results['after']:.2f}x"
+            ))
+            self.report_differences(corpus)
+
+    def load(self, directory):
+        if not os.path.isdir(directory):
+            raise CommandError(f"Corpus directory {directory} does not exist")
+        corpus = []
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.eml'):
+                with open(os.path.join(directory, name), 'rb') as f:
+                    corpus.append((name, f.read()))
+        if not corpus:
+            raise CommandError(f"No .eml files in {directory}")
+        return corpus
+
+    def run(self, messages, parse, repeat):
+        """Median seconds to build and decode every message."""
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            for uid, raw in enumerate(messages, 1):
+                parse(build_mail_message(uid, [], len(raw), raw))
+            timings.append(time.perf_counter() - started)
+        return statistics.median(timings)
+
+    def report_differences(self, corpus):
+        differing = []
+        for name, raw in corpus:
+            before = legacy_fields(build_mail_message(1, [], len(raw), raw))
+            after = message_fields(build_mail_message(1, [], len(raw), raw))
+            if any(before[field] != after[field] for field in DECODED_FIELDS):
+                differing.append(name)
+        self.stdout.write(f"Decoded differently: {len(differing)} of {len(corpus)} messages")
+        for name in differing:
+            self.stdout.write(f"  {name}")
@@ -0,0 +1,263 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import Count, Index, Q
+from django.utils import timezone
+from emails.models import IMAPServer, Blob, Email, EmailBody, Thread
+from emails.threads import SUMMARY_FIELDS, annotate_thread_count, save_threads, summarize_threads
+import datetime
+import random
+import statistics
+import time
+
+BENCHMARK_USER = 'benchmark'
+FOLDERS = ['INBOX', 'Sent', 'Archive', 'Drafts', 'Spam', 'Trash', 'Work', 'Lists']
+BODY = 'Synthetic body ' * 20
+
+# Indexes of Email before composite indexes were added, restored for the
+# "before" run
+BEFORE_INDEXES = [
+    Index(fields=['subject'], name='emails_emai_subject_35730d_idx'),
+]
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        'Time the email list, filter, threads and statistics queries on a '
+        'synthetic dataset and show their EXPLAIN plans'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rows',
+            type=int,
+            default=1000000,
+            help='Number of synthetic emails (default: 1000000)',
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=5,
+            help='Runs of each query, the median is reported',
+        )
+        parser.add_argument(
+            '--compare',
+            action='store_true',
+            help='Also run every query with the composite indexes dropped, '
+                 'inside a transaction that is rolled back',
+        )
+        parser.add_argument(
+            '--keep',
+            action='store_true',
+            help='Keep the synthetic dataset for later runs',
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor not in ('sqlite', 'postgresql'):
+            raise CommandError('The benchmark needs transactional DDL (SQLite or PostgreSQL)')
+
+        user, server = self.dataset(options['rows'])
+        try:
+            queries = self.queries(user, server)
+            if options['compare']:
+                before = self.run_without_indexes(queries, options['repeat'])
+            after = self.run(queries, options['repeat'], 'after' if options['compare'] else None)
+
+            if options['compare']:
+                self.stdout.write('\nSummary (median ms)')
+                self.stdout.write(f"{'query':<22} {'before':>10} {'after':>10}")
+                for name in after:
+                    self.stdout.write(f"{name:<22} {before[name]:>10.2f} {after[name]:>10.2f}")
+        finally:
+            if not options['keep']:
+                self.cleanup(user)
+
+    def dataset(self, rows):
+        """Create the benchmark user's emails and threads, unless already there."""
+        user, _ = User.objects.get_or_create(username=BENCHMARK_USER)
+        servers = [
+            IMAPServer.objects.get_or_create(
+                user=user, name=f'Benchmark {i}',
+                defaults={'host': 'imap.example.com', 'username': BENCHMARK_USER, 'password': '-'}
+            )[0]
+            for i in range(2)
+        ]
+        existing = Email.objects.filter(user=user).count()
+        if existing == rows:
+            self.stdout.write(f"Reusing {rows} synthetic emails")
+            return user, servers[0]
+        if existing:
+            self.cleanup(user)
+            return self.dataset(rows)
+
+        self.stdout.write(f"Creating {rows} synthetic emails...")
+        started = time.monotonic()
+        rng = random.Random(0)
+        now = timezone.now()
+        uid = 0
+        batch = []
+        with transaction.atomic():
+            while uid < rows:
+                thread_size = rng.choice([1, 1, 1, 2, 3, 5, 8])
+                thread_id = f'<bench-{uid}@example.com>'
+                date = now - datetime.timedelta(minutes=rng.randrange(5 * 365 * 24 * 60))
+                folder = rng.choice(FOLDERS)
+                server = rng.choice(servers)
+                for i in range(min(thread_size, rows - uid)):
+                    uid += 1
+                    batch.append(Email(
+                        user=user,
+                        imap_server=server,
+                        message_id=str(uid),
+                        rfc_message_id=f'<bench-{uid}@example.com>',
+                        folder=folder,
+                        subject=f'Benchmark subject {uid % 5000}',
+                        sender=f'sender{uid % 300}@example.com',
+                        recipient='benchmark@example.com',
+                        date=date + datetime.timedelta(hours=i),
+                        thread_id=thread_id,
+                        snippet=BODY[:Email.SNIPPET_LENGTH],
+                    ))
+                if len(batch) >= 5000:
+                    self.save_batch(batch)
+                    batch = []
+            self.save_batch(batch)
+
+            rows_iter = (
+                Email.objects.filter(user=user)
+                .order_by('thread_id', 'date', 'id')
+                .values_list(*SUMMARY_FIELDS)
+                .iterator(chunk_size=5000)
+            )
+            threads = []
+            for thread in summarize_threads(user.id, rows_iter):
+                threads.append(thread)
+                if len(threads) >= 5000:
+                    save_threads(threads)
+                    threads = []
+            save_threads(threads)
+        self.analyze()
+        self.stdout.write(f"Created dataset in {time.monotonic() - started:.1f}s")
+        return user, servers[0]
+
+    def save_batch(self, emails):
+        Email.objects.bulk_create(emails)
+        body = Blob.for_content(BODY.encode())
+        Blob.store([body])
+        EmailBody.objects.bulk_create(EmailBody(email=e, text=body) for e in emails)
+
+    def analyze(self):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def queries(self, user, server):
+        """The querysets behind the API and web views, keyed by name."""
+        emails = Email.objects.filter(user=user)
+        middle = emails.order_by('-date', '-id').values_list('date', 'id')[emails.count() // 2]
+        listed = emails.only(*Email.LIST_FIELDS)
+        thread_id = emails.exclude(thread_id='').order_by('-date').values_list('thread_id', flat=True)[0]
+        return {
+            'list': lambda: list(
+                annotate_thread_count(listed).order_by('-date', '-id')[:50]
+            ),
+            'list_deep_page': lambda: list(
+                annotate_thread_count(listed)
+                .filter(Q(date__lte=middle[0]), Q(date__lt=middle[0]) | Q(id__lt=middle[1]))
+                .order_by('-date', '-id')[:50]
+            ),
+            'list_folder': lambda: list(
+                listed.filter(folder='Archive').order_by('-date', '-id')[:50]
+            ),
+            'list_server_folder': lambda: list(
+                listed.filter(imap_server=server, folder='INBOX').order_by('-date', '-id')[:50]
+            ),
+            'thread_members': lambda: list(
+                emails.filter(thread_id=thread_id)
+                .select_related('body__text', 'body__html').order_by('date', 'id')
+            ),
+            'threads': lambda: list(
+                Thread.objects.filter(user=user, root__isnull=False)
+                .select_related('root').order_by('-last_date', '-id')[:50]
+            ),
+            'stats_total': lambda: emails.count(),
+            'stats_threads': lambda: (
+                emails.exclude(thread_id='').values('thread_id').distinct().count()
+            ),
+            'stats_folders': lambda: list(
+                emails.values('folder').annotate(count=Count('id')).order_by('-count')
+            ),
+            'folders': lambda: list(
+                emails.values_list('folder', flat=True).distinct().order_by('folder')
+            ),
+        }
+
+    def run(self, queries, repeat, label=None):
+        """Print the plan and median time of each query, returning the timings."""
+        if label:
+            self.stdout.write(self.style.MIGRATE_HEADING(f"\n=== {label} ==="))
+        timings = {}
+        for name, query in queries.items():
+            samples = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                query()
+                samples.append((time.perf_counter() - started) * 1000)
+            timings[name] = statistics.median(samples)
+            self.stdout.write(self.style.SUCCESS(f"\n{name}: {timings[name]:.2f} ms"))
+            self.stdout.write(self.explain(query))
+        return timings
+
+    def explain(self, query):
+        """EXPLAIN the queries a callable runs."""
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as captured:
+            query()
+        plans = []
+        with connection.cursor() as cursor:
+            for executed in captured.captured_queries:
+                cursor.execute(f"EXPLAIN {'QUERY PLAN ' if connection.vendor == 'sqlite' else ''}{executed['sql']}")
+                rows = cursor.fetchall()
+                plans.extend(
+                    '  ' + (row[-1] if connection.vendor == 'sqlite' else row[0]) for row in rows
+                )
+        return '\n'.join(plans)
+
+    def run_without_indexes(self, queries, repeat):
+        """Run the queries with Email's indexes as they were before the composite ones."""
+        composite = [
+            index for index in Email._meta.indexes
+            if len(index.fields) > 1 and 'rfc_message_id' not in index.fields
+        ]
+        editor = connection.schema_editor()
+        timings = {}
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    for index in composite:
+                        cursor.execute(f'DROP INDEX {connection.ops.quote_name(index.name)}')
+                    for index in BEFORE_INDEXES:
+                        cursor.execute(str(index.create_sql(Email, editor)))
+                self.analyze()
+                timings = self.run(queries, repeat, 'before')
+                raise Rollback()
+        except Rollback:
+            pass
+        return timings
+
+    def cleanup(self, user):
+        """Remove the synthetic dataset."""
+        with transaction.atomic():
+            Thread.objects.filter(user=user).delete()
+            with connection.cursor() as cursor:
+                # Raw delete, the ORM would load every row to cascade
+                cursor.execute(
+                    'DELETE FROM emails_emailbody WHERE email_id IN '
+                    '(SELECT id FROM emails_email WHERE user_id = %s)', [user.id]
+                )
+                cursor.execute('DELETE FROM emails_email WHERE user_id = %s', [user.id])
+            user.delete()
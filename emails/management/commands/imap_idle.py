@@ -0,0 +1,228 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from emails.models import IMAPServer
+from emails.pool import IMAPConnectionPool
+from emails.writer import EmailWriter
+from emails.management.commands.sync_emails import Command as SyncCommand
+import imaplib
+import logging
+import signal
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# rfc2177: re-issue IDLE at least every 29 minutes
+MAX_IDLE_TIMEOUT = 29 * 60
+# Seconds between checks of the stop flag while idling
+IDLE_POLL_SLICE = 5
+
+
+class ServerWatcher(threading.Thread):
+    """Keeps one connection to a server and syncs new mail as it arrives."""
+
+    def __init__(self, command, server_id):
+        super().__init__(name=f'imap-idle-{server_id}', daemon=True)
+        self.command = command
+        self.server_id = server_id
+        self.stop_event = threading.Event()
+        self.failures = 0
+
+    def stopped(self):
+        return self.stop_event.is_set() or self.command.stop_event.is_set()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        pool = self.command.pool
+        while not self.stopped():
+            server = self._load_server()
+            if server is None:
+                return
+            # The server's folder selection applies to watched folders too
+            folders = self.command.sync._filter_folders(server, self.command.folders)
+            if not folders:
+                logger.info(f"No watched folder is synced for server {server.name}")
+                return
+            mailbox = pool.acquire(server, stop_event=self.stop_event)
+            if mailbox is None:
+                continue
+            try:
+                self._watch(server, mailbox, folders)
+                pool.release(server, mailbox)
+            except (imaplib.IMAP4.abort, imaplib.IMAP4.error, OSError) as e:
+                logger.warning(f"Connection to server {server.name} lost: {str(e)}")
+                self._backoff(server, mailbox)
+            except Exception:
+                logger.exception(f"Error watching server {server.name}")
+                self._backoff(server, mailbox)
+            finally:
+                connection.close()
+
+    def _backoff(self, server, mailbox):
+        """Drop the connection and wait longer after each consecutive failure."""
+        self.command.pool.discard(server, mailbox)
+        self.stop_event.wait(self.command.pool.backoff_delay(self.failures))
+        self.failures += 1
+
+    def _load_server(self):
+        try:
+            return IMAPServer.objects.select_related('user').get(pk=self.server_id)
+        except IMAPServer.DoesNotExist:
+            return None
+        finally:
+            connection.close()
+
+    def _watch(self, server, mailbox, folders):
+        """Sync, then wait for new mail in the folders until the next full
+        pass is due."""
+        sync = self.command.sync
+        options = self.command.options
+        supports_idle = 'IDLE' in mailbox.client.capabilities
+
+        while not self.stopped():
+            stats = sync.sync_server(server, mailbox=mailbox)
+            self.failures = 0
+            logger.info(
+                f"Synced server {server.name}: "
+                f"{stats['inserted']} new, {stats['updated']} updated"
+            )
+            next_full_pass = time.monotonic() + options['full_interval']
+
+            # IDLE reports on the selected folder only: watch the first one,
+            # the others are checked (a cheap UIDNEXT lookup) on every wakeup
+            watched, *others = folders
+            while not self.stopped() and time.monotonic() < next_full_pass:
+                if supports_idle:
+                    changed = self._idle(mailbox, watched, next_full_pass)
+                else:
+                    changed = self._poll(mailbox)
+                if self.stopped():
+                    return
+                if changed:
+                    self._sync_folder(server, mailbox, watched)
+                for folder in others:
+                    self._sync_folder(server, mailbox, folder)
+                connection.close()
+
+    def _idle(self, mailbox, folder, deadline):
+        """IDLE on the folder until mail arrives or the deadline passes."""
+        mailbox.folder.set(folder)
+        idle_until = min(
+            deadline, time.monotonic() + self.command.options['idle_timeout']
+        )
+        mailbox.idle.start()
+        try:
+            while not self.stopped() and time.monotonic() < idle_until:
+                responses = mailbox.idle.poll(timeout=IDLE_POLL_SLICE)
+                if any(b'EXISTS' in r for r in responses):
+                    return True
+            return False
+        finally:
+            mailbox.idle.stop()
+
+    def _poll(self, mailbox):
+        """Fallback for servers without IDLE: wait, then let the sync check UIDNEXT."""
+        self.stop_event.wait(self.command.options['poll_interval'])
+        mailbox.client.noop()
+        return True
+
+    def _sync_folder(self, server, mailbox, folder):
+        writer = EmailWriter(batch_size=self.command.sync.batch_size)
+        self.command.sync._sync_folder(mailbox, server, folder, writer)
+        if writer.inserted:
+            logger.info(f"Synced {writer.inserted} new emails in {server.name}/{folder}")
+
+
+class Command(BaseCommand):
+    help = 'Keep IMAP connections open and sync new mail as soon as it arrives'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user',
+            type=int,
+            help='Watch servers of a specific user ID only',
+        )
+        parser.add_argument(
+            '--folder',
+            action='append',
+            dest='folders',
+            help='Folder to watch for new mail, may be repeated (default INBOX). '
+                 'The first one is watched with IDLE, the others are checked '
+                 'whenever IDLE is re-issued or reports new mail',
+        )
+        parser.add_argument(
+            '--idle-timeout',
+            type=int,
+            default=600,
+            help='Seconds before IDLE is re-issued',
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=int,
+            default=60,
+            help='Seconds between checks on servers without IDLE support',
+        )
+        parser.add_argument(
+            '--full-interval',
+            type=int,
+            default=900,
+            help='Seconds between full incremental passes over all folders',
+        )
+        parser.add_argument(
+            '--refresh-interval',
+            type=int,
+            default=60,
+            help='Seconds between checks for added or removed servers',
+        )
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.options['idle_timeout'] = min(options['idle_timeout'], MAX_IDLE_TIMEOUT)
+        self.folders = options['folders'] or ['INBOX']
+        self.sync = SyncCommand(stdout=self.stdout, stderr=self.stderr)
+        self.pool = IMAPConnectionPool(self.sync._connect)
+        self.stop_event = threading.Event()
+
+        def shutdown(signum, frame):
+            self.stdout.write("Stopping IMAP watchers...")
+            self.stop_event.set()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
+        watchers = {}
+        try:
+            while not self.stop_event.is_set():
+                servers = IMAPServer.objects.all()
+                if options['user']:
+                    servers = servers.filter(user_id=options['user'])
+                # Servers whose folder selection excludes every watched folder
+                # are left alone
+                server_ids = set(
+                    server.id for server in servers
+                    if self.sync._filter_folders(server, self.folders)
+                )
+                connection.close()
+
+                for server_id in server_ids:
+                    watcher = watchers.get(server_id)
+                    if watcher is None or not watcher.is_alive():
+                        watcher = watchers[server_id] = ServerWatcher(self, server_id)
+                        watcher.start()
+                        logger.info(f"Watching IMAP server {server_id}")
+
+                for server_id in set(watchers) - server_ids:
+                    watchers.pop(server_id).stop()
+                    logger.info(f"Stopped watching IMAP server {server_id}")
+
+                self.stop_event.wait(options['refresh_interval'])
+        finally:
+            self.stop_event.set()
+            # Also wakes watchers waiting for a connection or a reconnect
+            for watcher in watchers.values():
+                watcher.stop()
+            for watcher in watchers.values():
+                watcher.join(timeout=IDLE_POLL_SLICE * 2)
+            self.pool.close_all()
@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Sum
+from emails.models import Blob, EmailBody
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def unreferenced_blobs():
+    """Blobs no EmailBody points at, left behind by deleted emails."""
+    blobs = Blob.objects.all()
+    for field in EmailBody.BLOB_FIELDS:
+        blobs = blobs.filter(~Exists(EmailBody.objects.filter(**{field: OuterRef('pk')})))
+    return blobs
+
+
+class Command(BaseCommand):
+    help = 'Delete stored bodies and message sources no email refers to any more'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report how many blobs would be deleted',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of blobs deleted per transaction',
+        )
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            totals = unreferenced_blobs().aggregate(size=Sum('size'))
+            count = unreferenced_blobs().count()
+            self.stdout.write(
+                f"{count} unreferenced blobs ({totals['size'] or 0} bytes uncompressed)"
+            )
+            return
+
+        deleted = 0
+        while True:
+            with transaction.atomic():
+                digests = list(
+                    unreferenced_blobs().values_list('digest', flat=True)[:options['batch_size']]
+                )
+                if not digests:
+                    break
+                # Checked again in the DELETE, a sync may have reused a blob since
+                count, _ = unreferenced_blobs().filter(digest__in=digests).delete()
+            deleted += count
+            logger.debug(f"Deleted {count} unreferenced blobs")
+
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} unreferenced blobs"))
@@ -0,0 +1,80 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.db import transaction
+from emails.cache import bump_generation
+from emails.models import Email
+from emails.search import backend, clear_index, index_emails
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index from stored emails'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user',
+            type=int,
+            help='Rebuild the index of a specific user ID only',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of emails indexed per transaction',
+        )
+
+    def handle(self, *args, **options):
+        if backend() is None:
+            self.stderr.write('The database has no full-text search index, searches use icontains')
+            return
+
+        users = User.objects.all()
+        if options['user']:
+            users = users.filter(id=options['user'])
+            if not users.exists():
+                self.stderr.write(f"User with ID {options['user']} not found")
+                return
+
+        for user in users:
+            started = time.monotonic()
+            try:
+                count = self.rebuild_user(user, options['batch_size'])
+            except Exception as e:
+                self.stderr.write(
+                    self.style.ERROR(f"Error indexing emails of {user.username}: {str(e)}")
+                )
+                logger.exception(f"Error indexing emails of {user.username}")
+                continue
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Indexed {count} emails of {user.username} "
+                    f"in {time.monotonic() - started:.1f}s"
+                )
+            )
+
+    def rebuild_user(self, user, batch_size):
+        """Replace the user's index entries, returning how many emails were indexed."""
+        emails = (
+            Email.objects
+            .filter(user=user)
+            .select_related('body__text')
+            .order_by('id')
+        )
+
+        count = 0
+        with transaction.atomic():
+            clear_index(user.id)
+            batch = []
+            for email_obj in emails.iterator(chunk_size=batch_size):
+                batch.append(email_obj)
+                if len(batch) >= batch_size:
+                    index_emails(batch)
+                    count += len(batch)
+                    batch = []
+            index_emails(batch)
+            count += len(batch)
+            bump_generation([user.id])
+        return count
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from emails.stats import rebuild_stats
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Recompute the mailbox statistics from stored emails'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user',
+            type=int,
+            help='Rebuild statistics of a specific user ID only',
+        )
+
+    def handle(self, *args, **options):
+        users = User.objects.all()
+        if options['user']:
+            users = users.filter(id=options['user'])
+            if not users.exists():
+                self.stderr.write(f"User with ID {options['user']} not found")
+                return
+
+        for user in users:
+            try:
+                count = rebuild_stats(user)
+            except Exception as e:
+                self.stderr.write(
+                    self.style.ERROR(f"Error rebuilding statistics of {user.username}: {str(e)}")
+                )
+                logger.exception(f"Error rebuilding statistics of {user.username}")
+                continue
+            self.stdout.write(
+                self.style.SUCCESS(f"Rebuilt statistics of {count} folders of {user.username}")
+            )
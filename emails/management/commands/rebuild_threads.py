@@ -0,0 +1,111 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.db import transaction
+from emails.cache import bump_generation
+from emails.models import Email, Thread
+from emails.threads import (
+    SUMMARY_FIELDS, ThreadResolver, ancestors, save_threads, summarize_threads,
+    thread_key
+)
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the Thread table from stored emails'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user',
+            type=int,
+            help='Rebuild threads of a specific user ID only',
+        )
+        parser.add_argument(
+            '--rethread',
+            action='store_true',
+            help='Recompute the thread of every email from its Message-ID, '
+                 'References and In-Reply-To headers first',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of threads written per query',
+        )
+
+    def handle(self, *args, **options):
+        users = User.objects.all()
+        if options['user']:
+            users = users.filter(id=options['user'])
+            if not users.exists():
+                self.stderr.write(f"User with ID {options['user']} not found")
+                return
+
+        for user in users:
+            started = time.monotonic()
+            try:
+                if options['rethread']:
+                    moved = self.rethread_user(user, options['batch_size'])
+                    self.stdout.write(f"Moved {moved} emails of {user.username} to another thread")
+                count = self.rebuild_user(user, options['batch_size'])
+            except Exception as e:
+                self.stderr.write(
+                    self.style.ERROR(f"Error rebuilding threads of {user.username}: {str(e)}")
+                )
+                logger.exception(f"Error rebuilding threads of {user.username}")
+                continue
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Rebuilt {count} threads of {user.username} "
+                    f"in {time.monotonic() - started:.1f}s"
+                )
+            )
+
+    def rethread_user(self, user, batch_size):
+        """Reassign thread ids of all the user's emails, returning how many changed."""
+        emails = list(
+            Email.objects
+            .filter(user=user)
+            .only('id', 'imap_server_id', 'message_id', 'folder', 'rfc_message_id',
+                  'in_reply_to', 'references', 'thread_id')
+        )
+        resolver = ThreadResolver()
+        for email_obj in emails:
+            resolver.add(thread_key(email_obj), ancestors(email_obj))
+
+        changed = []
+        for email_obj in emails:
+            thread_id = resolver.root(thread_key(email_obj))
+            if email_obj.thread_id != thread_id:
+                email_obj.thread_id = thread_id
+                changed.append(email_obj)
+        Email.objects.bulk_update(changed, ['thread_id'], batch_size=batch_size)
+        return len(changed)
+
+    def rebuild_user(self, user, batch_size):
+        """Replace the user's threads with ones computed in a single pass over their emails."""
+        rows = (
+            Email.objects
+            .filter(user=user)
+            .exclude(thread_id='')
+            .exclude(thread_id__isnull=True)
+            .order_by('thread_id', 'date', 'id')
+            .values_list(*SUMMARY_FIELDS)
+        )
+
+        count = 0
+        with transaction.atomic():
+            Thread.objects.filter(user=user).delete()
+            batch = []
+            for thread in summarize_threads(user.id, rows.iterator(chunk_size=2000)):
+                batch.append(thread)
+                if len(batch) >= batch_size:
+                    save_threads(batch)
+                    count += len(batch)
+                    batch = []
+            save_threads(batch)
+            count += len(batch)
+            bump_generation([user.id])
+        return count
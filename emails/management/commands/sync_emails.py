@@ -1,34 +1,154 @@
+from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import connection, transaction
 from django.utils import timezone
-from emails.models import IMAPServer, Email
+from emails.models import IMAPServer, Attachment, Email, FolderSyncState
+from emails.attachments import save_attachments
+from emails.messages import RawMailMessage, TransferDecoder
+from emails.parsing import parse_message
+from emails.pipeline import ParsePipeline, create_executor
+from emails.writer import EmailWriter
+from emails.threads import delete_emails
+from emails.search import index_emails
+from emails.stats import StatsDelta, is_unread, record_sync
+from emails.cache import bump_generation
+from emails.aioimap import FETCH_FLAGS_RE, FETCH_UID_RE
 from django.contrib.auth.models import User
-import imaplib
-import email
-from email.header import decode_header
 import datetime
 import logging
-import re
-from email.utils import parsedate_to_datetime, getaddresses, make_msgid
-import hashlib
-from imap_tools import MailBox, AND, MailBoxUnencrypted, MailMessage, A
-import html
-import chardet
+from imap_tools import MailBox, MailBoxUnencrypted, A, U
 import socket
 import ssl
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 logger = logging.getLogger(__name__)
 
+# Messages per FETCH command when downloading headers or bodies in bulk
+FETCH_BULK_SIZE = 100
+
+# UIDs per query when updating or deleting reconciled emails
+RECONCILE_CHUNK_SIZE = 500
+
+# Usually the largest folders, scheduled first when their size is unknown
+LARGE_FOLDERS = ['inbox', 'sent', '[gmail]/all mail', '[gmail]/sent mail']
+
+
+class SyncProgress:
+    """Counts synced folders and stored messages of one server sync.
+
+    ``callback`` is called with ``(folders_done, folders_total,
+    messages_processed)`` after every folder and every chunk the writers
+    stored, so a long folder keeps reporting. Folder workers of a parallel
+    sync share one instance.
+    """
+
+    def __init__(self, callback, folders_total):
+        self.callback = callback
+        self.folders_total = folders_total
+        self.folders_done = 0
+        self.messages = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._report()
+
+    def folder_done(self):
+        with self._lock:
+            self.folders_done += 1
+        self._report()
+
+    def stored(self, messages):
+        """``EmailWriter`` ``on_flush`` callback."""
+        with self._lock:
+            self.messages += messages
+        self._report()
+
+    def _report(self):
+        if self.callback is None:
+            return
+        try:
+            self.callback(self.folders_done, self.folders_total, self.messages)
+        except Exception as e:
+            logger.error(f"Error reporting sync progress: {str(e)}")
+
+
 class Command(BaseCommand):
     help = 'Synchronize emails from configured IMAP servers'
 
+    # Emails per bulk upsert, None uses settings.EMAIL_SYNC_BATCH_SIZE
+    batch_size = None
+    # Process pool parsing fetched messages, None parses them inline
+    parse_executor = None
+    # Fetched messages waiting to be parsed and stored
+    queue_size = 1000
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.per_host = getattr(settings, 'EMAIL_SYNC_MAX_PER_HOST', 2)
+        self._host_slots = defaultdict(
+            lambda: threading.BoundedSemaphore(max(1, self.per_host))
+        )
+        self._host_slots_lock = threading.Lock()
+
     def add_arguments(self, parser):
         parser.add_argument(
             '--user',
             type=int,
             help='Sync emails for specific user ID',
         )
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Ignore stored UID positions and resync every folder',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            help='Number of emails written per database transaction',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=getattr(settings, 'EMAIL_SYNC_WORKERS', 1),
+            help='Number of servers synced concurrently',
+        )
+        parser.add_argument(
+            '--per-host',
+            type=int,
+            default=getattr(settings, 'EMAIL_SYNC_MAX_PER_HOST', 2),
+            help='Maximum concurrent connections to the same IMAP host',
+        )
+        parser.add_argument(
+            '--engine',
+            choices=['threads', 'async'],
+            default='threads',
+            help='Sync with a thread per server, or with one asyncio event loop '
+                 'where --workers is the number of accounts synced at once',
+        )
+        parser.add_argument(
+            '--queue-size',
+            type=int,
+            default=1000,
+            help='Fetched messages buffered before storing',
+        )
+        parser.add_argument(
+            '--parse-workers',
+            type=int,
+            default=getattr(settings, 'EMAIL_SYNC_PARSE_WORKERS', 0),
+            help='Processes parsing fetched messages, 0 parses them in the '
+                 'thread reading from the server',
+        )
 
     def handle(self, *args, **options):
+        self.batch_size = options['batch_size']
+        self.per_host = options['per_host']
+        self.queue_size = options['queue_size']
+        if options['parse_workers'] > 0:
+            self.parse_executor = create_executor(options['parse_workers'])
         try:
             if options['user']:
                 users = User.objects.filter(id=options['user'])
@@ -38,108 +158,393 @@ class Command(BaseCommand):
             else:
                 users = User.objects.all()
 
-            for user in users:
-                self.stdout.write(f"Processing servers for user: {user.username}")
-                servers = IMAPServer.objects.filter(user=user)
-                
-                for server in servers:
-                    try:
-                        self.sync_server(server)
-                        self.stdout.write(
-                            self.style.SUCCESS(
-                                f"Successfully synced server: {server.name}"
-                            )
-                        )
-                    except Exception as e:
-                        self.stderr.write(
-                            self.style.ERROR(
-                                f"Error syncing server {server.name}: {str(e)}"
-                            )
-                        )
-                        logger.exception(f"Error syncing server {server.name}")
+            servers = list(
+                IMAPServer.objects
+                .filter(user__in=users)
+                .select_related('user')
+                .order_by('user_id', 'name')
+            )
+            workers = max(1, options['workers'])
+
+            started = time.monotonic()
+            if options['engine'] == 'async':
+                from emails.aiosync import AsyncSyncEngine
+                self.stdout.write(
+                    f"Syncing {len(servers)} servers with the async engine, "
+                    f"{workers} at a time"
+                )
+                engine = AsyncSyncEngine(
+                    self,
+                    concurrency=workers,
+                    per_host=self.per_host,
+                    queue_size=options['queue_size'],
+                    full=options['full'],
+                )
+                results = engine.run(servers)
+            elif workers == 1:
+                results = [
+                    self._sync_server_timed(server, options['full'])
+                    for server in servers
+                ]
+            else:
+                self.stdout.write(
+                    f"Syncing {len(servers)} servers with {workers} workers"
+                )
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = [
+                        executor.submit(self._sync_server_timed, server, options['full'])
+                        for server in servers
+                    ]
+                    results = [future.result() for future in as_completed(futures)]
+
+            self._write_summary(results, time.monotonic() - started)
 
         except Exception as e:
             self.stderr.write(self.style.ERROR(f"Sync failed: {str(e)}"))
             logger.exception("Email sync failed")
+        finally:
+            if self.parse_executor is not None:
+                self.parse_executor.shutdown()
+                self.parse_executor = None
+
+    def _host_slot(self, host):
+        """Semaphore limiting concurrent connections to one IMAP host."""
+        with self._host_slots_lock:
+            return self._host_slots[host.lower()]
 
-    def sync_server(self, server):
-        """Sync emails from a specific IMAP server."""
+    def _sync_server_timed(self, server, full=False):
+        """Sync one server, returning its duration, counts and error."""
+        result = {'server': server, 'inserted': 0, 'updated': 0, 'error': None}
+        started = time.monotonic()
         try:
-            # Choose appropriate connection class
-            MailBoxClass = MailBox if server.use_ssl else MailBoxUnencrypted
-            
-            # Set timeout for operations
-            socket.setdefaulttimeout(300)  # 5 minutes timeout
-            
-            # Connect with error handling
-            try:
-                mailbox = MailBoxClass(server.host, port=server.port)
-                mailbox.login(server.username, server.password)
-                logger.debug(f"Successfully connected to server {server.name}")
-            except ssl.SSLError as e:
-                raise Exception(f"SSL connection failed: {str(e)}")
-            except socket.timeout:
-                raise Exception("Connection timed out")
-            except socket.gaierror:
-                raise Exception(f"Could not resolve hostname: {server.host}")
-            except Exception as e:
-                raise Exception(f"Connection failed: {str(e)}")
+            with self._host_slot(server.host):
+                result.update(self.sync_server(server, full=full))
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Successfully synced server: {server.name} "
+                    f"({result['inserted']} new, {result['updated']} updated)"
+                )
+            )
+        except Exception as e:
+            result['error'] = str(e)
+            self.stderr.write(
+                self.style.ERROR(
+                    f"Error syncing server {server.name}: {str(e)}"
+                )
+            )
+            logger.exception(f"Error syncing server {server.name}")
+        finally:
+            result['duration'] = time.monotonic() - started
+            if threading.current_thread() is not threading.main_thread():
+                # Worker threads get their own database connection
+                connection.close()
+        return result
+
+    def _write_summary(self, results, elapsed):
+        """Print per-server duration and message counts, slowest first."""
+        if not results:
+            self.stdout.write("No servers to sync")
+            return
+        self.stdout.write("Sync summary:")
+        for result in sorted(results, key=lambda r: r['duration'], reverse=True):
+            server = result['server']
+            status = f"error: {result['error']}" if result['error'] else 'ok'
+            self.stdout.write(
+                f"  {server.user.username}/{server.name} ({server.host}): "
+                f"{result['duration']:.1f}s, {result['inserted']} new, "
+                f"{result['updated']} updated, {status}"
+            )
+        failed = sum(1 for r in results if r['error'])
+        self.stdout.write(
+            f"Synced {len(results) - failed}/{len(results)} servers in {elapsed:.1f}s"
+        )
+
+    def sync_server(self, server, full=False, mailbox=None, progress=None):
+        """Sync emails from a specific IMAP server.
+
+        Only messages with a UID above the stored per-folder position are
+        fetched, unless ``full`` is set or the folder's UIDVALIDITY changed.
+        Returns the number of inserted and updated emails.
+
+        With ``server.max_connections`` above one, folders are spread over
+        that many connections and synced in parallel, largest first.
+        An already logged in ``mailbox`` is used, and left open, if given.
+        ``progress`` is an optional callback, see ``SyncProgress``.
+        """
+        own_connection = mailbox is None
+        try:
+            if own_connection:
+                mailbox = self._connect(server)
 
             try:
                 # Get list of folders
                 folders_to_sync = self._get_folders_to_sync(mailbox, server)
                 logger.debug(f"Folders to sync: {folders_to_sync}")
-                
-                for folder in folders_to_sync:
-                    try:
-                        self._sync_folder(mailbox, server, folder)
-                    except Exception as e:
-                        logger.error(f"Error syncing folder {folder}: {str(e)}")
-                        continue
+                tracker = SyncProgress(progress, len(folders_to_sync))
+                tracker.start()
+
+                connections = min(server.max_connections, len(folders_to_sync))
+                if connections > 1:
+                    folders_to_sync = self._order_folders_by_size(mailbox, folders_to_sync)
+                    stats = self._sync_folders_parallel(
+                        mailbox, server, folders_to_sync, connections, full, tracker
+                    )
+                else:
+                    writer = EmailWriter(batch_size=self.batch_size, on_flush=tracker.stored)
+                    for folder in folders_to_sync:
+                        try:
+                            self._sync_folder(mailbox, server, folder, writer, full=full)
+                        except Exception as e:
+                            logger.error(f"Error syncing folder {folder}: {str(e)}")
+                        tracker.folder_done()
+                    stats = writer.stats
 
                 # Update last sync time
                 server.last_sync = timezone.now()
                 server.save()
 
+                return stats
+
             finally:
                 # Always try to logout
-                try:
-                    mailbox.logout()
-                except:
-                    pass
+                if own_connection:
+                    try:
+                        mailbox.logout()
+                    except:
+                        pass
 
         except Exception as e:
             logger.error(f"Error connecting to server: {str(e)}")
             raise
 
+    def _order_folders_by_size(self, mailbox, folders):
+        """Sort folders largest first so the longest syncs start earliest."""
+        sizes = {}
+        for folder in folders:
+            try:
+                sizes[folder] = mailbox.folder.status(folder, ['MESSAGES']).get('MESSAGES', 0)
+            except Exception as e:
+                logger.debug(f"Could not get size of folder {folder}: {str(e)}")
+                sizes[folder] = 0
+        return sorted(
+            folders,
+            key=lambda f: (-sizes[f], f.lower() not in LARGE_FOLDERS)
+        )
+
+    def _sync_folders_parallel(self, mailbox, server, folders, connections, full=False,
+                               tracker=None):
+        """Sync folders over several connections to the same server.
+
+        The already open ``mailbox`` is one of the connections. Extra
+        connections are only opened while the per-host limit allows it.
+        """
+        pending = queue.Queue()
+        for folder in folders:
+            pending.put(folder)
+
+        def worker(worker_mailbox):
+            writer = EmailWriter(
+                batch_size=self.batch_size,
+                on_flush=tracker.stored if tracker is not None else None
+            )
+            slot = None
+            try:
+                if worker_mailbox is None:
+                    slot = self._host_slot(server.host)
+                    if not slot.acquire(blocking=False):
+                        slot = None
+                        return writer.stats
+                    worker_mailbox = self._connect(server)
+                while True:
+                    try:
+                        folder = pending.get_nowait()
+                    except queue.Empty:
+                        break
+                    try:
+                        self._sync_folder(worker_mailbox, server, folder, writer, full=full)
+                    except Exception as e:
+                        logger.error(f"Error syncing folder {folder}: {str(e)}")
+                    if tracker is not None:
+                        tracker.folder_done()
+                return writer.stats
+            finally:
+                if worker_mailbox is not mailbox:
+                    if worker_mailbox is not None:
+                        try:
+                            worker_mailbox.logout()
+                        except:
+                            pass
+                    if slot is not None:
+                        slot.release()
+                    connection.close()
+
+        with ThreadPoolExecutor(max_workers=connections - 1) as executor:
+            futures = [executor.submit(worker, None) for _ in range(connections - 1)]
+            # The calling thread works on its own connection meanwhile
+            results = [worker(mailbox)]
+            results.extend(future.result() for future in futures)
+
+        return {
+            'inserted': sum(r['inserted'] for r in results),
+            'updated': sum(r['updated'] for r in results),
+        }
+
+    def _connect(self, server, timeout=None):
+        """Open and log in an IMAP connection to the server."""
+        # Choose appropriate connection class
+        MailBoxClass = MailBox if server.use_ssl else MailBoxUnencrypted
+        
+        # Per-connection timeout, a process-wide default would leak into
+        # every other thread
+        timeout = timeout or getattr(settings, 'EMAIL_SYNC_TIMEOUT', 300)
+        
+        # Connect with error handling
+        try:
+            mailbox = MailBoxClass(server.host, port=server.port, timeout=timeout)
+            # Keep the downloaded source, it is stored with the email
+            mailbox.email_message_class = RawMailMessage
+            mailbox.login(server.username, server.password)
+            logger.debug(f"Successfully connected to server {server.name}")
+        except ssl.SSLError as e:
+            raise Exception(f"SSL connection failed: {str(e)}")
+        except socket.timeout:
+            raise Exception("Connection timed out")
+        except socket.gaierror:
+            raise Exception(f"Could not resolve hostname: {server.host}")
+        except Exception as e:
+            raise Exception(f"Connection failed: {str(e)}")
+        return mailbox
+
+    def fetch_body(self, email_obj, timeout=None):
+        """Download and store the body of an email synced without one.
+
+        ``timeout`` overrides ``EMAIL_SYNC_TIMEOUT`` for the connection.
+        """
+        server = email_obj.imap_server
+        mailbox = self._connect(server, timeout)
+        try:
+            mailbox.folder.set(email_obj.folder, readonly=True)
+            messages = list(mailbox.fetch(
+                uid_list=[email_obj.message_id], mark_seen=False
+            ))
+        finally:
+            try:
+                mailbox.logout()
+            except:
+                pass
+
+        if not messages:
+            raise Exception(
+                f"Message {email_obj.message_id} no longer exists in folder {email_obj.folder}"
+            )
+
+        fetched = self._build_email(messages[0], server, email_obj.folder)
+        email_obj.body_text = fetched.body_text
+        email_obj.body_html = fetched.body_html
+        email_obj.raw_message = fetched.raw_message
+        email_obj.pending_attachments = fetched.pending_attachments
+        email_obj.body_pending = False
+        with transaction.atomic():
+            email_obj.save(update_fields=[
+                'body_text', 'body_html', 'raw_message', 'snippet', 'body_pending', 'updated_at'
+            ])
+            save_attachments([email_obj])
+        index_emails([email_obj])
+        bump_generation([email_obj.user_id])
+        return email_obj
+
+    def stream_attachment(self, attachment, chunk_size=None):
+        """Download an attachment from the server, as an iterator of decoded chunks.
+
+        The part is fetched ``chunk_size`` bytes at a time with partial
+        ``BODY.PEEK[part]<offset.length>`` fetches, so memory use does not
+        grow with its size. The first chunk is fetched before returning,
+        errors reaching the server are raised here. The connection is
+        closed once the iterator is exhausted or closed.
+        """
+        chunk_size = chunk_size or getattr(settings, 'ATTACHMENT_CHUNK_SIZE', 1024 * 1024)
+        email_obj = attachment.email
+        mailbox = self._connect(email_obj.imap_server)
+        try:
+            mailbox.folder.set(email_obj.folder, readonly=True)
+            first = self._fetch_section(mailbox, email_obj.message_id, attachment.part, 0, chunk_size)
+            if first is None:
+                raise Exception(
+                    f"Message {email_obj.message_id} no longer exists in folder {email_obj.folder}"
+                )
+        except Exception:
+            self._logout(mailbox)
+            raise
+        return self._stream_section(mailbox, attachment, first, chunk_size)
+
+    def _stream_section(self, mailbox, attachment, data, chunk_size):
+        uid = attachment.email.message_id
+        decoder = TransferDecoder(attachment.encoding)
+        offset = 0
+        try:
+            while True:
+                decoded = decoder.feed(data)
+                if decoded:
+                    yield decoded
+                if len(data) < chunk_size:
+                    break
+                offset += len(data)
+                data = self._fetch_section(mailbox, uid, attachment.part, offset, chunk_size) or b''
+            decoded = decoder.flush()
+            if decoded:
+                yield decoded
+        finally:
+            self._logout(mailbox)
+
+    def _fetch_section(self, mailbox, uid, section, offset, length):
+        """Bytes of ``BODY[section]<offset.length>`` of a message, None if it is gone."""
+        result = mailbox.client.uid('FETCH', uid, f'(BODY.PEEK[{section}]<{offset}.{length}>)')
+        if result[0] != 'OK':
+            raise Exception(f"Fetching part {section} failed: {result[1]}")
+        for item in result[1]:
+            if isinstance(item, tuple):
+                return item[1]
+        return None
+
+    def _logout(self, mailbox):
+        try:
+            mailbox.logout()
+        except Exception:
+            pass
+
     def _get_folders_to_sync(self, mailbox, server):
         """Get list of folders to sync based on server configuration."""
         try:
-            all_folders = []
-            
             # List all folders
+            folder_names = []
             for folder_info in mailbox.folder.list():
-                folder_name = folder_info.name
-                logger.debug(f"Found folder: {folder_name} with flags: {folder_info.flags}")
-                
-                # Skip trash folder if exclude_trash is True
-                if server.exclude_trash and any(name in folder_name.lower() 
-                    for name in ['trash', '[gmail]/trash', 'kosz', 'spam', 'junk']):
-                    continue
-                all_folders.append(folder_name)
-
-            # If specific folders are configured, use only those
-            configured_folders = server.get_folders_list()
-            if configured_folders:
-                return [f for f in all_folders if f in configured_folders]
-            
-            return all_folders
+                logger.debug(f"Found folder: {folder_info.name} with flags: {folder_info.flags}")
+                folder_names.append(folder_info.name)
+
+            return self._filter_folders(server, folder_names)
         except Exception as e:
             logger.error(f"Error listing folders: {str(e)}")
             raise
 
-    def _sync_folder(self, mailbox, server, folder):
-        """Sync emails from a specific folder."""
+    def _filter_folders(self, server, folder_names):
+        """Apply the server's folder selection to the listed folder names."""
+        all_folders = []
+        for folder_name in folder_names:
+            # Skip trash folder if exclude_trash is True
+            if server.exclude_trash and any(name in folder_name.lower() 
+                for name in ['trash', '[gmail]/trash', 'kosz', 'spam', 'junk']):
+                continue
+            all_folders.append(folder_name)
+
+        # If specific folders are configured, use only those
+        configured_folders = server.get_folders_list()
+        if configured_folders:
+            return [f for f in all_folders if f in configured_folders]
+        
+        return all_folders
+
+    def _sync_folder(self, mailbox, server, folder, writer, full=False):
+        """Sync new emails from a specific folder."""
         try:
             # Try to select folder
             try:
@@ -148,41 +553,281 @@ class Command(BaseCommand):
             except Exception as e:
                 logger.error(f"Could not select folder {folder}: {str(e)}")
                 return
+            highestmodseq = self._selected_modseq(mailbox)
+
+            status = mailbox.folder.status(folder, ['UIDVALIDITY', 'UIDNEXT'])
+            state = self._get_folder_state(
+                server, folder, status.get('UIDVALIDITY'), full
+            )
+
+            # Mirror flag changes and deletions of already synced messages
+            try:
+                self._reconcile_folder(mailbox, server, folder, state, highestmodseq)
+            except Exception as e:
+                logger.error(f"Error reconciling folder {folder}: {str(e)}")
+
+            uidnext = status.get('UIDNEXT')
+            if uidnext and uidnext - 1 <= state.last_uid:
+                logger.debug(f"No new messages in folder {folder}")
+                self._save_folder_state(state)
+                return
 
-            # Build criteria based on sync limits
-            criteria = self._build_search_criteria(server)
+            # Build criteria based on sync limits and the stored UID position
+            criteria = self._build_search_criteria(server, state.last_uid)
             
+            headers_first = server.fetch_mode == 'headers_first'
             try:
-                # Fetch messages with error handling
-                messages = mailbox.fetch(criteria)
-                
-                # Convert to list if we need to limit
-                if server.sync_limit_type == 'last_n':
-                    messages = list(messages)[-server.sync_limit_value:]
+                # Select the messages with a UID SEARCH on the server, then
+                # download only those
+                uids = self._search_uids(mailbox, server, criteria, state.last_uid)
+                if not uids:
+                    logger.debug(f"No matching messages in folder {folder}")
+                    messages = iter(())
+                elif headers_first:
+                    messages = mailbox.fetch(
+                        uid_list=uids, mark_seen=False, headers_only=True,
+                        bulk=FETCH_BULK_SIZE
+                    )
+                else:
+                    messages = mailbox.fetch(
+                        uid_list=uids, mark_seen=False, bulk=FETCH_BULK_SIZE
+                    )
+
+                if headers_first:
+                    messages = self._fetch_bodies(mailbox, server, folder, messages)
+                else:
+                    messages = ((m, False) for m in messages)
                 
-                for msg in messages:
-                    try:
-                        self._process_email(msg, server, folder)
-                    except Exception as e:
-                        logger.error(f"Error processing email in folder {folder}: {str(e)}")
-                        continue
+                # Parsed in worker processes and written by a writer thread
+                # when parse workers are enabled
+                last_uid = state.last_uid
+                with ParsePipeline(self, writer, self.parse_executor, self.queue_size) as pipeline:
+                    for msg, body_pending in messages:
+                        last_uid = max(last_uid, int(msg.uid))
+                        pipeline.add(msg, server, folder, body_pending)
+                    pipeline.drain()
 
             except Exception as e:
                 logger.error(f"Error fetching messages from folder {folder}: {str(e)}")
                 raise
 
+            # Only advance the UID position once the messages are stored
+            writer.flush()
+            state.last_uid = last_uid
+            self._save_folder_state(state)
+
         except Exception as e:
             logger.error(f"Error accessing folder {folder}: {str(e)}")
+            # Not stored, they are fetched again by the next sync
+            writer.clear()
             raise
 
-    def _build_search_criteria(self, server):
-        """Build search criteria based on server sync settings."""
-        if server.sync_limit_type == 'all':
+    def _reconcile_folder(self, mailbox, server, folder, state, highestmodseq=None):
+        """Update flags and remove deleted emails without fetching bodies.
+
+        With CONDSTORE only flags changed since the stored mod-sequence are
+        fetched, and nothing at all if the mod-sequence is unchanged.
+        Otherwise the flags of every synced UID are fetched in one command.
+        """
+        if not state.last_uid:
+            state.highestmodseq = highestmodseq
+            return
+        if highestmodseq and state.highestmodseq == highestmodseq:
+            return
+
+        uid_range = f'1:{state.last_uid}'
+        if highestmodseq and state.highestmodseq:
+            flags = self._fetch_flags(mailbox, uid_range, state.highestmodseq)
+            present = set(int(uid) for uid in mailbox.uids(A(uid=uid_range)))
+        else:
+            flags = self._fetch_flags(mailbox, uid_range)
+            present = set(flags)
+
+        self._apply_reconciliation(server, folder, state.last_uid, flags, present)
+        state.highestmodseq = highestmodseq
+
+    def _selected_modseq(self, mailbox):
+        """HIGHESTMODSEQ sent by a CONDSTORE server when the folder was selected."""
+        values = mailbox.client.untagged_responses.pop('HIGHESTMODSEQ', None)
+        if not values or 'CONDSTORE' not in mailbox.client.capabilities:
             return None
-        
+        try:
+            return int(values[-1])
+        except (TypeError, ValueError):
+            return None
+
+    def _fetch_flags(self, mailbox, uid_range, changedsince=None):
+        """Return ``{uid: flags}`` for the UID range."""
+        items = '(UID FLAGS)'
+        if changedsince:
+            items += f' (CHANGEDSINCE {changedsince})'
+        result = mailbox.client.uid('FETCH', uid_range, items)
+        if result[0] != 'OK':
+            raise Exception(f"Fetching flags failed: {result[1]}")
+
+        flags = {}
+        for line in result[1]:
+            if isinstance(line, tuple):
+                line = line[0]
+            uid_match = FETCH_UID_RE.search(line or b'')
+            flags_match = FETCH_FLAGS_RE.search(line or b'')
+            if uid_match and flags_match:
+                flags[int(uid_match.group(1))] = self._format_flags(
+                    flags_match.group(1).decode().split()
+                )
+        return flags
+
+    def _format_flags(self, flags):
+        return ' '.join(sorted(flags))
+
+    def _apply_reconciliation(self, server, folder, last_uid, flags, present):
+        """Store changed flags and delete emails whose UIDs disappeared.
+
+        ``flags`` maps UIDs to their current flags (possibly only changed
+        ones), ``present`` holds every UID up to ``last_uid`` still on the
+        server.
+        """
+        stored = dict(
+            Email.objects
+            .filter(user_id=server.user_id, imap_server=server, folder=folder)
+            .values_list('message_id', 'flags')
+        )
+
+        changed = defaultdict(list)
+        for uid, value in flags.items():
+            if str(uid) in stored and stored[str(uid)] != value:
+                changed[value].append(str(uid))
+        deleted = [
+            uid for uid in stored
+            if uid.isdigit() and int(uid) <= last_uid and int(uid) not in present
+        ]
+
+        stats = StatsDelta()
+        for value, uids in changed.items():
+            unread = sum(is_unread(value) - is_unread(stored[uid]) for uid in uids)
+            stats.add(server.user_id, server.id, folder, unread=unread)
+
+        emails = Email.objects.filter(user_id=server.user_id, imap_server=server, folder=folder)
+        with transaction.atomic():
+            for value, uids in changed.items():
+                for i in range(0, len(uids), RECONCILE_CHUNK_SIZE):
+                    emails.filter(
+                        message_id__in=uids[i:i + RECONCILE_CHUNK_SIZE]
+                    ).update(flags=value, updated_at=timezone.now())
+            stats.save()
+            for i in range(0, len(deleted), RECONCILE_CHUNK_SIZE):
+                delete_emails(emails.filter(
+                    message_id__in=deleted[i:i + RECONCILE_CHUNK_SIZE]
+                ))
+            if changed:
+                bump_generation([server.user_id])
+
+        flagged = sum(len(uids) for uids in changed.values())
+        if flagged or deleted:
+            logger.info(
+                f"Reconciled folder {folder}: {flagged} flag changes, "
+                f"{len(deleted)} deleted"
+            )
+        return flagged, len(deleted)
+
+    def _search_uids(self, mailbox, server, criteria, last_uid=0):
+        """Return the UIDs matching the criteria that still need syncing.
+
+        For ``last_n`` only the newest N UIDs are kept, so nothing else is
+        ever downloaded.
+        """
+        uids = self._limit_uids(server, mailbox.uids(criteria), last_uid)
+        return [str(uid) for uid in uids]
+
+    def _limit_uids(self, server, uids, last_uid=0):
+        """Sort searched UIDs and apply the ``last_n`` limit."""
+        uids = sorted(int(uid) for uid in uids)
         if server.sync_limit_type == 'last_n':
-            return None  # We'll limit after fetching
-        
+            uids = uids[-server.sync_limit_value:]
+        # "UID n:*" always matches the newest message, even below n
+        return [uid for uid in uids if uid > last_uid]
+
+    def _fetch_bodies(self, mailbox, server, folder, headers):
+        """Download full messages for fetched headers that need a body.
+
+        Yields ``(message, body_pending)`` pairs. Messages already stored with
+        a body are skipped, messages above ``server.max_body_size`` are yielded
+        header-only with ``body_pending`` set.
+        """
+        batch = []
+        for msg in headers:
+            batch.append(msg)
+            if len(batch) >= FETCH_BULK_SIZE:
+                yield from self._fetch_body_batch(mailbox, server, folder, batch)
+                batch = []
+        if batch:
+            yield from self._fetch_body_batch(mailbox, server, folder, batch)
+
+    def _fetch_body_batch(self, mailbox, server, folder, headers):
+        stored = self._stored_bodies(server, folder, [m.uid for m in headers])
+        headers = [m for m in headers if int(m.uid) not in stored]
+
+        wanted = [
+            m.uid for m in headers
+            if not server.max_body_size or m.size_rfc822 <= server.max_body_size
+        ]
+        bodies = {}
+        if wanted:
+            # One FETCH for the batch, imap_tools rejects a bulk size of 1
+            for msg in mailbox.fetch(uid_list=wanted, mark_seen=False, bulk=True):
+                bodies[msg.uid] = msg
+
+        for header in headers:
+            if header.uid in bodies:
+                yield bodies[header.uid], False
+            else:
+                yield header, True
+
+    def _stored_bodies(self, server, folder, uids):
+        """UIDs among ``uids`` already stored with their body."""
+        return set(
+            int(uid) for uid in
+            Email.objects.filter(
+                user_id=server.user_id,
+                imap_server=server,
+                folder=folder,
+                message_id__in=[str(uid) for uid in uids],
+                body_pending=False
+            ).values_list('message_id', flat=True)
+        )
+
+    def _get_folder_state(self, server, folder, uidvalidity, full=False):
+        """Load the folder's sync position, resetting it if it is no longer valid."""
+        state, _ = FolderSyncState.objects.get_or_create(
+            imap_server=server,
+            folder=folder
+        )
+
+        if state.uidvalidity is not None and state.uidvalidity != uidvalidity:
+            # Stored UIDs no longer identify the same messages
+            logger.info(
+                f"UIDVALIDITY of folder {folder} changed "
+                f"({state.uidvalidity} -> {uidvalidity}), resyncing"
+            )
+            delete_emails(Email.objects.filter(user_id=server.user_id, imap_server=server, folder=folder))
+            state.reset(uidvalidity)
+        elif full or state.uidvalidity is None:
+            state.reset(uidvalidity)
+
+        return state
+
+    def _save_folder_state(self, state):
+        """Persist the folder's sync position."""
+        state.last_sync = timezone.now()
+        state.save()
+        record_sync(state.imap_server, state.folder, state.last_sync)
+
+    def _build_search_criteria(self, server, last_uid=0):
+        """Build search criteria based on server sync settings."""
+        params = {}
+        if last_uid:
+            params['uid'] = U(str(last_uid + 1), '*')
+
         # Calculate date for time-based limits
         if server.sync_limit_type == 'days':
             delta = datetime.timedelta(days=server.sync_limit_value)
@@ -191,89 +836,35 @@ class Command(BaseCommand):
         elif server.sync_limit_type == 'months':
             delta = datetime.timedelta(days=server.sync_limit_value * 30)
         else:
-            return None
+            # 'all' and 'last_n' - last_n is applied to the searched UIDs
+            delta = None
 
-        date = (timezone.now() - delta).date()
-        return A(date_gte=date)
+        if delta is not None:
+            params['date_gte'] = (timezone.now() - delta).date()
 
-    def _process_email(self, msg, server, folder):
-        """Process and save email message."""
-        try:
-            # Get message headers
-            headers = {}
-            for header in msg.obj.items():
-                headers[header[0].lower()] = header[1]
-
-            # Get references and in-reply-to from headers
-            references = headers.get('references', '').split()
-            in_reply_to = headers.get('in-reply-to', '')
-
-            # Generate thread ID
-            thread_id = self._generate_thread_id(references, in_reply_to, msg)
-
-            # Clean and decode text
-            subject = self._clean_text(msg.subject)
-            body_text = self._clean_text(msg.text)
-            body_html = self._clean_text(msg.html)
-
-            # Create or update email
-            email_obj, created = Email.objects.update_or_create(
-                message_id=str(msg.uid),
-                user=server.user,
-                imap_server=server,
-                folder=folder,
-                defaults={
-                    'subject': subject or '(No Subject)',
-                    'sender': str(msg.from_) or 'unknown',
-                    'recipient': str(msg.to) or 'unknown',
-                    'date': msg.date or timezone.now(),
-                    'body_text': body_text,
-                    'body_html': body_html,
-                    'in_reply_to': in_reply_to,
-                    'references': ' '.join(references),
-                    'thread_id': thread_id
-                }
-            )
-
-            if created:
-                logger.debug(f"Created new email: {subject} in folder {folder}")
-            else:
-                logger.debug(f"Updated existing email: {subject} in folder {folder}")
+        return A(**params) if params else 'ALL'
 
-        except Exception as e:
-            logger.error(f"Error saving email: {str(e)}")
-            raise
+    def _build_email(self, msg, server, folder, body_pending=False, parsed=None):
+        """Build an unsaved Email from a fetched message.
 
-    def _generate_thread_id(self, references, in_reply_to, msg):
-        """Generate a thread ID based on message references or create a new one."""
-        if references:
-            # Use the first message ID in references as thread ID
-            return references[0]
-        elif in_reply_to:
-            # Use in-reply-to as thread ID
-            return in_reply_to
-        else:
-            # Generate new thread ID based on subject and first few chars of content
-            thread_hash = hashlib.md5(f"{msg.subject}{msg.text[:100]}".encode()).hexdigest()
-            return f"thread-{thread_hash}"
-
-    def _clean_text(self, text):
-        """Clean and decode text, handling various encodings."""
-        if not text:
-            return ""
-        
-        if isinstance(text, bytes):
-            # Detect encoding
-            detected = chardet.detect(text)
-            try:
-                text = text.decode(detected['encoding'] or 'utf-8', errors='replace')
-            except:
-                text = text.decode('utf-8', errors='replace')
-        
-        # Convert HTML entities
-        text = html.unescape(text)
-        
-        # Remove null bytes and other problematic characters
-        text = text.replace('\x00', '').replace('\r', '\n')
-        
-        return text
+        ``parsed`` is the ``parse_message`` result when the message was
+        already parsed by a worker process. ``thread_id`` is only
+        provisional, ``EmailWriter`` resolves it against stored emails when
+        the batch is written.
+        """
+        fields, attachments = parsed or parse_message(msg, body_pending)
+        email_obj = Email(
+            message_id=str(msg.uid),
+            user=server.user,
+            imap_server=server,
+            folder=folder,
+            flags=self._format_flags(msg.flags),
+            # Only the header section was downloaded when the body is pending
+            raw_message=b'' if body_pending else getattr(msg, 'raw', b''),
+            body_pending=body_pending,
+            **fields
+        )
+        email_obj.pending_attachments = (
+            None if attachments is None else [Attachment(**a) for a in attachments]
+        )
+        return email_obj
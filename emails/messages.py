@@ -0,0 +1,98 @@
+"""Fetched messages as the sync parses them."""
+import base64
+import binascii
+import email
+from functools import cached_property
+
+from imap_tools import MailMessage
+
+
+class RawMailMessage(MailMessage):
+    """imap_tools message keeping the bytes it was parsed from.
+
+    ``raw`` is the RFC822 source as downloaded, or only the header section
+    when the message was fetched with ``headers_only``. Set as
+    ``email_message_class`` of a MailBox to get these from ``fetch``.
+
+    The MIME structure is only parsed when ``obj`` is first used, so UID,
+    flags and size can be read, and the bytes handed to a parser process,
+    without parsing in the thread reading from the server.
+    """
+
+    def __init__(self, fetch_data):
+        self.raw, self._raw_uid_data, self._raw_flag_data = (
+            self._get_message_data_parts(fetch_data)
+        )
+
+    @cached_property
+    def obj(self):
+        return email.message_from_bytes(self.raw)
+
+
+def build_mail_message(uid, flags, size, raw):
+    """Wrap raw FETCH data in the imap_tools message the parser expects."""
+    meta = f"{uid} (UID {uid} FLAGS ({' '.join(flags)}) RFC822.SIZE {size} BODY[] {{{len(raw)}}}"
+    return RawMailMessage([(meta.encode(), raw), b')'])
+
+
+def walk_parts(message, number=''):
+    """Yield ``(part_number, part)`` of the leaf parts of a message.
+
+    Parts are numbered like IMAP body sections (``1``, ``2.1``, ...), so a
+    number can be fetched with ``BODY.PEEK[number]``. Attached messages are
+    leaves, their own parts are not listed.
+    """
+    if message.is_multipart() and not (number and message.get_content_type() == 'message/rfc822'):
+        for i, part in enumerate(message.get_payload(), 1):
+            yield from walk_parts(part, f'{number}.{i}' if number else str(i))
+    else:
+        yield number or '1', message
+
+
+def find_part(message, number):
+    """The leaf part with the given IMAP part number, or None."""
+    for part_number, part in walk_parts(message):
+        if part_number == number:
+            return part
+    return None
+
+
+def part_payload(part):
+    """Decoded content of a leaf part, an attached message as its source."""
+    if part.get_content_type() == 'message/rfc822' and part.is_multipart():
+        return part.get_payload(0).as_bytes()
+    return part.get_payload(decode=True) or b''
+
+
+class TransferDecoder:
+    """Incrementally decode a part's Content-Transfer-Encoding.
+
+    ``feed`` takes encoded chunks of any size and returns what can be
+    decoded so far, ``flush`` the rest. Unknown encodings pass through.
+    """
+
+    def __init__(self, encoding):
+        self.encoding = (encoding or '').strip().lower()
+        self._pending = b''
+
+    def feed(self, data):
+        if self.encoding == 'base64':
+            data = self._pending + b''.join(data.split())
+            end = len(data) // 4 * 4
+            self._pending = data[end:]
+            return base64.b64decode(data[:end])
+        if self.encoding == 'quoted-printable':
+            # Decode complete lines only, an escape may span chunks
+            data = self._pending + data
+            end = data.rfind(b'\n') + 1
+            self._pending = data[end:]
+            return binascii.a2b_qp(data[:end])
+        return data
+
+    def flush(self):
+        data, self._pending = self._pending, b''
+        if self.encoding == 'base64':
+            return base64.b64decode(data + b'=' * (-len(data) % 4)) if data else b''
+        if self.encoding == 'quoted-printable':
+            return binascii.a2b_qp(data)
+        return data
@@ -0,0 +1,62 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("emails", "0004_alter_email_message_id_alter_email_unique_together"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FolderSyncState",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("folder", models.CharField(max_length=255, verbose_name="Folder")),
+                (
+                    "uidvalidity",
+                    models.BigIntegerField(
+                        blank=True, null=True, verbose_name="UIDVALIDITY"
+                    ),
+                ),
+                (
+                    "last_uid",
+                    models.BigIntegerField(
+                        default=0,
+                        help_text="Highest message UID already synced from this folder",
+                        verbose_name="Last Seen UID",
+                    ),
+                ),
+                (
+                    "last_sync",
+                    models.DateTimeField(
+                        blank=True, null=True, verbose_name="Last Sync"
+                    ),
+                ),
+                (
+                    "imap_server",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="folder_states",
+                        to="emails.imapserver",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Folder Sync State",
+                "verbose_name_plural": "Folder Sync States",
+                "unique_together": {("imap_server", "folder")},
+            },
+        ),
+    ]
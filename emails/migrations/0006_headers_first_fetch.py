@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("emails", "0005_folder_sync_state"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="email",
+            name="body_pending",
+            field=models.BooleanField(
+                default=False,
+                help_text="Body was not downloaded during sync",
+                verbose_name="Body Pending",
+            ),
+        ),
+        migrations.AddField(
+            model_name="email",
+            name="size",
+            field=models.IntegerField(
+                default=0, help_text="RFC822 size in bytes", verbose_name="Size"
+            ),
+        ),
+        migrations.AddField(
+            model_name="imapserver",
+            name="fetch_mode",
+            field=models.CharField(
+                choices=[
+                    ("full", "Full Messages"),
+                    ("headers_first", "Headers First, Bodies On Demand"),
+                ],
+                default="full",
+                help_text="Headers first downloads bodies only for new messages",
+                max_length=20,
+                verbose_name="Fetch Mode",
+            ),
+        ),
+        migrations.AddField(
+            model_name="imapserver",
+            name="max_body_size",
+            field=models.IntegerField(
+                blank=True,
+                help_text="In headers first mode, bodies of larger messages (in bytes) are downloaded only when the email is opened",
+                null=True,
+                verbose_name="Max Body Size",
+            ),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("emails", "0006_headers_first_fetch"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="imapserver",
+            name="max_connections",
+            field=models.PositiveSmallIntegerField(
+                default=1,
+                help_text="Number of connections used to sync folders in parallel",
+                verbose_name="Max Connections",
+            ),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("emails", "0008_sync_job"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="email",
+            name="flags",
+            field=models.CharField(
+                blank=True,
+                help_text="Space separated IMAP flags, e.g. \\Seen \\Flagged",
+                max_length=255,
+                verbose_name="Flags",
+            ),
+        ),
+        migrations.AddField(
+            model_name="foldersyncstate",
+            name="highestmodseq",
+            field=models.BigIntegerField(
+                blank=True,
+                help_text="CONDSTORE mod-sequence at the last flag reconciliation",
+                null=True,
+                verbose_name="Highest MODSEQ",
+            ),
+        ),
+    ]
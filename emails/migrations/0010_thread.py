@@ -0,0 +1,101 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:32
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("emails", "0009_email_flags"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Thread",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "thread_id",
+                    models.CharField(max_length=255, verbose_name="Thread ID"),
+                ),
+                (
+                    "subject",
+                    models.CharField(
+                        blank=True, max_length=1000, verbose_name="Subject"
+                    ),
+                ),
+                (
+                    "participants",
+                    models.JSONField(
+                        blank=True, default=list, verbose_name="Participants"
+                    ),
+                ),
+                (
+                    "folders",
+                    models.JSONField(blank=True, default=list, verbose_name="Folders"),
+                ),
+                (
+                    "message_count",
+                    models.IntegerField(default=0, verbose_name="Message Count"),
+                ),
+                (
+                    "first_date",
+                    models.DateTimeField(
+                        blank=True, null=True, verbose_name="First Date"
+                    ),
+                ),
+                (
+                    "last_date",
+                    models.DateTimeField(
+                        blank=True, null=True, verbose_name="Last Date"
+                    ),
+                ),
+                (
+                    "updated_at",
+                    models.DateTimeField(auto_now=True, verbose_name="Updated At"),
+                ),
+                (
+                    "root",
+                    models.ForeignKey(
+                        blank=True,
+                        help_text="Earliest email of the thread",
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="+",
+                        to="emails.email",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="threads",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Thread",
+                "verbose_name_plural": "Threads",
+                "ordering": ["-last_date"],
+                "indexes": [
+                    models.Index(
+                        fields=["user", "-last_date"],
+                        name="emails_thre_user_id_e367f9_idx",
+                    )
+                ],
+                "unique_together": {("user", "thread_id")},
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:34
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("emails", "0010_thread"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="email",
+            name="rfc_message_id",
+            field=models.CharField(
+                blank=True,
+                help_text="Message-ID header, used for threading",
+                max_length=255,
+                verbose_name="RFC Message-ID",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="email",
+            index=models.Index(
+                fields=["user", "rfc_message_id"], name="emails_emai_user_id_75da77_idx"
+            ),
+        ),
+    ]
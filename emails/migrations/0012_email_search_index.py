@@ -0,0 +1,61 @@
+from django.db import migrations
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE emails_email_fts USING fts5(
+        subject, sender, recipient, body, user_id UNINDEXED,
+        tokenize = 'unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER emails_email_fts_delete AFTER DELETE ON emails_email BEGIN
+        DELETE FROM emails_email_fts WHERE rowid = old.id;
+    END
+    """,
+]
+
+SQLITE_BACKWARD = [
+    "DROP TRIGGER IF EXISTS emails_email_fts_delete",
+    "DROP TABLE IF EXISTS emails_email_fts",
+]
+
+POSTGRES_FORWARD = [
+    """
+    CREATE TABLE emails_email_search (
+        email_id bigint PRIMARY KEY
+            REFERENCES emails_email (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+        user_id integer NOT NULL,
+        document tsvector NOT NULL
+    )
+    """,
+    "CREATE INDEX emails_email_search_document ON emails_email_search USING GIN (document)",
+    "CREATE INDEX emails_email_search_user_id ON emails_email_search (user_id)",
+]
+
+POSTGRES_BACKWARD = [
+    "DROP TABLE IF EXISTS emails_email_search",
+]
+
+
+def _run(statements):
+    def run(apps, schema_editor):
+        for sql in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(sql)
+
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("emails", "0011_email_rfc_message_id"),
+    ]
+
+    operations = [
+        # The index is filled by the sync writer, run the rebuild_search_index
+        # command once to index emails synced before this migration.
+        migrations.RunPython(
+            _run({"sqlite": SQLITE_FORWARD, "postgresql": POSTGRES_FORWARD}),
+            _run({"sqlite": SQLITE_BACKWARD, "postgresql": POSTGRES_BACKWARD}),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:41
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("emails", "0012_email_search_index"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="thread",
+            name="emails_thre_user_id_e367f9_idx",
+        ),
+        migrations.AddIndex(
+            model_name="email",
+            index=models.Index(
+                fields=["user", "date", "id"], name="emails_emai_user_id_7a1d5e_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="thread",
+            index=models.Index(
+                fields=["user", "last_date", "id"],
+                name="emails_thre_user_id_f5d6b0_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:42
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("emails", "0013_keyset_indexes"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="email",
+            name="emails_emai_subject_35730d_idx",
+        ),
+        migrations.AddIndex(
+            model_name="email",
+            index=models.Index(
+                fields=["user", "folder", "date", "id"],
+                name="emails_emai_user_id_9c029d_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="email",
+            index=models.Index(
+                fields=["user", "imap_server", "folder"],
+                name="emails_emai_user_id_9d2ba2_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="email",
+            index=models.Index(
+                fields=["user", "thread_id", "date"],
+                name="emails_emai_user_id_5a3df0_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,116 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:45
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+
+
+def fill_mailbox_stats(apps, schema_editor):
+    Email = apps.get_model("emails", "Email")
+    FolderSyncState = apps.get_model("emails", "FolderSyncState")
+    IMAPServer = apps.get_model("emails", "IMAPServer")
+    MailboxStats = apps.get_model("emails", "MailboxStats")
+
+    owners = dict(IMAPServer.objects.values_list("id", "user_id"))
+    stats = {}
+    rows = (
+        Email.objects.order_by()
+        .values("imap_server_id", "folder")
+        .annotate(
+            messages=Count("id"),
+            unread=Count("id", filter=~Q(flags__contains="\\Seen")),
+            size=Sum("size"),
+        )
+    )
+    for row in rows:
+        stats[(row["imap_server_id"], row["folder"])] = MailboxStats(
+            user_id=owners[row["imap_server_id"]],
+            imap_server_id=row["imap_server_id"],
+            folder=row["folder"],
+            message_count=row["messages"],
+            unread_count=row["unread"],
+            total_size=row["size"] or 0,
+        )
+    for server_id, folder, last_sync in FolderSyncState.objects.values_list(
+        "imap_server_id", "folder", "last_sync"
+    ):
+        key = (server_id, folder)
+        if key not in stats:
+            stats[key] = MailboxStats(
+                user_id=owners[server_id], imap_server_id=server_id, folder=folder
+            )
+        stats[key].last_sync = last_sync
+    MailboxStats.objects.bulk_create(stats.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("emails", "0014_composite_email_indexes"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MailboxStats",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("folder", models.CharField(max_length=255, verbose_name="Folder")),
+                (
+                    "message_count",
+                    models.IntegerField(default=0, verbose_name="Messages"),
+                ),
+                ("unread_count", models.IntegerField(default=0, verbose_name="Unread")),
+                (
+                    "total_size",
+                    models.BigIntegerField(
+                        default=0,
+                        help_text="Sum of the RFC822 sizes of the messages in bytes",
+                        verbose_name="Total Size",
+                    ),
+                ),
+                (
+                    "last_sync",
+                    models.DateTimeField(
+                        blank=True, null=True, verbose_name="Last Sync"
+                    ),
+                ),
+                (
+                    "updated_at",
+                    models.DateTimeField(auto_now=True, verbose_name="Updated At"),
+                ),
+                (
+                    "imap_server",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="mailbox_stats",
+                        to="emails.imapserver",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="mailbox_stats",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Mailbox Statistics",
+                "verbose_name_plural": "Mailbox Statistics",
+                "ordering": ["imap_server", "folder"],
+                "unique_together": {("imap_server", "folder")},
+            },
+        ),
+        migrations.RunPython(fill_mailbox_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,117 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+SNIPPET_LENGTH = 200
+
+# Rebuilding emails_email on SQLite drops the search index trigger of 0012
+SQLITE_TRIGGER = """
+    CREATE TRIGGER IF NOT EXISTS emails_email_fts_delete AFTER DELETE ON emails_email BEGIN
+        DELETE FROM emails_email_fts WHERE rowid = old.id;
+    END
+"""
+
+
+def create_search_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor == "sqlite":
+        schema_editor.execute(SQLITE_TRIGGER)
+
+
+def copy_bodies(apps, schema_editor):
+    Email = apps.get_model("emails", "Email")
+    EmailBody = apps.get_model("emails", "EmailBody")
+    schema_editor.execute(
+        f"INSERT INTO {EmailBody._meta.db_table} (email_id, text, html, raw_headers) "
+        f"SELECT id, body_text, body_html, raw_headers FROM {Email._meta.db_table}"
+    )
+
+    batch = []
+    for pk, body_text in Email.objects.values_list("id", "body_text").iterator(
+        chunk_size=2000
+    ):
+        snippet = " ".join((body_text or "").split())[:SNIPPET_LENGTH]
+        if snippet:
+            batch.append(Email(id=pk, snippet=snippet))
+        if len(batch) >= 500:
+            Email.objects.bulk_update(batch, ["snippet"])
+            batch = []
+    Email.objects.bulk_update(batch, ["snippet"])
+
+
+def restore_bodies(apps, schema_editor):
+    Email = apps.get_model("emails", "Email")
+    EmailBody = apps.get_model("emails", "EmailBody")
+    bodies = EmailBody.objects.filter(email_id=OuterRef("pk"))
+    Email.objects.update(
+        **{
+            field: Coalesce(Subquery(bodies.values(column)[:1]), Value(""))
+            for field, column in (
+                ("body_text", "text"),
+                ("body_html", "html"),
+                ("raw_headers", "raw_headers"),
+            )
+        }
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("emails", "0016_cache_generation"),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, create_search_trigger),
+        migrations.CreateModel(
+            name="EmailBody",
+            fields=[
+                (
+                    "email",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="body",
+                        serialize=False,
+                        to="emails.email",
+                    ),
+                ),
+                ("text", models.TextField(blank=True, verbose_name="Body Text")),
+                ("html", models.TextField(blank=True, verbose_name="Body HTML")),
+                (
+                    "raw_headers",
+                    models.TextField(blank=True, verbose_name="Raw Headers"),
+                ),
+            ],
+            options={
+                "verbose_name": "Email Body",
+                "verbose_name_plural": "Email Bodies",
+            },
+        ),
+        migrations.AddField(
+            model_name="email",
+            name="snippet",
+            field=models.CharField(
+                blank=True,
+                help_text="Start of the plain text body, shown in email lists",
+                max_length=200,
+                verbose_name="Snippet",
+            ),
+        ),
+        migrations.RunPython(copy_bodies, restore_bodies),
+        migrations.RemoveField(
+            model_name="email",
+            name="body_html",
+        ),
+        migrations.RemoveField(
+            model_name="email",
+            name="body_text",
+        ),
+        migrations.RemoveField(
+            model_name="email",
+            name="raw_headers",
+        ),
+        migrations.RunPython(create_search_trigger, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,207 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:20
+
+import hashlib
+import zlib
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BLOB_FIELDS = [("text", "text_blob"), ("html", "html_blob")]
+
+
+# Copies of the emails.blobs helpers as they were when this migration was
+# written, so it does not change with that module. Bodies are packed with
+# zlib, always available, and read back whatever their codec.
+def content_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def compress(data):
+    packed = zlib.compress(data, 6)
+    if len(packed) >= len(data):
+        return "none", data
+    return "zlib", packed
+
+
+def decompress(codec, data):
+    data = bytes(data)
+    if codec == "none":
+        return data
+    if codec == "zlib":
+        return zlib.decompress(data)
+    if codec == "zstd" and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise Exception(f"Can not decompress blob with codec {codec}")
+
+
+def pack_bodies(apps, schema_editor):
+    Blob = apps.get_model("emails", "Blob")
+    EmailBody = apps.get_model("emails", "EmailBody")
+
+    def flush(bodies, blobs):
+        stored = set(
+            Blob.objects.filter(digest__in=list(blobs)).values_list("digest", flat=True)
+        )
+        new = []
+        for digest, data in blobs.items():
+            if digest not in stored:
+                codec, packed = compress(data)
+                new.append(
+                    Blob(digest=digest, codec=codec, size=len(data), data=packed)
+                )
+        Blob.objects.bulk_create(new, ignore_conflicts=True)
+        EmailBody.objects.bulk_update(bodies, [blob for _, blob in BLOB_FIELDS])
+
+    bodies, blobs = [], {}
+    rows = EmailBody.objects.values_list("email_id", "text", "html").iterator(
+        chunk_size=2000
+    )
+    for email_id, text, html in rows:
+        body = EmailBody(email_id=email_id)
+        for (_, blob_field), content in zip(BLOB_FIELDS, (text, html)):
+            if content:
+                data = content.encode("utf-8")
+                digest = content_digest(data)
+                blobs[digest] = data
+                setattr(body, f"{blob_field}_id", digest)
+        bodies.append(body)
+        if len(bodies) >= 500:
+            flush(bodies, blobs)
+            bodies, blobs = [], {}
+    flush(bodies, blobs)
+
+
+def unpack_bodies(apps, schema_editor):
+    EmailBody = apps.get_model("emails", "EmailBody")
+    bodies = EmailBody.objects.select_related("text_blob", "html_blob")
+    batch = []
+    for body in bodies.iterator(chunk_size=500):
+        for column, blob_field in BLOB_FIELDS:
+            blob = getattr(body, blob_field)
+            content = decompress(blob.codec, blob.data).decode("utf-8") if blob else ""
+            setattr(body, column, content)
+        batch.append(body)
+        if len(batch) >= 500:
+            EmailBody.objects.bulk_update(batch, [column for column, _ in BLOB_FIELDS])
+            batch = []
+    EmailBody.objects.bulk_update(batch, [column for column, _ in BLOB_FIELDS])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("emails", "0017_email_body"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Blob",
+            fields=[
+                (
+                    "digest",
+                    models.CharField(
+                        help_text="SHA-256 of the uncompressed content",
+                        max_length=64,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="Digest",
+                    ),
+                ),
+                (
+                    "codec",
+                    models.CharField(
+                        choices=[
+                            ("none", "Uncompressed"),
+                            ("zlib", "zlib"),
+                            ("zstd", "Zstandard"),
+                        ],
+                        default="none",
+                        max_length=10,
+                        verbose_name="Codec",
+                    ),
+                ),
+                (
+                    "size",
+                    models.IntegerField(
+                        help_text="Uncompressed size in bytes", verbose_name="Size"
+                    ),
+                ),
+                ("data", models.BinaryField(verbose_name="Data")),
+                (
+                    "created_at",
+                    models.DateTimeField(auto_now_add=True, verbose_name="Created At"),
+                ),
+            ],
+            options={
+                "verbose_name": "Blob",
+                "verbose_name_plural": "Blobs",
+            },
+        ),
+        migrations.AddField(
+            model_name="emailbody",
+            name="text_blob",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="+",
+                to="emails.blob",
+                verbose_name="Body Text",
+            ),
+        ),
+        migrations.AddField(
+            model_name="emailbody",
+            name="html_blob",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="+",
+                to="emails.blob",
+                verbose_name="Body HTML",
+            ),
+        ),
+        migrations.AddField(
+            model_name="emailbody",
+            name="raw",
+            field=models.ForeignKey(
+                blank=True,
+                help_text="Message as downloaded, empty while the body is pending",
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="+",
+                to="emails.blob",
+                verbose_name="RFC822 Source",
+            ),
+        ),
+        # Emails synced before this migration have no RFC822 source, it is
+        # stored the next time their body is downloaded
+        migrations.RunPython(pack_bodies, unpack_bodies),
+        migrations.RemoveField(
+            model_name="emailbody",
+            name="text",
+        ),
+        migrations.RemoveField(
+            model_name="emailbody",
+            name="html",
+        ),
+        migrations.RemoveField(
+            model_name="emailbody",
+            name="raw_headers",
+        ),
+        migrations.RenameField(
+            model_name="emailbody",
+            old_name="text_blob",
+            new_name="text",
+        ),
+        migrations.RenameField(
+            model_name="emailbody",
+            old_name="html_blob",
+            new_name="html",
+        ),
+    ]
@@ -0,0 +1,90 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:31
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("emails", "0018_blob_store"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Attachment",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "index",
+                    models.IntegerField(
+                        help_text="Position among the attachments of the email",
+                        verbose_name="Index",
+                    ),
+                ),
+                (
+                    "part",
+                    models.CharField(
+                        help_text="IMAP body section of the attachment, e.g. 2 or 1.3",
+                        max_length=50,
+                        verbose_name="Part Number",
+                    ),
+                ),
+                (
+                    "filename",
+                    models.CharField(
+                        blank=True, max_length=255, verbose_name="Filename"
+                    ),
+                ),
+                (
+                    "content_type",
+                    models.CharField(max_length=255, verbose_name="Content Type"),
+                ),
+                (
+                    "size",
+                    models.IntegerField(
+                        default=0,
+                        help_text="Decoded size in bytes",
+                        verbose_name="Size",
+                    ),
+                ),
+                (
+                    "content_id",
+                    models.CharField(
+                        blank=True, max_length=255, verbose_name="Content ID"
+                    ),
+                ),
+                (
+                    "encoding",
+                    models.CharField(
+                        blank=True,
+                        help_text="Content-Transfer-Encoding of the part, e.g. base64",
+                        max_length=50,
+                        verbose_name="Transfer Encoding",
+                    ),
+                ),
+                (
+                    "email",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="attachments",
+                        to="emails.email",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Attachment",
+                "verbose_name_plural": "Attachments",
+                "ordering": ["email_id", "index"],
+                "unique_together": {("email", "index")},
+            },
+        ),
+    ]
@@ -1,7 +1,11 @@
+import re
+
 from django.db import models
 from django.conf import settings
 from django.utils.translation import gettext_lazy as _
 
+from .blobs import compress, content_digest, decompress
+
 class IMAPServer(models.Model):
     SYNC_LIMIT_CHOICES = [
         ('all', 'All Messages'),
@@ -11,6 +15,11 @@ class IMAPServer(models.Model):
         ('months', 'Messages from Last N Months'),
     ]
 
+    FETCH_MODE_CHOICES = [
+        ('full', 'Full Messages'),
+        ('headers_first', 'Headers First, Bodies On Demand'),
+    ]
+
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
@@ -36,6 +45,25 @@ class IMAPServer(models.Model):
         blank=True,
         help_text=_('Number of messages or time period to sync')
     )
+    fetch_mode = models.CharField(
+        _('Fetch Mode'),
+        max_length=20,
+        choices=FETCH_MODE_CHOICES,
+        default='full',
+        help_text=_('Headers first downloads bodies only for new messages')
+    )
+    max_connections = models.PositiveSmallIntegerField(
+        _('Max Connections'),
+        default=1,
+        help_text=_('Number of connections used to sync folders in parallel')
+    )
+    max_body_size = models.IntegerField(
+        _('Max Body Size'),
+        null=True,
+        blank=True,
+        help_text=_('In headers first mode, bodies of larger messages (in bytes) '
+                    'are downloaded only when the email is opened')
+    )
     
     # Folder settings
     folders_to_sync = models.TextField(
@@ -66,6 +94,22 @@ class IMAPServer(models.Model):
         return [f.strip() for f in self.folders_to_sync.split(',')]
 
 class Email(models.Model):
+    """Metadata of a synced email.
+
+    Bodies live in EmailBody so list and filter queries never read them.
+    ``body_text``, ``body_html`` and ``raw_message``, the RFC822 source, are
+    proxied to the blobs of the EmailBody, which is saved along with the
+    email; select_related('body__text', 'body__html') when bodies of several
+    emails are read.
+    """
+    BODY_FIELDS = {'body_text': 'text', 'body_html': 'html', 'raw_message': 'raw'}
+    SNIPPET_LENGTH = 200
+    # Columns read by email lists
+    LIST_FIELDS = (
+        'id', 'user', 'imap_server', 'message_id', 'subject', 'sender', 'recipient',
+        'date', 'snippet', 'folder', 'thread_id', 'flags', 'size', 'body_pending',
+    )
+
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
@@ -81,13 +125,34 @@ class Email(models.Model):
         max_length=255,
         help_text=_('Unique identifier for the email')
     )
+    rfc_message_id = models.CharField(
+        _('RFC Message-ID'),
+        max_length=255,
+        blank=True,
+        help_text=_('Message-ID header, used for threading')
+    )
     subject = models.CharField(_('Subject'), max_length=1000, blank=True)
     sender = models.CharField(_('Sender'), max_length=255)
     recipient = models.CharField(_('Recipient'), max_length=255)
     date = models.DateTimeField(_('Date'))
-    body_text = models.TextField(_('Body Text'), blank=True)
-    body_html = models.TextField(_('Body HTML'), blank=True)
-    raw_headers = models.TextField(_('Raw Headers'), blank=True)
+    snippet = models.CharField(
+        _('Snippet'),
+        max_length=200,
+        blank=True,
+        help_text=_('Start of the plain text body, shown in email lists')
+    )
+    body_pending = models.BooleanField(
+        _('Body Pending'),
+        default=False,
+        help_text=_('Body was not downloaded during sync')
+    )
+    size = models.IntegerField(_('Size'), default=0, help_text=_('RFC822 size in bytes'))
+    flags = models.CharField(
+        _('Flags'),
+        max_length=255,
+        blank=True,
+        help_text=_('Space separated IMAP flags, e.g. \\Seen \\Flagged')
+    )
     
     # Threading fields
     in_reply_to = models.CharField(_('In Reply To'), max_length=255, blank=True, null=True)
@@ -104,21 +169,409 @@ class Email(models.Model):
         verbose_name = _('Email')
         verbose_name_plural = _('Emails')
         ordering = ['-date']
+        # Every query is scoped to a user, so composite indexes lead with it.
         indexes = [
             models.Index(fields=['message_id']),
             models.Index(fields=['date']),
             models.Index(fields=['sender']),
-            models.Index(fields=['subject']),
             models.Index(fields=['thread_id']),
             models.Index(fields=['folder']),
+            models.Index(fields=['user', 'rfc_message_id']),
+            # Email list, newest first, and its keyset pagination
+            models.Index(fields=['user', 'date', 'id']),
+            # Email list filtered by folder
+            models.Index(fields=['user', 'folder', 'date', 'id']),
+            # Sync and reconciliation of a folder, folder statistics
+            models.Index(fields=['user', 'imap_server', 'folder']),
+            # Emails of a thread in date order
+            models.Index(fields=['user', 'thread_id', 'date']),
         ]
         unique_together = [['user', 'imap_server', 'message_id', 'folder']]
 
     def __str__(self):
         return f"{self.subject} ({self.date})"
 
+    def save(self, *args, **kwargs):
+        """Save the email and, if its body was loaded or set, the body."""
+        update_fields = kwargs.get('update_fields')
+        save_body = update_fields is None or any(f in self.BODY_FIELDS for f in update_fields)
+        if update_fields is not None:
+            kwargs['update_fields'] = [f for f in update_fields if f not in self.BODY_FIELDS]
+        super().save(*args, **kwargs)
+        if save_body and Email.body.is_cached(self) and self._body() is not None:
+            body = self._body()
+            body.email = self
+            Blob.store(body.loaded_blobs())
+            body.save()
+
+    def _body(self, create=False):
+        """The email's EmailBody, None if it has none unless ``create``."""
+        try:
+            return self.body
+        except EmailBody.DoesNotExist:
+            return EmailBody(email=self) if create else None
+
+    def _get_body_field(name, binary=False):
+        def getter(self):
+            body = self._body()
+            blob = getattr(body, Email.BODY_FIELDS[name]) if body is not None else None
+            data = blob.read() if blob is not None else b''
+            return data if binary else data.decode('utf-8')
+
+        def setter(self, value):
+            data = value if binary else (value or '').encode('utf-8')
+            setattr(self._body(create=True), Email.BODY_FIELDS[name], Blob.for_content(data))
+            if name == 'body_text':
+                self.snippet = ' '.join((value or '').split())[:Email.SNIPPET_LENGTH]
+
+        return property(getter, setter)
+
+    body_text = _get_body_field('body_text')
+    body_html = _get_body_field('body_html')
+    raw_message = _get_body_field('raw_message', binary=True)
+    del _get_body_field
+
+    @property
+    def raw_headers(self):
+        """Header section of the stored RFC822 source"""
+        header = re.split(rb'\r?\n\r?\n', self.raw_message, maxsplit=1)[0]
+        return header.decode('utf-8', errors='replace')
+
     def get_thread(self):
         """Returns all emails in the same thread"""
         if not self.thread_id:
             return Email.objects.filter(id=self.id)
-        return Email.objects.filter(thread_id=self.thread_id).order_by('date')
+        return Email.objects.filter(
+            user_id=self.user_id, thread_id=self.thread_id
+        ).order_by('date')
+
+class Blob(models.Model):
+    """Compressed content stored once, however many emails share it
+
+    See ``emails.blobs``. Blobs no longer referenced are removed by the
+    prune_blobs command.
+    """
+    CODEC_CHOICES = [
+        ('none', 'Uncompressed'),
+        ('zlib', 'zlib'),
+        ('zstd', 'Zstandard'),
+    ]
+
+    digest = models.CharField(
+        _('Digest'),
+        max_length=64,
+        primary_key=True,
+        help_text=_('SHA-256 of the uncompressed content')
+    )
+    codec = models.CharField(_('Codec'), max_length=10, choices=CODEC_CHOICES, default='none')
+    size = models.IntegerField(_('Size'), help_text=_('Uncompressed size in bytes'))
+    data = models.BinaryField(_('Data'))
+    created_at = models.DateTimeField(_('Created At'), auto_now_add=True)
+
+    class Meta:
+        verbose_name = _('Blob')
+        verbose_name_plural = _('Blobs')
+
+    def __str__(self):
+        return self.digest
+
+    @classmethod
+    def for_content(cls, data):
+        """An unsaved Blob of the bytes, None for empty content.
+
+        The content is only compressed by ``store`` if it is not stored yet.
+        """
+        if not data:
+            return None
+        blob = cls(digest=content_digest(data), size=len(data))
+        blob._content = data
+        return blob
+
+    @classmethod
+    def store(cls, blobs, chunk_size=500):
+        """Save the given blobs whose content is not stored yet."""
+        blobs = [b for b in blobs if b is not None and b._state.adding]
+        pending = {b.digest: b for b in blobs}
+        digests = list(pending)
+        stored = set()
+        for i in range(0, len(digests), chunk_size):
+            stored.update(
+                cls.objects
+                .filter(digest__in=digests[i:i + chunk_size])
+                .values_list('digest', flat=True)
+            )
+        new = [blob for digest, blob in pending.items() if digest not in stored]
+        for blob in new:
+            blob.codec, blob.data = compress(blob._content)
+        # Another writer may store the same content meanwhile
+        cls.objects.bulk_create(new, ignore_conflicts=True, batch_size=chunk_size)
+        for blob in blobs:
+            blob._state.adding = False
+
+    def read(self):
+        """Uncompressed content"""
+        content = getattr(self, '_content', None)
+        if content is None:
+            content = decompress(self.codec, self.data)
+        return content
+
+class EmailBody(models.Model):
+    """Content of an email, joined only when an email is shown in full"""
+    BLOB_FIELDS = ('text', 'html', 'raw')
+
+    email = models.OneToOneField(
+        Email,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='body'
+    )
+    text = models.ForeignKey(
+        Blob, on_delete=models.PROTECT, null=True, blank=True, related_name='+',
+        verbose_name=_('Body Text')
+    )
+    html = models.ForeignKey(
+        Blob, on_delete=models.PROTECT, null=True, blank=True, related_name='+',
+        verbose_name=_('Body HTML')
+    )
+    raw = models.ForeignKey(
+        Blob, on_delete=models.PROTECT, null=True, blank=True, related_name='+',
+        verbose_name=_('RFC822 Source'),
+        help_text=_('Message as downloaded, empty while the body is pending')
+    )
+
+    class Meta:
+        verbose_name = _('Email Body')
+        verbose_name_plural = _('Email Bodies')
+
+    def __str__(self):
+        return f"Body of {self.email_id}"
+
+    def loaded_blobs(self):
+        """Blobs already loaded or assigned, without querying the others"""
+        blobs = []
+        for name in self.BLOB_FIELDS:
+            field = self._meta.get_field(name)
+            if field.is_cached(self):
+                blobs.append(field.get_cached_value(self))
+        return blobs
+
+class Attachment(models.Model):
+    """Metadata of an attachment, its content is streamed on download
+
+    See ``emails.attachments``.
+    """
+    email = models.ForeignKey(
+        Email,
+        on_delete=models.CASCADE,
+        related_name='attachments'
+    )
+    index = models.IntegerField(_('Index'), help_text=_('Position among the attachments of the email'))
+    part = models.CharField(
+        _('Part Number'),
+        max_length=50,
+        help_text=_('IMAP body section of the attachment, e.g. 2 or 1.3')
+    )
+    filename = models.CharField(_('Filename'), max_length=255, blank=True)
+    content_type = models.CharField(_('Content Type'), max_length=255)
+    size = models.IntegerField(_('Size'), default=0, help_text=_('Decoded size in bytes'))
+    content_id = models.CharField(_('Content ID'), max_length=255, blank=True)
+    encoding = models.CharField(
+        _('Transfer Encoding'),
+        max_length=50,
+        blank=True,
+        help_text=_('Content-Transfer-Encoding of the part, e.g. base64')
+    )
+
+    class Meta:
+        verbose_name = _('Attachment')
+        verbose_name_plural = _('Attachments')
+        ordering = ['email_id', 'index']
+        unique_together = [['email', 'index']]
+
+    def __str__(self):
+        return self.filename or f"Part {self.part} of {self.email_id}"
+
+class Thread(models.Model):
+    """Summary of an email thread, kept up to date during sync"""
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='threads'
+    )
+    thread_id = models.CharField(_('Thread ID'), max_length=255)
+    root = models.ForeignKey(
+        Email,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+',
+        help_text=_('Earliest email of the thread')
+    )
+    subject = models.CharField(_('Subject'), max_length=1000, blank=True)
+    participants = models.JSONField(_('Participants'), default=list, blank=True)
+    folders = models.JSONField(_('Folders'), default=list, blank=True)
+    message_count = models.IntegerField(_('Message Count'), default=0)
+    first_date = models.DateTimeField(_('First Date'), null=True, blank=True)
+    last_date = models.DateTimeField(_('Last Date'), null=True, blank=True)
+    updated_at = models.DateTimeField(_('Updated At'), auto_now=True)
+
+    class Meta:
+        verbose_name = _('Thread')
+        verbose_name_plural = _('Threads')
+        ordering = ['-last_date']
+        indexes = [
+            models.Index(fields=['user', 'last_date', 'id']),
+        ]
+        unique_together = [['user', 'thread_id']]
+
+    def __str__(self):
+        return f"{self.subject} ({self.message_count} messages)"
+
+class FolderSyncState(models.Model):
+    """Incremental sync position for a single folder on an IMAP server"""
+    imap_server = models.ForeignKey(
+        IMAPServer,
+        on_delete=models.CASCADE,
+        related_name='folder_states'
+    )
+    folder = models.CharField(_('Folder'), max_length=255)
+    uidvalidity = models.BigIntegerField(_('UIDVALIDITY'), null=True, blank=True)
+    last_uid = models.BigIntegerField(
+        _('Last Seen UID'),
+        default=0,
+        help_text=_('Highest message UID already synced from this folder')
+    )
+    highestmodseq = models.BigIntegerField(
+        _('Highest MODSEQ'),
+        null=True,
+        blank=True,
+        help_text=_('CONDSTORE mod-sequence at the last flag reconciliation')
+    )
+    last_sync = models.DateTimeField(_('Last Sync'), null=True, blank=True)
+
+    class Meta:
+        verbose_name = _('Folder Sync State')
+        verbose_name_plural = _('Folder Sync States')
+        unique_together = [['imap_server', 'folder']]
+
+    def __str__(self):
+        return f"{self.imap_server.name}: {self.folder} (UID {self.last_uid})"
+
+    def reset(self, uidvalidity=None):
+        """Forget the sync position so the folder is fully resynced"""
+        self.uidvalidity = uidvalidity
+        self.last_uid = 0
+        self.highestmodseq = None
+
+class MailboxStats(models.Model):
+    """Message counters of one folder, kept current by the sync through deltas"""
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='mailbox_stats'
+    )
+    imap_server = models.ForeignKey(
+        IMAPServer,
+        on_delete=models.CASCADE,
+        related_name='mailbox_stats'
+    )
+    folder = models.CharField(_('Folder'), max_length=255)
+    message_count = models.IntegerField(_('Messages'), default=0)
+    unread_count = models.IntegerField(_('Unread'), default=0)
+    total_size = models.BigIntegerField(
+        _('Total Size'),
+        default=0,
+        help_text=_('Sum of the RFC822 sizes of the messages in bytes')
+    )
+    last_sync = models.DateTimeField(_('Last Sync'), null=True, blank=True)
+    updated_at = models.DateTimeField(_('Updated At'), auto_now=True)
+
+    class Meta:
+        verbose_name = _('Mailbox Statistics')
+        verbose_name_plural = _('Mailbox Statistics')
+        ordering = ['imap_server', 'folder']
+        unique_together = [['imap_server', 'folder']]
+
+    def __str__(self):
+        return f"{self.imap_server.name}: {self.folder} ({self.message_count} messages)"
+
+class CacheGeneration(models.Model):
+    """Version of a user's synced data, bumped whenever the sync changes it
+
+    Keys of cached API responses and ETags include the generation, so they
+    change as soon as the data does, across all processes.
+    """
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='cache_generation'
+    )
+    generation = models.BigIntegerField(_('Generation'), default=0)
+    updated_at = models.DateTimeField(_('Updated At'), auto_now=True)
+
+    class Meta:
+        verbose_name = _('Cache Generation')
+        verbose_name_plural = _('Cache Generations')
+
+    def __str__(self):
+        return f"{self.user} (generation {self.generation})"
+
+class SyncJob(models.Model):
+    """Background sync of one IMAP server started from the API"""
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('success', 'Success'),
+        ('failed', 'Failed'),
+    ]
+    ACTIVE_STATUSES = ['pending', 'running']
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='sync_jobs'
+    )
+    imap_server = models.ForeignKey(
+        IMAPServer,
+        on_delete=models.CASCADE,
+        related_name='sync_jobs'
+    )
+    status = models.CharField(
+        _('Status'),
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default='pending'
+    )
+    full = models.BooleanField(_('Full Resync'), default=False)
+    folders_total = models.IntegerField(_('Folders Total'), default=0)
+    folders_done = models.IntegerField(_('Folders Done'), default=0)
+    messages_processed = models.IntegerField(_('Messages Processed'), default=0)
+    inserted = models.IntegerField(_('Inserted'), default=0)
+    updated = models.IntegerField(_('Updated'), default=0)
+    error = models.TextField(_('Error'), blank=True)
+
+    created_at = models.DateTimeField(_('Created At'), auto_now_add=True)
+    updated_at = models.DateTimeField(_('Updated At'), auto_now=True)
+    started_at = models.DateTimeField(_('Started At'), null=True, blank=True)
+    finished_at = models.DateTimeField(_('Finished At'), null=True, blank=True)
+
+    class Meta:
+        verbose_name = _('Sync Job')
+        verbose_name_plural = _('Sync Jobs')
+        ordering = ['-created_at']
+        constraints = [
+            # At most one queued or running sync per server
+            models.UniqueConstraint(
+                fields=['imap_server'],
+                condition=models.Q(status__in=['pending', 'running']),
+                name='unique_active_sync_job'
+            ),
+        ]
+
+    def __str__(self):
+        return f"Sync of {self.imap_server.name} ({self.status})"
+
+    @property
+    def is_active(self):
+        return self.status in self.ACTIVE_STATUSES
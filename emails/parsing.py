@@ -0,0 +1,217 @@
+"""Decoding of fetched messages into Email field values.
+
+Text parts are decoded with the charset their MIME headers declare. Only
+when it is missing, unknown or does not match the bytes is UTF-8 tried,
+then the common single-byte charsets of ``LEGACY_CHARSETS`` on a sample of
+the part, and only when none of them reads as text a detector run, on at
+most ``CHARSET_SAMPLE_SIZE`` bytes: ``charset_normalizer`` when installed,
+``chardet`` otherwise. Both bodies
+are collected in a single walk of the message. The HTML body is stored as
+markup, HTML entities are only unescaped when the text body of a message
+without a text/plain part is extracted from it.
+"""
+import html
+import re
+
+import chardet
+from django.utils import timezone
+from imap_tools.utils import replace_html_ct_charset
+
+from .attachments import attachment_fields
+from .threads import parse_message_ids
+
+try:
+    import charset_normalizer
+except ImportError:
+    charset_normalizer = None
+
+# Bytes of a part given to the charset detector
+CHARSET_SAMPLE_SIZE = 1024
+
+# Declared charsets decoded as their usual superset, like browsers do:
+# mail labelled Latin-1 is very often Windows-1252 (curly quotes, dashes)
+CHARSET_ALIASES = {
+    'iso-8859-1': 'windows-1252',
+    'latin-1': 'windows-1252',
+    'latin1': 'windows-1252',
+}
+
+
+# Single-byte charsets of mislabelled mail, tried before the detector
+LEGACY_CHARSETS = ['windows-1252', 'koi8-r', 'windows-1251']
+
+# Bytes of a part the single-byte charsets are tried on
+LEGACY_SAMPLE_SIZE = 512
+
+# Share of the non-ASCII characters that must be letters of real looking
+# words to trust a single-byte charset
+LEGACY_CHARSET_MIN_SCORE = 0.6
+
+_NON_ASCII = re.compile(rb'[\x80-\xff]')
+_NON_ASCII_WORDS = re.compile(r'[^\W\d_]*(?=[^\x00-\x7f])[^\W\d_]+')
+_NON_LATIN = re.compile(r'[^\x00-\u024f]')
+
+
+def _non_ascii_count(text):
+    return len(text) - len(text.encode('ascii', 'ignore'))
+
+
+def _reads_as_word(word, non_ascii):
+    """Whether a word with ``non_ascii`` non-ASCII letters looks like a
+    real one."""
+    if not (word.islower() or word.istitle()):
+        return False
+    if not _NON_LATIN.search(word):
+        # Latin words are mostly ASCII, with the odd accented letter
+        return non_ascii * 2 <= len(word) or len(word) < 3
+    # Other scripts are not mixed with ASCII letters
+    return non_ascii == len(word)
+
+
+def _word_score(text):
+    """Share of the non-ASCII characters of ``text`` that are letters of
+    words looking like real ones.
+
+    Text decoded with the wrong single-byte charset swaps the case of
+    Cyrillic letters, mixes scripts within words, makes up Latin words of
+    accented letters only or is mostly symbols.
+    """
+    total = _non_ascii_count(text)
+    if not total:
+        return 0
+    good = 0
+    for word in _NON_ASCII_WORDS.findall(text):
+        non_ascii = _non_ascii_count(word)
+        if _reads_as_word(word, non_ascii):
+            good += non_ascii
+    return good / total
+
+
+def guess_legacy_charset(data):
+    """The ``LEGACY_CHARSETS`` charset ``data`` reads best in, None when
+    none reads as text."""
+    match = _NON_ASCII.search(data)
+    if match is None:
+        return None
+    start = max(0, match.start() - 64)
+    sample = data[start:start + LEGACY_SAMPLE_SIZE]
+    best, best_score = None, LEGACY_CHARSET_MIN_SCORE
+    for charset in LEGACY_CHARSETS:
+        try:
+            score = _word_score(sample.decode(charset))
+        except UnicodeDecodeError:
+            continue
+        if score > best_score:
+            best, best_score = charset, score
+    return best
+
+
+def detect_charset(data):
+    """Charset guessed from a bounded sample of ``data``, None if unknown."""
+    sample = data[:CHARSET_SAMPLE_SIZE]
+    if charset_normalizer is not None:
+        match = charset_normalizer.from_bytes(sample).best()
+        return match.encoding if match else None
+    return chardet.detect(sample, should_rename_legacy=True)['encoding']
+
+
+def decode_text(data, charset=None):
+    """Decode the bytes of a text part, trusting the declared charset first."""
+    if not data:
+        return ''
+    for encoding in (CHARSET_ALIASES.get(charset), charset, 'utf-8'):
+        if not encoding:
+            continue
+        try:
+            return data.decode(encoding)
+        except (LookupError, UnicodeDecodeError):
+            pass
+    try:
+        charset = guess_legacy_charset(data) or detect_charset(data) or 'utf-8'
+        return data.decode(charset, errors='replace')
+    except LookupError:
+        return data.decode('utf-8', errors='replace')
+
+
+def clean_text(text):
+    """Remove null bytes and carriage returns."""
+    return text.replace('\x00', '').replace('\r', '\n')
+
+
+_INVISIBLE_ELEMENTS = re.compile(r'<(head|script|style)\b.*?</\1\s*>', re.IGNORECASE | re.DOTALL)
+_LINE_BREAKS = re.compile(r'<(?:br|/p|/div|/h[1-6]|/li|/tr)\b[^>]*>', re.IGNORECASE)
+_TAGS = re.compile(r'<!--.*?-->|<[^>]*>', re.DOTALL)
+_BLANK_LINES = re.compile(r'[ \t]*\n\s*\n\s*')
+
+
+def html_to_text(body_html):
+    """Readable text of an HTML body, for messages without a text part."""
+    text = _INVISIBLE_ELEMENTS.sub('', body_html)
+    text = _LINE_BREAKS.sub('\n', text)
+    text = html.unescape(_TAGS.sub('', text))
+    return _BLANK_LINES.sub('\n\n', text).strip()
+
+
+def message_bodies(message):
+    """``(text, html)`` bodies of a parsed message.
+
+    Parts are picked like imap_tools' ``MailMessage.text`` and ``.html``:
+    every non-attachment text/plain and text/html part, concatenated. An
+    HTML-only message gets the text of its HTML body.
+    """
+    texts = []
+    htmls = []
+    for part in message.walk():
+        if part.get_content_maintype() == 'multipart' or part.get_filename():
+            continue
+        content_type = part.get_content_type()
+        if content_type in ('text/plain', 'text/'):
+            texts.append(decode_text(part.get_payload(decode=True), part.get_content_charset()))
+        elif content_type == 'text/html':
+            body = decode_text(part.get_payload(decode=True), part.get_content_charset())
+            htmls.append(replace_html_ct_charset(body, 'utf-8'))
+    body_html = clean_text(''.join(htmls))
+    if not texts and body_html:
+        return html_to_text(body_html), body_html
+    return clean_text(''.join(texts)), body_html
+
+
+def message_fields(msg):
+    """Email field values of a fetched imap_tools message.
+
+    Account, folder, UID, flags and the raw source are left to the caller.
+    ``thread_id`` is only provisional, ``EmailWriter`` resolves it against
+    stored emails.
+    """
+    headers = msg.obj
+    rfc_message_id = (parse_message_ids(headers.get('message-id', '')) or [''])[0]
+    references = parse_message_ids(headers.get('references', ''))
+    in_reply_to = (parse_message_ids(headers.get('in-reply-to', '')) or [''])[0]
+    body_text, body_html = message_bodies(msg.obj)
+    subject = clean_text(msg.subject) if msg.subject else ''
+
+    return {
+        'rfc_message_id': rfc_message_id[:255],
+        'subject': subject or '(No Subject)',
+        'sender': str(msg.from_) or 'unknown',
+        'recipient': str(msg.to) or 'unknown',
+        'date': msg.date or timezone.now(),
+        'body_text': body_text,
+        'body_html': body_html,
+        'in_reply_to': in_reply_to[:255],
+        'references': ' '.join(references),
+        'thread_id': (references or [in_reply_to or rfc_message_id])[0][:255],
+        'size': msg.size_rfc822,
+    }
+
+
+def parse_message(msg, body_pending=False):
+    """``(fields, attachments)`` of a fetched message, as plain data.
+
+    ``attachments`` are the ``attachment_fields``, None when only the
+    header section was downloaded. Nothing here needs the database, so it
+    can run in a parser process.
+    """
+    fields = message_fields(msg)
+    attachments = None if body_pending else attachment_fields(msg.obj)
+    return fields, attachments
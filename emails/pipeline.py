@@ -0,0 +1,149 @@
+"""Parsing of downloaded messages in worker processes.
+
+MIME parsing and charset decoding are CPU bound and, done inline, keep a
+sync on one core. With ``EMAIL_SYNC_PARSE_WORKERS`` (``sync_emails
+--parse-workers``) above zero, the thread reading from the IMAP server only
+hands the raw bytes of each message to a process pool. A writer thread
+takes the parsed field values, in fetch order, and adds them to the
+``EmailWriter`` of the sync, so the reader keeps fetching while a chunk is
+bulk-inserted. The async engine writes from its database thread instead,
+which is already apart from the reading. At most ``max_pending`` messages
+are in flight, adding blocks beyond that, so memory stays flat however
+large the folder is.
+"""
+import logging
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.db import connection
+
+from .messages import build_mail_message
+from .parsing import parse_message
+
+logger = logging.getLogger(__name__)
+
+
+def create_executor(workers):
+    """Process pool for ``parse_fetched``.
+
+    Workers are spawned rather than forked, the sync runs threads and holds
+    database connections a forked child would inherit.
+    """
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=django.setup,
+    )
+
+
+def parse_fetched(uid, flags, size, raw, body_pending=False):
+    """``parse_message`` of raw FETCH data, run in a worker process."""
+    return parse_message(build_mail_message(uid, flags, size, raw), body_pending)
+
+
+class ParsePipeline:
+    """Parses fetched messages and adds them to an ``EmailWriter`` in order.
+
+    ``command`` is the ``sync_emails`` Command building the emails. Without
+    an ``executor`` messages are parsed and written in the calling thread as
+    they are added. With one and ``writer_thread``, a writer thread stores
+    them and the calling thread must not use the writer until ``drain()``
+    returned. A failed flush is raised by the next ``add()`` or
+    ``drain()``. Use as a context manager, or ``close()`` the pipeline, so
+    the writer thread stops on errors too.
+    """
+
+    def __init__(self, command, writer, executor=None, max_pending=1000, writer_thread=True):
+        self.command = command
+        self.writer = writer
+        self.executor = executor
+        self.max_pending = max(1, max_pending)
+        self.writer_thread = writer_thread
+        self._pending = queue.Queue(maxsize=self.max_pending)
+        self._thread = None
+        self._error = None
+        self._discard = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, msg, server, folder, body_pending=False):
+        """Queue a fetched message, waiting while ``max_pending`` are."""
+        if self.executor is None:
+            self._store(None, msg, server, folder, body_pending)
+            return
+        self._raise_error()
+        if self._thread is None and self.writer_thread:
+            self._thread = threading.Thread(
+                target=self._write_pending, name='email-writer', daemon=True
+            )
+            self._thread.start()
+        future = self.executor.submit(
+            parse_fetched, msg.uid, msg.flags, msg.size_rfc822, msg.raw, body_pending
+        )
+        self._pending.put((future, msg, server, folder, body_pending))
+        if not self.writer_thread:
+            # Store those already parsed, waiting once max_pending are
+            while not self._pending.empty() and (
+                self._pending.full() or self._pending.queue[0][0].done()
+            ):
+                self._store(*self._pending.get())
+
+    def drain(self):
+        """Wait until every queued message was added to the writer."""
+        self._stop()
+        self._raise_error()
+
+    def close(self):
+        """Stop the writer thread, dropping messages not yet written."""
+        self._discard = True
+        self._stop()
+        self._discard = False
+
+    def _stop(self):
+        if self._thread is not None:
+            self._pending.put(None)
+            self._thread.join()
+            self._thread = None
+        while not self._pending.empty():
+            item = self._pending.get()
+            if not self._discard:
+                self._store(*item)
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            self.close()
+            raise error
+
+    def _write_pending(self):
+        try:
+            while True:
+                item = self._pending.get()
+                if item is None:
+                    return
+                # After an error the rest is only taken off the queue, so
+                # the reader is never left blocked
+                if self._error is None and not self._discard:
+                    try:
+                        self._store(*item)
+                    except Exception as e:
+                        self._error = e
+        finally:
+            connection.close()
+
+    def _store(self, future, msg, server, folder, body_pending):
+        try:
+            parsed = future.result() if future is not None else None
+            email_obj = self.command._build_email(msg, server, folder, body_pending, parsed)
+        except Exception as e:
+            logger.error(f"Error processing email in folder {folder}: {str(e)}")
+            return
+        # A failed flush is raised, the folder position must not advance
+        self.writer.add(email_obj)
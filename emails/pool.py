@@ -0,0 +1,108 @@
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class IMAPConnectionPool:
+    """Keeps authenticated IMAP connections open between syncs.
+
+    ``connect`` is a callable taking an IMAPServer and returning a logged in
+    imap_tools mailbox, usually ``sync_emails.Command._connect``. Failed
+    connection attempts are retried with exponential backoff and jitter.
+    """
+
+    def __init__(self, connect, max_per_server=1, backoff_base=1, backoff_max=300):
+        self.connect = connect
+        self.max_per_server = max_per_server
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._idle = {}
+        self._open = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, server, stop_event=None):
+        """Return a live connection to the server, connecting if needed.
+
+        Blocks, retrying with backoff, until a connection is made or
+        ``stop_event`` is set, in which case None is returned.
+        """
+        with self._lock:
+            idle = self._idle.setdefault(server.id, [])
+        while idle:
+            mailbox = idle.pop()
+            if self._is_alive(mailbox):
+                return mailbox
+            self.discard(server, mailbox)
+
+        attempt = 0
+        while stop_event is None or not stop_event.is_set():
+            with self._lock:
+                if self._open.get(server.id, 0) < self.max_per_server:
+                    self._open[server.id] = self._open.get(server.id, 0) + 1
+                    break
+            # Wait for another user of the server to release its connection
+            time.sleep(0.1)
+        else:
+            return None
+
+        while True:
+            try:
+                mailbox = self.connect(server)
+                logger.debug(f"Opened pooled connection to server {server.name}")
+                return mailbox
+            except Exception as e:
+                delay = self.backoff_delay(attempt)
+                attempt += 1
+                logger.warning(
+                    f"Connection to server {server.name} failed ({str(e)}), "
+                    f"retrying in {delay:.0f}s"
+                )
+                if stop_event is not None and stop_event.wait(delay):
+                    self._forget(server)
+                    return None
+                if stop_event is None:
+                    time.sleep(delay)
+
+    def release(self, server, mailbox):
+        """Return a healthy connection to the pool for reuse."""
+        with self._lock:
+            self._idle.setdefault(server.id, []).append(mailbox)
+
+    def discard(self, server, mailbox):
+        """Drop a broken or unwanted connection."""
+        try:
+            mailbox.logout()
+        except Exception:
+            pass
+        self._forget(server)
+
+    def close_all(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+            self._open = {}
+        for mailboxes in idle.values():
+            for mailbox in mailboxes:
+                try:
+                    mailbox.logout()
+                except Exception:
+                    pass
+
+    def backoff_delay(self, attempt):
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        return delay * random.uniform(0.5, 1)
+
+    def _forget(self, server):
+        with self._lock:
+            self._open[server.id] = max(0, self._open.get(server.id, 0) - 1)
+
+    @staticmethod
+    def _is_alive(mailbox):
+        try:
+            mailbox.client.noop()
+            return True
+        except Exception:
+            return False
@@ -0,0 +1,251 @@
+"""Full-text search over emails.
+
+Subject, sender, recipient and body text are indexed in a table of their
+own, written by the sync writer next to the emails:
+
+- on SQLite, ``emails_email_fts`` is an FTS5 virtual table keyed by the
+  email id, ranked with ``bm25``;
+- on PostgreSQL, ``emails_email_search`` holds a weighted ``tsvector`` per
+  email under a GIN index, ranked with ``ts_rank``.
+
+Other databases fall back to ``icontains`` filters.
+
+Queries are made of words, ``"quoted phrases"`` and ``prefix*`` words, all
+of which must match. A word or phrase can be restricted to a field with
+``from:``, ``to:``, ``subject:`` or ``body:``, and excluded with a leading
+``-``.
+"""
+import logging
+import re
+from dataclasses import dataclass
+
+from django.db import connection
+from django.db.models import Q
+
+logger = logging.getLogger(__name__)
+
+SQLITE_TABLE = 'emails_email_fts'
+POSTGRES_TABLE = 'emails_email_search'
+
+# Indexed columns and their rank weight on SQLite
+COLUMNS = ('subject', 'sender', 'recipient', 'body')
+BM25_WEIGHTS = '10.0, 4.0, 4.0, 1.0, 0.0'
+
+# tsvector weight label of each column on PostgreSQL
+WEIGHTS = {'subject': 'A', 'sender': 'B', 'recipient': 'C', 'body': 'D'}
+
+# Query qualifiers and the column they search
+QUALIFIERS = {
+    'from': 'sender',
+    'to': 'recipient',
+    'subject': 'subject',
+    'body': 'body',
+}
+
+# Characters of body text indexed per email, tsvectors are limited to 1MB
+BODY_INDEX_LIMIT = 200000
+
+# Rows written per statement while indexing
+INDEX_CHUNK_SIZE = 500
+
+TERM_RE = re.compile(r'(-)?(?:(\w+):)?(?:"([^"]*)"?|(\S+))')
+WORD_RE = re.compile(r'[^\W_]+')
+
+
+@dataclass
+class Term:
+    text: str
+    column: str = None
+    phrase: bool = False
+    prefix: bool = False
+    negated: bool = False
+
+    @property
+    def words(self):
+        return WORD_RE.findall(self.text.lower())
+
+
+def parse_query(query):
+    """Split a search query into Terms, dropping ones without any word."""
+    terms = []
+    for match in TERM_RE.finditer(query or ''):
+        negated, qualifier, phrase, word = match.groups()
+        column = QUALIFIERS.get((qualifier or '').lower())
+        if qualifier and column is None:
+            # Not a known field, search for the text as typed
+            word = f'{qualifier}:{word if phrase is None else phrase}'
+            phrase = None
+        term = Term(
+            text=phrase if phrase is not None else word,
+            column=column,
+            phrase=phrase is not None,
+            negated=bool(negated),
+        )
+        if not term.phrase and term.text.endswith('*'):
+            term.text = term.text.rstrip('*')
+            term.prefix = True
+        if term.words:
+            terms.append(term)
+    return terms
+
+
+def backend():
+    """Search backend of the default database: 'sqlite', 'postgresql' or None."""
+    if connection.vendor in ('sqlite', 'postgresql'):
+        return connection.vendor
+    return None
+
+
+def search_emails(queryset, query, ranked=True):
+    """Filter an Email queryset to the messages matching ``query``.
+
+    With ``ranked``, the best matches come first. Blank queries leave the
+    queryset as it is, queries that only exclude match nothing.
+    """
+    terms = parse_query(query)
+    if not terms:
+        return queryset
+    if not any(not t.negated for t in terms):
+        return queryset.none()
+
+    vendor = backend()
+    if vendor == 'sqlite':
+        queryset = queryset.extra(
+            select={'search_rank': f'bm25({SQLITE_TABLE}, {BM25_WEIGHTS})'},
+            tables=[SQLITE_TABLE],
+            where=[f'{SQLITE_TABLE}.rowid = emails_email.id', f'{SQLITE_TABLE} MATCH %s'],
+            params=[fts5_query(terms)],
+        )
+        return queryset.order_by('search_rank', '-date') if ranked else queryset
+    if vendor == 'postgresql':
+        tsquery = tsquery_string(terms)
+        queryset = queryset.extra(
+            select={'search_rank': f"ts_rank({POSTGRES_TABLE}.document, to_tsquery('simple', %s))"},
+            select_params=[tsquery],
+            tables=[POSTGRES_TABLE],
+            where=[
+                f'{POSTGRES_TABLE}.email_id = emails_email.id',
+                f"{POSTGRES_TABLE}.document @@ to_tsquery('simple', %s)",
+            ],
+            params=[tsquery],
+        )
+        return queryset.order_by('-search_rank', '-date') if ranked else queryset
+    return queryset.filter(_fallback_filter(terms))
+
+
+def fts5_query(terms):
+    """Build an FTS5 MATCH expression; every term is quoted, so user input
+    can not inject query syntax."""
+    def expression(term):
+        if term.phrase:
+            text = ' '.join(term.words)
+        else:
+            text = term.text
+        quoted = '"' + text.replace('"', '""') + '"'
+        if term.prefix:
+            quoted += ' *'
+        if term.column:
+            quoted = f'{term.column} : {quoted}'
+        return quoted
+
+    positive = ' AND '.join(expression(t) for t in terms if not t.negated)
+    negative = ''.join(f' NOT {expression(t)}' for t in terms if t.negated)
+    return f'({positive}){negative}'
+
+
+def tsquery_string(terms):
+    """Build a to_tsquery() expression from terms.
+
+    Fields are matched through the weight label of their lexemes, phrases
+    through the ``<->`` operator. Lexemes only hold letters and digits, the
+    same tokens ``index_emails`` writes.
+    """
+    def expression(term):
+        label = WEIGHTS[term.column] if term.column else ''
+        words = term.words
+        lexemes = [f"'{w}':{label}" if label else f"'{w}'" for w in words]
+        if term.prefix:
+            lexemes[-1] = f"'{words[-1]}':*{label}"
+        joined = ' <-> '.join(lexemes)
+        if len(lexemes) > 1:
+            joined = f'({joined})'
+        return f'!{joined}' if term.negated else joined
+
+    return ' & '.join(expression(t) for t in terms)
+
+
+def _fallback_filter(terms):
+    # Bodies are compressed in the blob store, only their snippet is searchable
+    columns = {'subject': 'subject', 'sender': 'sender', 'recipient': 'recipient', 'body': 'snippet'}
+    query = Q()
+    for term in terms:
+        text = ' '.join(term.words) if term.phrase else term.text
+        if term.column:
+            match = Q(**{f'{columns[term.column]}__icontains': text})
+        else:
+            match = Q()
+            for field in columns.values():
+                match |= Q(**{f'{field}__icontains': text})
+        query &= ~match if term.negated else match
+    return query
+
+
+def _document(email_obj):
+    return (
+        email_obj.subject or '',
+        email_obj.sender or '',
+        email_obj.recipient or '',
+        (email_obj.body_text or '')[:BODY_INDEX_LIMIT],
+    )
+
+
+def _tokens(text):
+    # PostgreSQL's parser keeps addresses, hosts and hyphenated words as
+    # single lexemes, index the same plain words queries are split into
+    return ' '.join(WORD_RE.findall(text.lower()))
+
+
+def index_emails(emails):
+    """Write the search index entries of saved emails, replacing older ones."""
+    emails = [e for e in emails if e.pk]
+    vendor = backend()
+    if not emails or vendor is None:
+        return
+
+    with connection.cursor() as cursor:
+        for i in range(0, len(emails), INDEX_CHUNK_SIZE):
+            chunk = emails[i:i + INDEX_CHUNK_SIZE]
+            if vendor == 'sqlite':
+                cursor.executemany(
+                    f'DELETE FROM {SQLITE_TABLE} WHERE rowid = %s',
+                    [(e.pk,) for e in chunk]
+                )
+                cursor.executemany(
+                    f'INSERT INTO {SQLITE_TABLE} (rowid, {", ".join(COLUMNS)}, user_id) '
+                    f'VALUES (%s, %s, %s, %s, %s, %s)',
+                    [(e.pk, *_document(e), e.user_id) for e in chunk]
+                )
+            else:
+                vector = ' || '.join(
+                    f"setweight(to_tsvector('simple', %s), '{WEIGHTS[c]}')" for c in COLUMNS
+                )
+                cursor.executemany(
+                    f'INSERT INTO {POSTGRES_TABLE} (email_id, user_id, document) '
+                    f'VALUES (%s, %s, {vector}) '
+                    f'ON CONFLICT (email_id) DO UPDATE '
+                    f'SET user_id = EXCLUDED.user_id, document = EXCLUDED.document',
+                    [(e.pk, e.user_id, *(_tokens(v) for v in _document(e))) for e in chunk]
+                )
+    logger.debug(f"Indexed {len(emails)} emails for search")
+
+
+def clear_index(user_id=None):
+    """Remove the search index entries of a user, or of everyone."""
+    table = {'sqlite': SQLITE_TABLE, 'postgresql': POSTGRES_TABLE}.get(backend())
+    if table is None:
+        return
+    with connection.cursor() as cursor:
+        if user_id is None:
+            cursor.execute(f'DELETE FROM {table}')
+        else:
+            cursor.execute(f'DELETE FROM {table} WHERE user_id = %s', [user_id])
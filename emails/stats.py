@@ -0,0 +1,150 @@
+"""Per-folder mailbox statistics.
+
+MailboxStats rows hold the message, unread and size totals of every synced
+folder. Instead of recounting, whoever inserts, updates or deletes emails
+records the difference in a ``StatsDelta`` and applies it with
+``F()`` expressions in the same transaction. ``rebuild_stats`` recomputes
+the rows from the emails in case they drift, for instance after emails were
+edited in the admin.
+"""
+import logging
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+
+from .cache import bump_generation
+from .models import Email, FolderSyncState, MailboxStats
+
+logger = logging.getLogger(__name__)
+
+SEEN_FLAG = '\\Seen'
+
+
+def is_unread(flags):
+    return SEEN_FLAG not in (flags or '')
+
+
+class StatsDelta:
+    """Accumulates counter changes per ``(user_id, imap_server_id, folder)``."""
+
+    def __init__(self):
+        self._changes = defaultdict(lambda: [0, 0, 0])
+
+    def add(self, user_id, server_id, folder, messages=0, unread=0, size=0):
+        change = self._changes[(user_id, server_id, folder)]
+        change[0] += messages
+        change[1] += unread
+        change[2] += size
+
+    def add_email(self, email_obj, sign=1):
+        """Count an email in (``sign=1``) or out (``sign=-1``) of its folder."""
+        self.add(
+            email_obj.user_id, email_obj.imap_server_id, email_obj.folder,
+            messages=sign,
+            unread=sign * is_unread(email_obj.flags),
+            size=sign * (email_obj.size or 0),
+        )
+
+    def remove_queryset(self, emails):
+        """Count every email of a queryset out, with one aggregate query."""
+        rows = (
+            emails
+            .order_by()
+            .values('user_id', 'imap_server_id', 'folder')
+            .annotate(
+                messages=Count('id'),
+                unread=Count('id', filter=~Q(flags__contains=SEEN_FLAG)),
+                size=Sum('size'),
+            )
+        )
+        for row in rows:
+            self.add(
+                row['user_id'], row['imap_server_id'], row['folder'],
+                messages=-row['messages'], unread=-row['unread'], size=-(row['size'] or 0)
+            )
+
+    def save(self):
+        """Apply the accumulated changes to MailboxStats."""
+        changes = {key: change for key, change in self._changes.items() if any(change)}
+        self._changes.clear()
+        if not changes:
+            return
+
+        with transaction.atomic():
+            MailboxStats.objects.bulk_create(
+                [
+                    MailboxStats(user_id=user_id, imap_server_id=server_id, folder=folder)
+                    for user_id, server_id, folder in changes
+                ],
+                ignore_conflicts=True
+            )
+            for (user_id, server_id, folder), (messages, unread, size) in changes.items():
+                MailboxStats.objects.filter(imap_server_id=server_id, folder=folder).update(
+                    message_count=F('message_count') + messages,
+                    unread_count=F('unread_count') + unread,
+                    total_size=F('total_size') + size,
+                    updated_at=timezone.now()
+                )
+
+
+def record_sync(server, folder, synced_at):
+    """Remember when a folder was last synced.
+
+    Sync times are read outside of cached responses, so the generation is
+    only bumped when the folder gets its first row. Writes and reconciled
+    flags bump it themselves.
+    """
+    stats = MailboxStats.objects.filter(imap_server=server, folder=folder)
+    if stats.update(last_sync=synced_at):
+        return
+    MailboxStats.objects.bulk_create(
+        [MailboxStats(user_id=server.user_id, imap_server=server, folder=folder)],
+        ignore_conflicts=True
+    )
+    stats.update(last_sync=synced_at)
+    bump_generation([server.user_id])
+
+
+def rebuild_stats(user):
+    """Recompute the user's MailboxStats from their emails, returning the row count."""
+    last_sync = {
+        (server_id, folder): synced_at
+        for server_id, folder, synced_at in FolderSyncState.objects
+        .filter(imap_server__user=user)
+        .values_list('imap_server_id', 'folder', 'last_sync')
+    }
+    rows = (
+        Email.objects
+        .filter(user=user)
+        .order_by()
+        .values('imap_server_id', 'folder')
+        .annotate(
+            messages=Count('id'),
+            unread=Count('id', filter=~Q(flags__contains=SEEN_FLAG)),
+            size=Sum('size'),
+        )
+    )
+    stats = {
+        (row['imap_server_id'], row['folder']): MailboxStats(
+            user=user,
+            imap_server_id=row['imap_server_id'],
+            folder=row['folder'],
+            message_count=row['messages'],
+            unread_count=row['unread'],
+            total_size=row['size'] or 0,
+        )
+        for row in rows
+    }
+    # Synced folders without any email keep a row for their sync time
+    for key, synced_at in last_sync.items():
+        if key not in stats:
+            stats[key] = MailboxStats(user=user, imap_server_id=key[0], folder=key[1])
+        stats[key].last_sync = synced_at
+
+    with transaction.atomic():
+        MailboxStats.objects.filter(user=user).delete()
+        MailboxStats.objects.bulk_create(stats.values())
+        bump_generation([user.id])
+    return len(stats)
@@ -0,0 +1,197 @@
+"""Background sync jobs and downloads of pending bodies.
+
+Jobs are queued on Celery when it is installed and a broker is configured
+(``CELERY_BROKER_URL``). Otherwise, or with ``SYNC_JOB_BACKEND = 'local'``,
+they run in a thread of the process that queued them, which is enough for
+local development with SQLite.
+"""
+import datetime
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+
+from .models import Email, SyncJob
+
+logger = logging.getLogger(__name__)
+
+try:
+    from celery import shared_task
+except ImportError:
+    shared_task = None
+
+
+def enqueue_sync(server, full=False):
+    """Queue a sync of the server, returning ``(job, created)``.
+
+    If the server already has a pending or running job, that job is
+    returned instead of starting a second one.
+    """
+    _expire_stale_jobs(server)
+    try:
+        with transaction.atomic():
+            job = SyncJob.objects.create(
+                user=server.user,
+                imap_server=server,
+                full=full
+            )
+    except IntegrityError:
+        # unique_active_sync_job: another request queued it first
+        job = SyncJob.objects.filter(
+            imap_server=server,
+            status__in=SyncJob.ACTIVE_STATUSES
+        ).first()
+        if job is None:
+            raise
+        return job, False
+
+    transaction.on_commit(lambda: _dispatch(job.id))
+    return job, True
+
+
+def enqueue_body_fetch(email_obj):
+    """Queue the download of an email's pending body, returning whether it
+    was queued.
+
+    No second download of the email is queued while one is waiting or
+    running.
+    """
+    timeout = getattr(settings, 'EMAIL_BODY_FETCH_TIMEOUT', 30)
+    # Expires on its own should the worker die
+    if not cache.add(_body_fetch_key(email_obj.pk), True, timeout * 2):
+        return False
+    transaction.on_commit(lambda: _run_in_background(
+        fetch_body_task, fetch_email_body, email_obj.pk, f'body-fetch-{email_obj.pk}'
+    ))
+    return True
+
+
+def _body_fetch_key(email_id):
+    return f'body-fetch:{email_id}'
+
+
+def _dispatch(job_id):
+    _run_in_background(sync_server_task, run_sync_job, job_id, f'sync-job-{job_id}')
+
+
+def _run_in_background(task, run, arg, name):
+    """Queue the Celery ``task`` or start ``run`` in a thread."""
+    if _use_celery():
+        task.delay(arg)
+    else:
+        thread = threading.Thread(target=_run_local, args=(run, arg), name=name, daemon=True)
+        thread.start()
+
+
+def _use_celery():
+    backend = getattr(settings, 'SYNC_JOB_BACKEND', 'auto')
+    if backend == 'local':
+        return False
+    available = shared_task is not None and bool(getattr(settings, 'CELERY_BROKER_URL', ''))
+    if backend == 'celery' and not available:
+        raise Exception("SYNC_JOB_BACKEND is 'celery' but Celery or its broker is not configured")
+    return available
+
+
+def _run_local(run, arg):
+    try:
+        run(arg)
+    finally:
+        connection.close()
+
+
+def _expire_stale_jobs(server):
+    """Fail active jobs whose worker died without reporting back.
+
+    Running jobs report after every folder and every chunk of emails
+    stored, so a long folder does not look stale.
+    """
+    stale_after = getattr(settings, 'SYNC_JOB_STALE_AFTER', 3600)
+    cutoff = timezone.now() - datetime.timedelta(seconds=stale_after)
+    SyncJob.objects.filter(
+        imap_server=server,
+        status__in=SyncJob.ACTIVE_STATUSES,
+        updated_at__lt=cutoff
+    ).update(
+        status='failed',
+        error='Job stopped reporting progress',
+        finished_at=timezone.now(),
+        updated_at=timezone.now()
+    )
+
+
+def run_sync_job(job_id):
+    """Run a queued sync job, recording progress and the result on the job."""
+    from emails.management.commands.sync_emails import Command as SyncCommand
+
+    claimed = SyncJob.objects.filter(id=job_id, status='pending').update(
+        status='running',
+        started_at=timezone.now(),
+        updated_at=timezone.now()
+    )
+    if not claimed:
+        logger.warning(f"Sync job {job_id} is no longer pending, skipping")
+        return
+
+    job = SyncJob.objects.select_related('imap_server__user').get(id=job_id)
+
+    def progress(folders_done, folders_total, messages):
+        SyncJob.objects.filter(id=job_id).update(
+            folders_done=folders_done,
+            folders_total=folders_total,
+            messages_processed=messages,
+            updated_at=timezone.now()
+        )
+
+    try:
+        stats = SyncCommand().sync_server(job.imap_server, full=job.full, progress=progress)
+        SyncJob.objects.filter(id=job_id).update(
+            status='success',
+            inserted=stats['inserted'],
+            updated=stats['updated'],
+            finished_at=timezone.now(),
+            updated_at=timezone.now()
+        )
+    except Exception as e:
+        logger.error(f"Sync job {job_id} failed: {str(e)}")
+        SyncJob.objects.filter(id=job_id).update(
+            status='failed',
+            error=str(e),
+            finished_at=timezone.now(),
+            updated_at=timezone.now()
+        )
+
+
+def fetch_email_body(email_id):
+    """Download the pending body of an email, with the short
+    ``EMAIL_BODY_FETCH_TIMEOUT`` since a reader is waiting for it."""
+    from emails.management.commands.sync_emails import Command as SyncCommand
+
+    try:
+        email_obj = Email.objects.select_related('imap_server__user').filter(
+            id=email_id, body_pending=True
+        ).first()
+        if email_obj is not None:
+            SyncCommand().fetch_body(
+                email_obj, timeout=getattr(settings, 'EMAIL_BODY_FETCH_TIMEOUT', 30)
+            )
+    except Exception as e:
+        logger.error(f"Error fetching body of email {email_id}: {str(e)}")
+    finally:
+        cache.delete(_body_fetch_key(email_id))
+
+
+if shared_task is not None:
+    @shared_task(name='emails.sync_server', ignore_result=True)
+    def sync_server_task(job_id):
+        run_sync_job(job_id)
+
+    @shared_task(name='emails.fetch_body', ignore_result=True)
+    def fetch_body_task(email_id):
+        fetch_email_body(email_id)
+else:
+    sync_server_task = None
+    fetch_body_task = None
@@ -0,0 +1,346 @@
+"""Fixtures shared by the test suites of the emails and api apps.
+
+``FakeIMAPServer`` is a small IMAP4rev1 server on a local port, backed by
+in-memory folders. The sync talks to it through the real imap_tools and
+aioimap clients, so everything from the SEARCH criteria to the FETCH bulk
+sizes goes through the code paths used against a real server. It speaks
+only what the sync uses: LOGIN, LIST, SELECT, STATUS, UID SEARCH, UID FETCH
+(with CONDSTORE's CHANGEDSINCE), IDLE and LOGOUT.
+"""
+import asyncio
+import datetime
+import email
+import re
+import threading
+from email.message import EmailMessage
+from email.utils import format_datetime, make_msgid
+
+from django.contrib.auth.models import User
+from imap_tools.imap_utf7 import utf7_decode, utf7_encode
+
+from .models import IMAPServer
+
+
+def create_account(username='reader', name='Mail', **server_fields):
+    """A user and one IMAP server of theirs."""
+    user = User.objects.create_user(username=username, password='secret')
+    server_fields = {
+        'host': 'imap.example.com', 'username': username, 'password': 'secret',
+        **server_fields,
+    }
+    server = IMAPServer.objects.create(user=user, name=name, **server_fields)
+    return user, server
+
+
+class AccountTestMixin:
+    """Gives a test case ``self.user`` and their ``self.server``.
+
+    They are created once per class, tests get their own copies.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.user, cls.server = create_account()
+
+
+def make_message(subject, body='Hello', sender='sender@example.com',
+                 to='reader@example.com', message_id=None, in_reply_to=None,
+                 references=None, date=None):
+    """Source of a plain text message."""
+    message = EmailMessage()
+    message['Subject'] = subject
+    message['From'] = sender
+    message['To'] = to
+    message['Message-ID'] = message_id or make_msgid()
+    message['Date'] = format_datetime(
+        date or datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    )
+    if in_reply_to:
+        message['In-Reply-To'] = in_reply_to
+    if references:
+        message['References'] = references
+    message.set_content(body)
+    return message.as_bytes()
+
+
+class FakeFolder:
+    """Messages of one folder, by UID, with CONDSTORE mod-sequences."""
+
+    def __init__(self, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.modseq = 1
+        # uid -> [source, flags, modseq]
+        self.messages = {}
+
+    def add(self, source, flags=()):
+        """Append a message, returning its UID."""
+        uid = self.uidnext
+        self.uidnext += 1
+        self.modseq += 1
+        self.messages[uid] = [source, tuple(flags), self.modseq]
+        return uid
+
+    def set_flags(self, uid, flags):
+        self.modseq += 1
+        self.messages[uid][1:] = [tuple(flags), self.modseq]
+
+    def expunge(self, uid):
+        self.modseq += 1
+        del self.messages[uid]
+
+    def reset(self, uidvalidity):
+        """Renumber the messages under a new UIDVALIDITY, like a rebuilt mailbox."""
+        messages = [m[:2] for _, m in sorted(self.messages.items())]
+        self.__init__(uidvalidity)
+        for source, flags in messages:
+            self.add(source, flags)
+
+
+def _quote(value):
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _tokens(line):
+    """Split command arguments into atoms, quoted strings and lists."""
+    tokens = []
+    for match in re.finditer(r'"((?:\\.|[^"\\])*)"|(\((?:[^()]|\([^()]*\))*\))|(\S+\[[^\]]*\]\S*|\S+)', line):
+        quoted, parenthesized, atom = match.groups()
+        if quoted is not None:
+            tokens.append(re.sub(r'\\(.)', r'\1', quoted))
+        else:
+            tokens.append(parenthesized or atom)
+    return tokens
+
+
+def _uid_set(spec, uids):
+    """UIDs of ``uids`` in an IMAP sequence set like ``1,4:*``."""
+    highest = max(uids, default=0)
+    selected = set()
+    for part in spec.split(','):
+        low, _, high = part.partition(':')
+        low = highest if low == '*' else int(low)
+        high = low if not high else highest if high == '*' else int(high)
+        low, high = min(low, high), max(low, high)
+        selected.update(uid for uid in uids if low <= uid <= high)
+        # "n:*" matches the last message even when it is below n
+        if part.endswith('*') and uids and not selected:
+            selected.add(highest)
+    return sorted(selected)
+
+
+def _section(source, section):
+    """Data of a BODY[section] item."""
+    header, _, text = source.partition(b'\n\n')
+    if section == '':
+        return source
+    if section == 'HEADER':
+        return header + b'\n\n'
+    if section == 'TEXT':
+        return text
+    part = email.message_from_bytes(source)
+    for number in section.split('.'):
+        if not part.is_multipart():
+            return text if number == '1' else b''
+        part = part.get_payload()[int(number) - 1]
+    return part.as_bytes().partition(b'\n\n')[2]
+
+
+class _Session:
+    """One client connection."""
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.selected = None
+
+    async def send(self, data):
+        self.writer.write(data.encode() if isinstance(data, str) else data)
+        await self.writer.drain()
+
+    async def run(self):
+        await self.send('* OK fake IMAP server ready\r\n')
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    return
+                tag, command, arguments = (line.decode().rstrip('\r\n').split(' ', 2) + [''])[:3]
+                command = command.upper()
+                if command == 'UID':
+                    command, _, arguments = arguments.partition(' ')
+                    command = 'UID_' + command.upper()
+                self.server.commands.append(f'{command} {arguments}'.strip())
+                if self.server.latency:
+                    await asyncio.sleep(self.server.latency)
+                handler = getattr(self, f'do_{command}', None)
+                if handler is None:
+                    await self.send(f'{tag} BAD unknown command\r\n')
+                elif await handler(tag, arguments) == 'BYE':
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.writer.close()
+
+    @property
+    def folder(self):
+        return self.server.folders[self.selected]
+
+    async def do_CAPABILITY(self, tag, arguments):
+        capabilities = 'IMAP4rev1 IDLE' + (' CONDSTORE' if self.server.condstore else '')
+        await self.send(f'* CAPABILITY {capabilities}\r\n{tag} OK done\r\n')
+
+    async def do_LOGIN(self, tag, arguments):
+        await self.send(f'{tag} OK logged in\r\n')
+
+    async def do_LOGOUT(self, tag, arguments):
+        await self.send(f'* BYE logging out\r\n{tag} OK done\r\n')
+        return 'BYE'
+
+    async def do_NOOP(self, tag, arguments):
+        await self.send(f'{tag} OK done\r\n')
+
+    async def do_LIST(self, tag, arguments):
+        lines = ''.join(
+            f'* LIST (\\HasNoChildren) "/" {_quote(utf7_encode(name).decode())}\r\n'
+            for name in self.server.folders
+        )
+        await self.send(f'{lines}{tag} OK done\r\n')
+
+    async def do_SELECT(self, tag, arguments):
+        self.selected = utf7_decode(_tokens(arguments)[0].encode())
+        folder = self.folder
+        modseq = f'* OK [HIGHESTMODSEQ {folder.modseq}] ok\r\n' if self.server.condstore else ''
+        await self.send(
+            f'* {len(folder.messages)} EXISTS\r\n* 0 RECENT\r\n'
+            f'* OK [UIDVALIDITY {folder.uidvalidity}] ok\r\n'
+            f'* OK [UIDNEXT {folder.uidnext}] ok\r\n{modseq}'
+            f'{tag} OK [READ-WRITE] done\r\n'
+        )
+
+    do_EXAMINE = do_SELECT
+
+    async def do_STATUS(self, tag, arguments):
+        name, items = _tokens(arguments)
+        folder = self.server.folders[utf7_decode(name.encode())]
+        values = {
+            'MESSAGES': len(folder.messages),
+            'RECENT': 0,
+            'UIDNEXT': folder.uidnext,
+            'UIDVALIDITY': folder.uidvalidity,
+            'UNSEEN': sum('\\Seen' not in m[1] for m in folder.messages.values()),
+            'HIGHESTMODSEQ': folder.modseq,
+        }
+        items = ' '.join(f'{item} {values[item]}' for item in items.strip('()').split())
+        await self.send(f'* STATUS {_quote(name)} ({items})\r\n{tag} OK done\r\n')
+
+    async def do_UID_SEARCH(self, tag, arguments):
+        # Only UID ranges are honoured, other criteria match every message
+        uids = sorted(self.folder.messages)
+        match = re.search(r'UID ([\d:*,]+)', arguments)
+        if match:
+            uids = _uid_set(match.group(1), uids)
+        await self.send(f'* SEARCH {" ".join(map(str, uids))}\r\n{tag} OK done\r\n')
+
+    async def do_UID_FETCH(self, tag, arguments):
+        spec, items = arguments.split(' ', 1)
+        changedsince = None
+        match = re.search(r'\s*\(CHANGEDSINCE (\d+)\)$', items)
+        if match:
+            changedsince = int(match.group(1))
+            items = items[:match.start()]
+        items = _tokens(items[1:-1] if items.startswith('(') else items)
+        numbers = {uid: n for n, uid in enumerate(sorted(self.folder.messages), 1)}
+        response = b''
+        for uid in _uid_set(spec, list(numbers)):
+            source, flags, modseq = self.folder.messages[uid]
+            if changedsince is not None and modseq <= changedsince:
+                continue
+            data = [f'UID {uid}'.encode()]
+            for item in items:
+                item = item.upper()
+                if item == 'FLAGS':
+                    data.append(f'FLAGS ({" ".join(flags)})'.encode())
+                elif item == 'RFC822.SIZE':
+                    data.append(f'RFC822.SIZE {len(source)}'.encode())
+                elif item == 'INTERNALDATE':
+                    data.append(b'INTERNALDATE "01-Jan-2024 00:00:00 +0000"')
+                elif item == 'MODSEQ':
+                    data.append(f'MODSEQ ({modseq})'.encode())
+                elif item == 'RFC822' or item.startswith('BODY'):
+                    match = re.match(r'BODY(?:\.PEEK)?\[(.*?)\](?:<(\d+)\.(\d+)>)?$', item)
+                    section = match.group(1) if match else ''
+                    content = _section(source, section)
+                    name = 'RFC822' if item == 'RFC822' else f'BODY[{section}]'
+                    if match and match.group(2):
+                        offset = int(match.group(2))
+                        content = content[offset:offset + int(match.group(3))]
+                        name += f'<{offset}>'
+                    data.append(f'{name} {{{len(content)}}}\r\n'.encode() + content)
+                    if '.PEEK' not in item and '\\Seen' not in flags:
+                        self.folder.messages[uid][1] = flags + ('\\Seen',)
+            response += f'* {numbers[uid]} FETCH ('.encode() + b' '.join(data) + b')\r\n'
+        await self.send(response + f'{tag} OK done\r\n'.encode())
+
+    async def do_IDLE(self, tag, arguments):
+        await self.send('+ idling\r\n')
+        self.server.idlers.append(self)
+        try:
+            await self.reader.readline()
+        finally:
+            self.server.idlers.remove(self)
+        await self.send(f'{tag} OK IDLE done\r\n')
+
+
+class FakeIMAPServer:
+    """In-memory IMAP server listening on ``127.0.0.1:port``.
+
+    Runs its own event loop in a daemon thread. ``folders`` maps folder
+    names to ``FakeFolder`` and can be changed between syncs, ``commands``
+    lists every command received, without its tag. ``peak_sessions`` is
+    the most client connections open at once, ``latency`` delays every
+    response by that many seconds so concurrent syncs overlap.
+    """
+
+    def __init__(self, folders=('INBOX',), condstore=False, latency=0):
+        self.folders = {name: FakeFolder() for name in folders}
+        self.condstore = condstore
+        self.latency = latency
+        self.commands = []
+        self.sessions = 0
+        self.peak_sessions = 0
+        self.idlers = []
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+        self.thread = threading.Thread(target=self._serve, args=(started,), daemon=True)
+        self.thread.start()
+        started.wait()
+
+    def _serve(self, started):
+        asyncio.set_event_loop(self.loop)
+        self.listener = self.loop.run_until_complete(
+            asyncio.start_server(self._session, '127.0.0.1', 0)
+        )
+        self.port = self.listener.sockets[0].getsockname()[1]
+        started.set()
+        self.loop.run_forever()
+
+    async def _session(self, reader, writer):
+        self.sessions += 1
+        self.peak_sessions = max(self.peak_sessions, self.sessions)
+        try:
+            await _Session(self, reader, writer).run()
+        finally:
+            self.sessions -= 1
+
+    def account_fields(self):
+        """IMAPServer field values connecting to this server."""
+        return {'host': '127.0.0.1', 'port': self.port, 'use_ssl': False}
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.listener.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
@@ -1,3 +1,683 @@
-from django.test import TestCase
+import asyncio
+import base64
+import datetime
+import email
+import io
+import os
+import quopri
+import threading
+from email.message import EmailMessage
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .management.commands.imap_idle import Command as IdleCommand, ServerWatcher
+from .management.commands.sync_emails import Command as SyncCommand
+from .aioimap import AsyncIMAPClient
+from .aiosync import AsyncSyncEngine
+from .attachments import attachments_of
+from .cache import generation
+from .messages import TransferDecoder, build_mail_message
+from .models import Attachment, Blob, Email, EmailBody, FolderSyncState, MailboxStats, Thread
+from .parsing import decode_text, guess_legacy_charset, html_to_text, message_fields
+from .pipeline import ParsePipeline, create_executor
+from .pool import IMAPConnectionPool
+from .stats import rebuild_stats
+from .testing import AccountTestMixin, FakeIMAPServer, create_account, make_message
+from .threads import ThreadResolver, delete_emails
+from .writer import EmailWriter
+
+EML_DIR = os.path.join(os.path.dirname(__file__), 'testdata', 'eml')
+
+
+def read_eml(name):
+    with open(os.path.join(EML_DIR, name), 'rb') as f:
+        return f.read()
+
+
+class BlobStoreTests(AccountTestMixin, TestCase):
+    """Bodies and sources are compressed and stored once per distinct content"""
+
+    def test_folder_copies_share_blobs(self):
+        raw = b'Subject: Report\r\n\r\n' + b'Quarterly numbers. ' * 100
+        with EmailWriter() as writer:
+            for folder in ('INBOX', '[Gmail]/All Mail'):
+                writer.add(Email(
+                    user=self.user, imap_server=self.server, message_id='7',
+                    folder=folder, subject='Report', sender='sender@example.com',
+                    recipient='reader@example.com', date=timezone.now(),
+                    body_text='Quarterly numbers. ' * 100, body_html='<p>Quarterly</p>',
+                    raw_message=raw,
+                ))
+        self.assertEqual(EmailBody.objects.count(), 2)
+        self.assertEqual(Blob.objects.count(), 3)
+        self.assertTrue(all(
+            len(blob.data) < blob.size for blob in Blob.objects.exclude(codec='none')
+        ))
+
+        email_obj = Email.objects.select_related('body__text', 'body__html').first()
+        self.assertEqual(email_obj.body_text, 'Quarterly numbers. ' * 100)
+        self.assertEqual(email_obj.raw_message, raw)
+        self.assertEqual(email_obj.raw_headers, 'Subject: Report')
+
+        delete_emails(Email.objects.filter(user=self.user))
+        call_command('prune_blobs', stdout=io.StringIO())
+        self.assertEqual(Blob.objects.count(), 0)
+
+
+class MessageParsingTests(TestCase):
+    """Bodies are decoded with their declared charset, detected only when it is wrong"""
+
+    def parse(self, name):
+        raw = read_eml(name)
+        return message_fields(build_mail_message(1, [], len(raw), raw))
+
+    def test_declared_and_detected_charsets(self):
+        self.assertIn('réunion de lundi', self.parse('03-latin1-qp.eml')['body_text'])
+        # Latin-1 labels are read as their Windows-1252 superset
+        self.assertTrue(self.parse('04-cp1252-labelled-latin1.eml')['body_text'].startswith(
+            '“Thanks for the update” – we’ll'
+        ))
+        self.assertIn('Grüße aus München', self.parse('05-utf8-no-charset.eml')['body_text'])
+        fields = self.parse('06-koi8r-labelled-utf8.eml')
+        self.assertEqual(fields['subject'], 'Отчёт за апрель')
+        self.assertTrue(fields['body_text'].startswith('Добрый день! Отчёт за апрель'))
+        self.assertIn('議事録を送付', self.parse('07-shiftjis-html.eml')['body_html'])
+
+    def test_entities_only_unescaped_in_text_from_html(self):
+        fields = self.parse('10-notification-entities.eml')
+        self.assertIn('escaping of &amp; and &lt;tag&gt;', fields['body_text'])
+        # The HTML body is stored as markup
+        fields = self.parse('02-newsletter-alternative.eml')
+        self.assertIn('&copy;', fields['body_html'])
+        self.assertNotIn('©', fields['body_html'])
+        # The text of an HTML-only message comes from its HTML body
+        fields = self.parse('07-shiftjis-html.eml')
+        self.assertTrue(fields['body_text'].startswith('いつもお世話になっております。第0回'))
+        self.assertNotIn('<p>', fields['body_text'])
+        self.assertEqual(
+            html_to_text('<style>p {}</style><p>Fish &amp; chips</p><p>Today<br>only</p>'),
+            'Fish & chips\nToday\nonly'
+        )
+
+    def test_guess_legacy_charset(self):
+        russian = 'Привет, как дела? Отчёт за апрель готов.'
+        self.assertEqual(guess_legacy_charset(russian.encode('koi8-r')), 'koi8-r')
+        self.assertEqual(guess_legacy_charset(russian.encode('windows-1251')), 'windows-1251')
+        french = 'Café crème, déjà vu « naïve » à Noël.'
+        self.assertEqual(guess_legacy_charset(french.encode('windows-1252')), 'windows-1252')
+        # Left to the detector
+        self.assertIsNone(guess_legacy_charset('議事録を送付いたします。'.encode('shift_jis')))
+        self.assertIsNone(guess_legacy_charset(b'plain ASCII'))
+
+    def test_decode_text(self):
+        self.assertEqual(decode_text(b''), '')
+        self.assertEqual(decode_text('café'.encode('utf-8'), 'x-unknown'), 'café')
+        self.assertEqual(decode_text('café'.encode('utf-8'), 'us-ascii'), 'café')
+
+    def test_transfer_decoder(self):
+        data = bytes(range(256)) * 40
+        for encoding, encoded in (
+            ('base64', base64.encodebytes(data)),
+            ('quoted-printable', quopri.encodestring(data)),
+        ):
+            decoder = TransferDecoder(encoding)
+            chunks = [decoder.feed(encoded[i:i + 1000]) for i in range(0, len(encoded), 1000)]
+            self.assertEqual(b''.join(chunks) + decoder.flush(), data)
+
+
+class ParsePipelineTests(TransactionTestCase):
+    """Messages parsed in worker processes are stored like those parsed inline
+
+    The writer thread needs the test data committed.
+    """
+
+    def setUp(self):
+        self.user, self.server = create_account()
+
+    def messages(self):
+        return [
+            build_mail_message(uid, ('\\Seen',), len(raw), raw)
+            for uid, raw in enumerate(map(read_eml, sorted(os.listdir(EML_DIR))), 1)
+        ]
+
+    def stored(self, **filters):
+        return [
+            (e.folder, e.message_id, e.subject, e.flags, e.body_pending, e.body_text,
+             e.body_html, e.raw_message, e.thread_id,
+             list(e.attachments.values_list('part', 'filename', 'size')))
+            for e in Email.objects.filter(**filters).order_by('folder', 'date', 'message_id')
+        ]
+
+    def test_worker_processes(self):
+        messages = self.messages()
+        executor = create_executor(2)
+        try:
+            for folder, parse_executor in (('inline', None), ('workers', executor)):
+                with EmailWriter(batch_size=4) as writer:
+                    # Fewer pending messages than the corpus, adding has to wait
+                    with ParsePipeline(SyncCommand(), writer, parse_executor, max_pending=3) as pipeline:
+                        for msg in messages:
+                            pipeline.add(msg, self.server, folder, body_pending=msg.uid == '2')
+                        pipeline.drain()
+        finally:
+            executor.shutdown()
+
+        workers = [row[1:] for row in self.stored(folder='workers')]
+        self.assertEqual(len(workers), len(messages))
+        self.assertEqual(workers, [row[1:] for row in self.stored(folder='inline')])
+        self.assertEqual(Attachment.objects.filter(email__folder='workers').count(), 2)
+
+    def test_failed_flush_raised_by_drain(self):
+        executor = create_executor(1)
+        self.addCleanup(executor.shutdown)
+        writer = EmailWriter(batch_size=2)
+        pipeline = ParsePipeline(SyncCommand(), writer, executor, max_pending=2)
+        with mock.patch.object(EmailWriter, '_write', side_effect=Exception('database gone')):
+            with self.assertRaisesMessage(Exception, 'database gone'):
+                for msg in self.messages():
+                    pipeline.add(msg, self.server, 'INBOX')
+                pipeline.drain()
+        self.assertIsNone(pipeline._thread)
+        self.assertFalse(Email.objects.exists())
+
+    def test_engines_store_the_same_emails(self):
+        imap = FakeIMAPServer(folders=('Archive', 'INBOX'))
+        self.addCleanup(imap.stop)
+        sources = [read_eml(name) for name in sorted(os.listdir(EML_DIR))]
+        for name, folder in imap.folders.items():
+            for i, source in enumerate(sources * 2):
+                folder.add(source, flags=('\\Seen',) if i % 3 == 0 else ())
+        self.user.delete()
+
+        for fetch_mode in ('full', 'headers_first'):
+            results = []
+            for engine in ('threads', 'async'):
+                for parse_workers in (0, 2):
+                    create_account(
+                        fetch_mode=fetch_mode, max_body_size=5000, **imap.account_fields()
+                    )
+                    call_command(
+                        'sync_emails', engine=engine, parse_workers=parse_workers,
+                        queue_size=7, batch_size=5, stdout=io.StringIO(), stderr=io.StringIO()
+                    )
+                    results.append(self.stored())
+                    User.objects.all().delete()
+            with self.subTest(fetch_mode=fetch_mode):
+                self.assertEqual(len(results[0]), len(imap.folders) * 2 * len(sources))
+                for result in results[1:]:
+                    self.assertEqual(result, results[0])
+
+
+class EmailWriterTests(AccountTestMixin, TestCase):
+    """Emails are upserted in batches, a failed batch stays queued"""
+
+    def email(self, uid, subject='Message'):
+        message = EmailMessage()
+        message['Subject'] = subject
+        message.set_content('See attached')
+        message.add_attachment(b'data', maintype='application', subtype='pdf', filename='a.pdf')
+        email_obj = Email(
+            user=self.user, imap_server=self.server, message_id=str(uid), folder='INBOX',
+            subject=subject, sender='sender@example.com', recipient='reader@example.com',
+            date=timezone.now(), body_text='See attached', raw_message=message.as_bytes(),
+        )
+        email_obj.pending_attachments = attachments_of(email.message_from_bytes(message.as_bytes()))
+        return email_obj
+
+    def test_inserted_and_updated_counts(self):
+        writer = EmailWriter()
+        writer.add(self.email(1))
+        writer.add(self.email(2))
+        writer.flush()
+        self.assertEqual(writer.stats, {'inserted': 2, 'updated': 0})
+        writer.add(self.email(2, subject='Edited'))
+        writer.add(self.email(3))
+        writer.add(self.email(3, subject='Replaced before the flush'))
+        writer.flush()
+        self.assertEqual(writer.stats, {'inserted': 3, 'updated': 1})
+        self.assertEqual(
+            list(Email.objects.order_by('message_id').values_list('subject', flat=True)),
+            ['Message', 'Edited', 'Replaced before the flush']
+        )
+
+    def test_failed_flush_keeps_emails(self):
+        writer = EmailWriter()
+        writer.add(self.email(1))
+        writer.add(self.email(2))
+        with mock.patch('emails.writer.index_emails', side_effect=Exception('disk full')):
+            with self.assertRaises(Exception):
+                writer.flush()
+        self.assertFalse(Email.objects.exists())
+        self.assertEqual(writer.stats, {'inserted': 0, 'updated': 0})
+
+        writer.flush()
+        self.assertEqual(writer.stats, {'inserted': 2, 'updated': 0})
+        self.assertEqual(Attachment.objects.filter(filename='a.pdf').count(), 2)
+        self.assertEqual(Email.objects.get(message_id='1').body_text, 'See attached')
+
+
+class ThreadingTests(AccountTestMixin, TestCase):
+    """Emails are threaded by their ancestry whatever order they arrive in"""
+
+    def test_resolver_links_ancestry(self):
+        resolver = ThreadResolver()
+        # Replies before the messages they reply to
+        resolver.add('<c>', ['<a>', '<b>'])
+        resolver.add('<b>', ['<a>'])
+        self.assertEqual(resolver.root('<c>'), '<a>')
+        resolver.add('<a>', [])
+        self.assertEqual({resolver.root(m) for m in ('<a>', '<b>', '<c>')}, {'<a>'})
+        # Unrelated messages keep their own thread
+        resolver.add('<x>', [])
+        self.assertEqual(resolver.root('<x>'), '<x>')
+
+    def test_resolver_merges_stored_threads(self):
+        resolver = ThreadResolver()
+        resolver.add_stored('<a>', '<a>')
+        resolver.add_stored('<b>', '<b>')
+        resolver.add_stored('<c>', '<b>')
+        self.assertEqual(resolver.root('<c>'), '<b>')
+        # <b> turns out to be a reply to <a>
+        resolver.add('<d>', ['<a>', '<b>'])
+        self.assertEqual({resolver.root(m) for m in ('<a>', '<b>', '<c>', '<d>')}, {'<a>'})
+
+    def write(self, *messages):
+        with EmailWriter() as writer:
+            for message_id, references in messages:
+                *_, parent = [''] + references.split()
+                writer.add(Email(
+                    user=self.user, imap_server=self.server, message_id=message_id,
+                    folder='INBOX', subject=f'Message {message_id}', sender='sender@example.com',
+                    recipient='reader@example.com', date=timezone.now(),
+                    rfc_message_id=f'<{message_id}@example.com>',
+                    references=' '.join(f'<{m}@example.com>' for m in references.split()),
+                    in_reply_to=f'<{parent}@example.com>' if parent else '',
+                ))
+
+    def threads(self):
+        return {
+            thread.thread_id: (thread.message_count, thread.root.message_id)
+            for thread in Thread.objects.filter(user=self.user).select_related('root')
+        }
+
+    def test_reference_chain_before_its_root(self):
+        self.write(('c', 'a b'))
+        self.assertEqual(self.threads(), {'<a@example.com>': (1, 'c')})
+        self.write(('b', 'a'))
+        self.write(('a', ''))
+        self.assertEqual(self.threads(), {'<a@example.com>': (3, 'c')})
+        self.assertEqual(set(Email.objects.values_list('thread_id', flat=True)), {'<a@example.com>'})
+
+    def test_reply_merges_existing_threads(self):
+        self.write(('a', ''), ('b', ''))
+        self.write(('a2', 'a'), ('b2', 'b'))
+        self.assertEqual(len(self.threads()), 2)
+        # Its references show that b replied to a
+        self.write(('b3', 'a b'))
+        self.assertEqual(self.threads(), {'<a@example.com>': (5, 'a')})
+        self.assertEqual(set(Email.objects.values_list('thread_id', flat=True)), {'<a@example.com>'})
+
+    def test_email_list_shows_latest_matching_email(self):
+        day = datetime.timedelta(days=1)
+        start = timezone.now() - 10 * day
+        with EmailWriter() as writer:
+            for message_id, parent, folder, date in (
+                ('a', '', 'INBOX', start), ('a2', 'a', 'INBOX', start + day),
+                ('a3', 'a2', 'Sent', start + 2 * day), ('x', '', 'INBOX', start),
+                ('b', '', 'INBOX', start), ('b2', 'b', 'INBOX', start),
+            ):
+                writer.add(Email(
+                    user=self.user, imap_server=self.server, message_id=message_id,
+                    folder=folder, subject=f'Message {message_id}', sender='sender@example.com',
+                    recipient='reader@example.com', date=date,
+                    rfc_message_id=f'<{message_id}@example.com>',
+                    in_reply_to=f'<{parent}@example.com>' if parent else '',
+                ))
+        self.client.force_login(self.user)
+
+        def shown(**params):
+            response = self.client.get(reverse('email_list'), {'show_threads': 'on', **params})
+            return {e.message_id for e in response.context['emails']}
+        self.assertEqual(shown(), {'a3', 'b2', 'x'})
+        # The thread's last email is in another folder
+        self.assertEqual(shown(folder='INBOX'), {'a2', 'b2', 'x'})
+        self.assertEqual(shown(folder='Sent'), {'a3'})
+        self.assertEqual(shown(folder='INBOX', q='message'), {'a2', 'b2', 'x'})
+
+    def test_admin_list_counts_threads_without_query_per_email(self):
+        self.user.is_staff = self.user.is_superuser = True
+        self.user.save()
+        self.client.force_login(self.user)
+        url = reverse('admin:emails_email_changelist')
+        self.write(('a', ''), ('a2', 'a'))
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertContains(response, 'Thread (2 messages)', count=2)
+
+        self.write(('b', ''), ('b2', 'b'), ('b3', 'b2'))
+        with self.assertNumQueries(len(queries)):
+            response = self.client.get(url)
+        self.assertContains(response, 'Thread (3 messages)', count=3)
+
+
+class MailboxStatsTests(AccountTestMixin, TestCase):
+    """The writer keeps the per-folder counters in step with the emails"""
+
+    def write(self, uid, folder='INBOX', flags='', size=100):
+        with EmailWriter() as writer:
+            writer.add(Email(
+                user=self.user, imap_server=self.server, message_id=str(uid),
+                folder=folder, subject=f'Message {uid}', sender='sender@example.com',
+                recipient='reader@example.com', date=timezone.now(), flags=flags, size=size,
+            ))
+
+    def counters(self):
+        return sorted(
+            MailboxStats.objects.filter(user=self.user)
+            .values_list('folder', 'message_count', 'unread_count', 'total_size')
+        )
+
+    def test_counters_follow_writes_and_deletes(self):
+        self.write(1)
+        self.write(2, flags='\\Seen')
+        self.write(3, folder='Sent', flags='\\Seen', size=50)
+        # Updating a stored message replaces its contribution
+        self.write(1, flags='\\Flagged \\Seen', size=120)
+        delete_emails(Email.objects.filter(message_id='2'))
+        self.assertEqual(self.counters(), [('INBOX', 1, 0, 120), ('Sent', 1, 0, 50)])
+
+        expected = self.counters()
+        rebuild_stats(self.user)
+        self.assertEqual(self.counters(), expected)
+
+
+class SyncTests(TestCase):
+    """The sync only downloads what changed since the stored folder position"""
+
+    def setUp(self):
+        self.imap = FakeIMAPServer()
+        self.addCleanup(self.imap.stop)
+        self.inbox = self.imap.folders['INBOX']
+        self.user, self.server = create_account(**self.imap.account_fields())
+
+    def sync(self, **options):
+        call_command('sync_emails', stdout=io.StringIO(), stderr=io.StringIO(), **options)
+
+    def stored(self):
+        return list(
+            Email.objects.filter(folder='INBOX').order_by('message_id')
+            .values_list('message_id', 'subject', 'flags')
+        )
+
+    def fetched_uids(self):
+        """UIDs of every message downloaded since the last call."""
+        fetches = [c for c in self.imap.commands if c.startswith('UID_FETCH') and 'BODY' in c]
+        self.imap.commands.clear()
+        return [c.split()[1] for c in fetches]
+
+    def test_first_sync(self):
+        self.inbox.add(make_message('First'), flags=['\\Seen'])
+        self.inbox.add(make_message('Second'))
+        self.sync()
+        self.assertEqual(self.stored(), [('1', 'First', '\\Seen'), ('2', 'Second', '')])
+        state = FolderSyncState.objects.get(imap_server=self.server, folder='INBOX')
+        self.assertEqual((state.uidvalidity, state.last_uid), (1, 2))
+
+    def test_progress_reported_per_stored_chunk(self):
+        for i in range(5):
+            self.inbox.add(make_message(f'Message {i}'))
+        command = SyncCommand()
+        command.batch_size = 2
+        reports = []
+        command.sync_server(self.server, progress=lambda *args: reports.append(args))
+        # A long folder keeps its sync job alive before it is done
+        self.assertEqual(reports, [(0, 1, 0), (0, 1, 2), (0, 1, 4), (0, 1, 5), (1, 1, 5)])
+
+    def test_incremental_sync(self):
+        self.inbox.add(make_message('First'))
+        self.sync()
+        self.fetched_uids()
+
+        self.inbox.add(make_message('Second'))
+        self.inbox.add(make_message('Third'))
+        self.sync()
+        self.assertEqual(self.fetched_uids(), ['2,3'])
+        self.assertEqual([e[1] for e in self.stored()], ['First', 'Second', 'Third'])
+
+        # Nothing new, nothing downloaded
+        self.sync()
+        self.assertEqual(self.fetched_uids(), [])
+        self.assertEqual(FolderSyncState.objects.get(folder='INBOX').last_uid, 3)
+
+    def test_last_n_fetches_newest_messages(self):
+        self.server.sync_limit_type = 'last_n'
+        self.server.sync_limit_value = 2
+        self.server.save()
+        for subject in ('First', 'Second', 'Third', 'Fourth'):
+            self.inbox.add(make_message(subject))
+        self.sync()
+        # Older messages are never downloaded, not downloaded and dropped
+        self.assertEqual(self.fetched_uids(), ['3,4'])
+        self.assertEqual([e[1] for e in self.stored()], ['Third', 'Fourth'])
+
+        self.inbox.add(make_message('Fifth'))
+        self.sync()
+        self.assertEqual(self.fetched_uids(), ['5'])
+
+    def test_unchanged_folder_keeps_cache_generation(self):
+        self.inbox.add(make_message('First'))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.sync()
+        before = generation(self.user.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.sync()
+        self.assertEqual(generation(self.user.id), before)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.inbox.set_flags(1, ['\\Seen'])
+            self.sync()
+        self.assertGreater(generation(self.user.id)[0], before[0])
+
+    def test_uidvalidity_change_resyncs(self):
+        for subject in ('First', 'Second', 'Third'):
+            self.inbox.add(make_message(subject))
+        self.sync()
+        self.inbox.expunge(1)
+        self.inbox.reset(uidvalidity=2)
+        self.fetched_uids()
+
+        self.sync()
+        self.assertEqual(self.fetched_uids(), ['1,2'])
+        self.assertEqual(self.stored(), [('1', 'Second', ''), ('2', 'Third', '')])
+        state = FolderSyncState.objects.get(folder='INBOX')
+        self.assertEqual((state.uidvalidity, state.last_uid), (2, 2))
+
+    def test_reconcile_flags_and_expunged_messages(self):
+        for subject in ('First', 'Second', 'Third'):
+            self.inbox.add(make_message(subject))
+        self.sync()
+        self.inbox.set_flags(3, ['\\Seen'])
+        self.inbox.expunge(1)
+        self.inbox.expunge(2)
+        self.inbox.add(make_message('Fourth'))
+        self.imap.commands.clear()
+
+        self.sync()
+        self.assertIn('UID_FETCH 1:3 (UID FLAGS)', self.imap.commands)
+        self.assertEqual(self.stored(), [('3', 'Third', '\\Seen'), ('4', 'Fourth', '')])
+        stats = MailboxStats.objects.get(folder='INBOX')
+        self.assertEqual((stats.message_count, stats.unread_count), (2, 1))
+        self.assertEqual(Thread.objects.filter(user=self.user).count(), 2)
+
+    def test_flags_refreshed_with_condstore(self):
+        self.imap.condstore = True
+        for subject in ('First', 'Second', 'Third'):
+            self.inbox.add(make_message(subject))
+        self.sync()
+        self.inbox.set_flags(1, ['\\Seen', '\\Flagged'])
+        self.inbox.expunge(2)
+        self.imap.commands.clear()
+
+        self.sync()
+        self.assertEqual(self.stored(), [('1', 'First', '\\Flagged \\Seen'), ('3', 'Third', '')])
+        flag_fetches = [c for c in self.imap.commands if c.startswith('UID_FETCH')]
+        self.assertEqual(flag_fetches, ['UID_FETCH 1:3 (UID FLAGS) (CHANGEDSINCE 4)'])
+        state = FolderSyncState.objects.get(folder='INBOX')
+        self.assertEqual(state.highestmodseq, self.inbox.modseq)
+
+        # An unchanged mod-sequence skips the flag fetch
+        self.imap.commands.clear()
+        self.sync()
+        self.assertFalse([c for c in self.imap.commands if c.startswith('UID_FETCH')])
+
+    def test_headers_first_single_message(self):
+        self.server.fetch_mode = 'headers_first'
+        self.server.save()
+        self.inbox.add(make_message('Only', body='Small body'))
+        self.sync()
+        email_obj = Email.objects.get()
+        self.assertFalse(email_obj.body_pending)
+        self.assertEqual(email_obj.body_text.strip(), 'Small body')
+        self.assertEqual(self.fetched_uids(), ['1', '1'])
+
+    def test_failed_flush_retried_by_next_sync(self):
+        self.inbox.add(make_message('First'))
+        self.inbox.add(make_message('Second'))
+        with mock.patch('emails.writer.index_emails', side_effect=Exception('disk full')):
+            self.sync()
+        self.assertFalse(Email.objects.exists())
+        self.assertEqual(FolderSyncState.objects.get(folder='INBOX').last_uid, 0)
+
+        self.sync()
+        self.assertEqual([e[1] for e in self.stored()], ['First', 'Second'])
+        self.assertEqual(FolderSyncState.objects.get(folder='INBOX').last_uid, 2)
+
+
+class ParallelSyncTests(TransactionTestCase):
+    """Parallel syncs stay within the connection limits of a host
+
+    Worker threads need the test data committed.
+    """
+
+    def setUp(self):
+        # Slow responses make concurrent syncs overlap
+        self.imap = FakeIMAPServer(folders=('Archive', 'INBOX', 'Sent'), latency=0.02)
+        self.addCleanup(self.imap.stop)
+
+    def sync(self, **options):
+        call_command('sync_emails', stdout=io.StringIO(), stderr=io.StringIO(), **options)
+
+    def fetched_uids(self):
+        return sorted(
+            c.split()[1] for c in self.imap.commands
+            if c.startswith('UID_FETCH') and 'BODY' in c
+        )
+
+    def test_workers_limited_per_host(self):
+        inbox = self.imap.folders['INBOX']
+        inbox.add(make_message('First'))
+        inbox.add(make_message('Second'))
+        for username in ('ann', 'bob', 'cid'):
+            create_account(username=username, **self.imap.account_fields())
+
+        self.sync(workers=3, per_host=2)
+        self.assertEqual(self.imap.peak_sessions, 2)
+        self.assertEqual(self.fetched_uids(), ['1,2'] * 3)
+        self.assertEqual(
+            sorted(Email.objects.values_list('imap_server__user__username', 'subject')),
+            [(username, subject) for username in ('ann', 'bob', 'cid')
+             for subject in ('First', 'Second')]
+        )
+
+
+    def test_folders_spread_over_max_connections(self):
+        for folder in self.imap.folders.values():
+            folder.add(make_message('Only'))
+        _, server = create_account(max_connections=2, **self.imap.account_fields())
+
+        # The host would allow three connections, the server setting only two
+        self.sync(per_host=3)
+        self.assertEqual(self.imap.peak_sessions, 2)
+        self.assertEqual(self.fetched_uids(), ['1', '1', '1'])
+        self.assertEqual(
+            sorted(Email.objects.filter(imap_server=server).values_list('folder', flat=True)),
+            ['Archive', 'INBOX', 'Sent']
+        )
+
+class IdleWatcherTests(TransactionTestCase):
+    """imap_idle watches the folders the server's selection lets through"""
+
+    def test_excluded_folder_not_watched(self):
+        imap = FakeIMAPServer(folders=('Archive', 'INBOX'))
+        self.addCleanup(imap.stop)
+        _, server = create_account(folders_to_sync='Archive', **imap.account_fields())
+        command = IdleCommand()
+        command.folders = ['INBOX']
+        command.sync = SyncCommand()
+        command.pool = IMAPConnectionPool(command.sync._connect)
+        command.stop_event = threading.Event()
+
+        ServerWatcher(command, server.id).run()
+        self.assertEqual(imap.commands, [])
+
+
+class AsyncSyncTests(TransactionTestCase):
+    """The async engine stores the same emails and survives failing folders
+
+    Its database thread needs the test data committed.
+    """
+
+    def setUp(self):
+        self.imap = FakeIMAPServer(folders=('Archive', 'INBOX'))
+        self.addCleanup(self.imap.stop)
+        self.inbox = self.imap.folders['INBOX']
+        self.user, self.server = create_account(**self.imap.account_fields())
+
+    def sync(self, **options):
+        stderr = io.StringIO()
+        call_command(
+            'sync_emails', engine='async', stdout=io.StringIO(), stderr=stderr, **options
+        )
+        return stderr.getvalue()
+
+    def test_headers_first_without_size_limit(self):
+        self.server.fetch_mode = 'headers_first'
+        self.server.save()
+        self.inbox.add(make_message('First', body='Full body'))
+        self.sync()
+        email_obj = Email.objects.get()
+        self.assertFalse(email_obj.body_pending)
+        self.assertEqual(email_obj.body_text.strip(), 'Full body')
+
+    def test_folder_timeout_skips_folder(self):
+        self.imap.folders['Archive'].add(make_message('Archived'))
+        self.inbox.add(make_message('First'))
+        select = AsyncIMAPClient.select
+
+        async def slow_archive(client, folder, readonly=True):
+            if folder == 'Archive':
+                raise asyncio.TimeoutError()
+            return await select(client, folder, readonly)
+
+        with mock.patch.object(AsyncIMAPClient, 'select', slow_archive):
+            self.assertEqual(self.sync(), '')
+        self.assertEqual(list(Email.objects.values_list('folder', 'subject')), [('INBOX', 'First')])
+
+    def test_consumer_failure_releases_producers(self):
+        for i in range(5):
+            self.inbox.add(make_message(f'Message {i}'))
+        with mock.patch.object(
+            AsyncSyncEngine, '_save_items', side_effect=Exception('database gone')
+        ):
+            # The queue holds one message, the producer is blocked on it
+            stderr = self.sync(queue_size=1)
+        self.assertIn('Sync failed: database gone', stderr)
+        self.assertFalse(Email.objects.exists())
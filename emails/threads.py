@@ -0,0 +1,301 @@
+"""Threading of emails and maintenance of the materialized Thread table.
+
+Emails are grouped into threads by their Message-ID, References and
+In-Reply-To headers, in the spirit of the JWZ algorithm: every message id
+links to its ancestors, and the thread is named after the topmost
+ancestor. Messages whose ancestors arrive later are re-parented once the
+missing link shows up.
+
+Thread rows are recomputed from their emails whenever the sync writes,
+reconciles or deletes emails of a thread, so listings and counts can read
+a single indexed table.
+"""
+import logging
+import re
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from .cache import bump_generation
+from .models import Email, Thread
+from .stats import StatsDelta
+
+logger = logging.getLogger(__name__)
+
+# Thread ids refreshed per query
+REFRESH_CHUNK_SIZE = 500
+
+# Fields rewritten when a thread is recomputed
+UPDATE_FIELDS = [
+    'root', 'subject', 'participants', 'folders', 'message_count',
+    'first_date', 'last_date', 'updated_at',
+]
+
+ADDRESS_RE = re.compile(r'[\w.+=-]+@[\w-]+(?:\.[\w-]+)+')
+MESSAGE_ID_RE = re.compile(r'<[^<>\s]+>')
+
+# Columns read to summarize a thread, in date order
+SUMMARY_FIELDS = ('id', 'thread_id', 'subject', 'sender', 'recipient', 'folder', 'date')
+
+
+def parse_message_ids(value):
+    """Return the ``<id>`` tokens of a Message-ID, References or In-Reply-To header."""
+    return MESSAGE_ID_RE.findall(value or '')[:100]
+
+
+def thread_key(email_obj):
+    """Name of the email in the thread graph: its Message-ID or a local stand-in."""
+    if email_obj.rfc_message_id:
+        return email_obj.rfc_message_id
+    return f'<{email_obj.imap_server_id}.{email_obj.message_id}.{email_obj.folder}@local>'
+
+
+def ancestors(email_obj):
+    """Message ids of the email's ancestors, oldest first."""
+    refs = parse_message_ids(email_obj.references)
+    for parent in parse_message_ids(email_obj.in_reply_to)[:1]:
+        if parent not in refs:
+            refs.append(parent)
+    return refs
+
+
+class ThreadResolver:
+    """Union-find over message ids linked by their ancestry.
+
+    Each connected group of ids is one thread, named after its root: an id
+    not known to have a parent. When several ids qualify, because headers
+    were incomplete, the smallest one is used so every run agrees.
+    """
+
+    def __init__(self):
+        self._parent = {}
+        self._has_parent = set()
+        self._roots = None
+
+    def _find(self, name):
+        self._parent.setdefault(name, name)
+        root = name
+        while self._parent[root] != root:
+            root = self._parent[root]
+        while self._parent[name] != root:
+            self._parent[name], name = root, self._parent[name]
+        return root
+
+    def _union(self, a, b):
+        self._parent[self._find(a)] = self._find(b)
+        self._roots = None
+
+    def add(self, name, refs):
+        """Add a message and the ids of its ancestors, oldest first."""
+        self._find(name)
+        chain = refs + [name]
+        for parent, child in zip(chain, chain[1:]):
+            if parent == child:
+                continue
+            self._union(child, parent)
+            self._has_parent.add(child)
+        self._roots = None
+
+    def add_stored(self, name, thread_id):
+        """Add a message already stored in the given thread."""
+        self._find(name)
+        if thread_id and thread_id != name:
+            self._union(name, thread_id)
+            self._has_parent.add(name)
+        self._roots = None
+
+    def root(self, name):
+        """Thread id of the message id."""
+        if self._roots is None:
+            groups = defaultdict(list)
+            for member in self._parent:
+                groups[self._find(member)].append(member)
+            self._roots = {}
+            for group, members in groups.items():
+                candidates = [m for m in members if m not in self._has_parent]
+                self._roots[group] = min(candidates or members)
+        return self._roots[self._find(name)]
+
+
+def resolve_thread_ids(emails):
+    """Set ``thread_id`` on unsaved emails and re-parent stored ones.
+
+    Ancestors are looked up by the indexed Message-ID, threads started by
+    messages that turn out to have a parent are merged into the parent's
+    thread. Returns ``{user_id: thread_ids}`` of stored threads that
+    changed, so their summaries can be refreshed.
+    """
+    by_user = defaultdict(list)
+    for e in emails:
+        by_user[e.user_id].append(e)
+
+    changed = {}
+    for user_id, user_emails in by_user.items():
+        resolver = ThreadResolver()
+        links = [(e, thread_key(e), ancestors(e)) for e in user_emails]
+        names = set()
+        for _, name, refs in links:
+            names.add(name)
+            names.update(refs)
+
+        stored_threads = set()
+        for name, thread_id in _in_chunks(
+            names,
+            lambda chunk: Email.objects
+            .filter(user_id=user_id, rfc_message_id__in=chunk)
+            .values_list('rfc_message_id', 'thread_id')
+        ):
+            resolver.add_stored(name, thread_id)
+            if thread_id:
+                stored_threads.add(thread_id)
+
+        # Threads named after one of these ids, started by an earlier orphan
+        stored_threads.update(_in_chunks(
+            names | stored_threads,
+            lambda chunk: Email.objects
+            .filter(user_id=user_id, thread_id__in=chunk)
+            .values_list('thread_id', flat=True)
+            .distinct()
+        ))
+
+        for _, name, refs in links:
+            resolver.add(name, refs)
+        for e, name, _ in links:
+            e.thread_id = resolver.root(name)
+
+        moves = defaultdict(list)
+        for thread_id in stored_threads:
+            if thread_id and resolver.root(thread_id) != thread_id:
+                moves[resolver.root(thread_id)].append(thread_id)
+        for target, thread_ids in moves.items():
+            Email.objects.filter(
+                user_id=user_id, thread_id__in=thread_ids
+            ).update(thread_id=target)
+            logger.debug(f"Merged threads {thread_ids} into {target}")
+        changed[user_id] = set(moves) | set(t for ts in moves.values() for t in ts)
+    return changed
+
+
+def _in_chunks(values, query):
+    values = sorted(values)
+    for i in range(0, len(values), REFRESH_CHUNK_SIZE):
+        yield from query(values[i:i + REFRESH_CHUNK_SIZE])
+
+
+def annotate_thread_count(emails):
+    """Annotate an Email queryset with ``thread_count`` read from Thread."""
+    return emails.annotate(
+        thread_count=Coalesce(
+            Subquery(
+                Thread.objects
+                .filter(user_id=OuterRef('user_id'), thread_id=OuterRef('thread_id'))
+                .values('message_count')[:1]
+            ),
+            Value(1)
+        )
+    )
+
+
+def thread_members(user_id, thread_ids):
+    """Load the emails of several threads with their bodies in one query,
+    grouped by thread_id."""
+    members = defaultdict(list)
+    thread_ids = set(t for t in thread_ids if t)
+    if thread_ids:
+        emails = (
+            Email.objects
+            .filter(user_id=user_id, thread_id__in=thread_ids)
+            .select_related('body__text', 'body__html')
+            .order_by('date', 'id')
+        )
+        for email_obj in emails:
+            members[email_obj.thread_id].append(email_obj)
+    return members
+
+
+def refresh_threads(user_id, thread_ids):
+    """Recompute the Thread rows of the user's given thread ids.
+
+    Threads without emails left are deleted.
+    """
+    thread_ids = sorted(set(t for t in thread_ids if t))
+    for i in range(0, len(thread_ids), REFRESH_CHUNK_SIZE):
+        chunk = thread_ids[i:i + REFRESH_CHUNK_SIZE]
+        rows = (
+            Email.objects
+            .filter(user_id=user_id, thread_id__in=chunk)
+            .order_by('thread_id', 'date', 'id')
+            .values_list(*SUMMARY_FIELDS)
+        )
+        threads = list(summarize_threads(user_id, rows))
+        found = set(t.thread_id for t in threads)
+        with transaction.atomic():
+            save_threads(threads)
+            Thread.objects.filter(
+                user_id=user_id,
+                thread_id__in=[t for t in chunk if t not in found]
+            ).delete()
+
+
+def summarize_threads(user_id, rows):
+    """Build unsaved Threads from email rows ordered by thread_id and date.
+
+    ``rows`` are tuples of ``SUMMARY_FIELDS``.
+    """
+    current = None
+    for email_id, thread_id, subject, sender, recipient, folder, date in rows:
+        if current is None or current.thread_id != thread_id:
+            if current is not None:
+                yield _finish(current)
+            current = Thread(
+                user_id=user_id,
+                thread_id=thread_id,
+                root_id=email_id,
+                subject=subject,
+                first_date=date,
+            )
+            current.participants = set()
+            current.folders = set()
+        current.message_count += 1
+        current.last_date = date
+        current.participants.update(a.lower() for a in ADDRESS_RE.findall(sender))
+        current.participants.update(a.lower() for a in ADDRESS_RE.findall(recipient))
+        current.folders.add(folder)
+    if current is not None:
+        yield _finish(current)
+
+
+def _finish(thread):
+    thread.participants = sorted(thread.participants)
+    thread.folders = sorted(thread.folders)
+    return thread
+
+
+def save_threads(threads):
+    """Upsert computed threads."""
+    if threads:
+        Thread.objects.bulk_create(
+            threads,
+            update_conflicts=True,
+            unique_fields=['user', 'thread_id'],
+            update_fields=UPDATE_FIELDS,
+        )
+
+
+def delete_emails(emails):
+    """Delete a queryset of emails, refreshing the threads they belonged to
+    and the statistics of their folders."""
+    affected = {}
+    for user_id, thread_id in emails.values_list('user_id', 'thread_id').distinct():
+        affected.setdefault(user_id, set()).add(thread_id)
+    with transaction.atomic():
+        stats = StatsDelta()
+        stats.remove_queryset(emails)
+        deleted, _ = emails.delete()
+        for user_id, thread_ids in affected.items():
+            refresh_threads(user_id, thread_ids)
+        stats.save()
+        bump_generation(affected)
+    return deleted
@@ -1,9 +1,11 @@
 from django.shortcuts import render
 from django.contrib.auth.decorators import login_required
 from django.utils import timezone
-from django.db.models import Q, Count, Max, F
+from django.db.models import Exists, OuterRef, Q, Subquery
 from datetime import datetime
-from .models import IMAPServer, Email
+from .models import IMAPServer, Email, Thread
+from .search import search_emails
+from .threads import annotate_thread_count
 
 @login_required
 def email_list(request):
@@ -15,64 +17,55 @@ def email_list(request):
     date_to = request.GET.get('date_to')
     show_threads = request.GET.get('show_threads') == 'on'
 
-    # Base queryset
-    emails = Email.objects.filter(user=request.user)
+    # Base queryset, newest first unless a search ranks it
+    emails = Email.objects.filter(user=request.user).only(*Email.LIST_FIELDS).order_by('-date')
 
-    # Apply filters
+    # Apply filters, collected to also scope the thread grouping
+    scope = Q()
     if server_id:
-        emails = emails.filter(imap_server_id=server_id)
+        scope &= Q(imap_server_id=server_id)
     
     if folder:
-        emails = emails.filter(folder=folder)
-    
-    if search_query:
-        emails = emails.filter(
-            Q(subject__icontains=search_query) |
-            Q(sender__icontains=search_query) |
-            Q(recipient__icontains=search_query) |
-            Q(body_text__icontains=search_query)
-        )
+        scope &= Q(folder=folder)
     
     if date_from:
         try:
             date_from = datetime.strptime(date_from, '%Y-%m-%d')
-            emails = emails.filter(date__gte=date_from)
+            scope &= Q(date__gte=date_from)
         except ValueError:
             pass
     
     if date_to:
         try:
             date_to = datetime.strptime(date_to, '%Y-%m-%d')
-            emails = emails.filter(date__lte=date_to)
+            scope &= Q(date__lte=date_to)
         except ValueError:
             pass
 
+    emails = emails.filter(scope)
+
     # Handle thread grouping
     if show_threads:
-        # Get the latest email from each thread
-        thread_emails = emails.exclude(thread_id='').values('thread_id').annotate(
-            latest_date=Max('date'),
-            count=Count('id')
-        ).filter(count__gt=1)
-        
-        thread_ids = [t['thread_id'] for t in thread_emails]
-        
-        # Get the latest email from each thread and non-threaded emails
-        emails = (emails.filter(
-            Q(thread_id='') |  # Non-threaded emails
-            Q(thread_id__in=thread_ids, date__in=[t['latest_date'] for t in thread_emails])  # Latest from threads
-        ))
+        # Show the latest email of each thread among those matching the
+        # filters, and non-threaded emails
+        later = Email.objects.filter(
+            scope, user=request.user, thread_id=OuterRef('thread_id')
+        ).filter(Q(date__gt=OuterRef('date')) | Q(date=OuterRef('date'), id__gt=OuterRef('id')))
+        latest = ~Exists(later)
+        if not scope:
+            # Unfiltered, the latest email is dated like its thread's last
+            # one, which spares looking for later emails of every other
+            latest &= Q(date=Subquery(
+                Thread.objects.filter(user=request.user, thread_id=OuterRef('thread_id'))
+                .values('last_date')[:1]
+            ))
+        emails = emails.filter(Q(thread_id='') | Q(thread_id__isnull=True) | latest)
 
-    # Add thread count for display
-    emails = emails.annotate(
-        thread_count=Count(
-            'thread_id',
-            filter=Q(thread_id=F('thread_id')) & ~Q(thread_id='')
-        )
-    )
+    if search_query:
+        emails = search_emails(emails, search_query)
 
-    # Order by date
-    emails = emails.order_by('-date')
+    # Add thread count for display
+    emails = annotate_thread_count(emails)
 
     # Get all available folders for filtering
     folders = Email.objects.filter(
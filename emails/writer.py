@@ -0,0 +1,192 @@
+import logging
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+
+from .attachments import save_attachments
+from .cache import bump_generation
+from .models import Blob, Email, EmailBody
+from .search import index_emails
+from .stats import StatsDelta, is_unread
+from .threads import refresh_threads, resolve_thread_ids
+
+logger = logging.getLogger(__name__)
+
+# Fields rewritten when a synced message already exists locally
+UPDATE_FIELDS = [
+    'rfc_message_id', 'subject', 'sender', 'recipient', 'date', 'snippet',
+    'in_reply_to', 'references', 'thread_id', 'body_pending', 'size', 'flags',
+    'updated_at',
+]
+UNIQUE_FIELDS = ['user', 'imap_server', 'message_id', 'folder']
+BODY_UPDATE_FIELDS = ['text', 'html', 'raw']
+
+
+class EmailWriter:
+    """Buffers parsed emails and upserts them in chunks.
+
+    Each chunk is written with a single ``bulk_create(update_conflicts=True)``
+    inside its own transaction, instead of one ``update_or_create`` per
+    message, followed by one upsert of their EmailBody rows. Bodies already
+    in the blob store, like copies of a message in other folders, are not
+    written again. Thread ids are resolved for the whole chunk at once, and the
+    threads it touched, the search index and the mailbox statistics are
+    refreshed in the same transaction, and cached responses of the users
+    are invalidated once it commits. Use as a context manager or call ``flush()`` when done.
+    ``on_flush`` is called with the number of emails of every committed chunk.
+    """
+
+    def __init__(self, batch_size=None, on_flush=None):
+        self.batch_size = batch_size or getattr(settings, 'EMAIL_SYNC_BATCH_SIZE', 500)
+        self.on_flush = on_flush
+        self.inserted = 0
+        self.updated = 0
+        self._buffer = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    @staticmethod
+    def _key(email_obj):
+        return (
+            email_obj.user_id, email_obj.imap_server_id,
+            email_obj.message_id, email_obj.folder
+        )
+
+    def add(self, email_obj):
+        """Queue an unsaved Email, flushing once the batch is full."""
+        # A later copy of the same message replaces the queued one, a single
+        # upsert statement may not touch the same row twice.
+        self._buffer[self._key(email_obj)] = email_obj
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered emails in one transaction.
+
+        The buffer is only emptied once the transaction committed. When it
+        fails the emails stay queued and the error is raised, so the sync
+        does not advance past messages that were not stored.
+        """
+        if not self._buffer:
+            return
+        emails = list(self._buffer.values())
+
+        try:
+            existing = self._write(emails)
+        except Exception:
+            self._forget_rows(emails)
+            raise
+        self._buffer = {}
+        for e in emails:
+            e.pending_attachments = None
+
+        updated = sum(1 for e in emails if self._key(e) in existing)
+        self.inserted += len(emails) - updated
+        self.updated += updated
+        logger.debug(f"Flushed {len(emails)} emails ({updated} updated)")
+        if self.on_flush is not None:
+            self.on_flush(len(emails))
+
+    def clear(self):
+        """Drop the buffered emails without writing them."""
+        self._buffer = {}
+
+    def _write(self, emails):
+        """Upsert the emails and everything derived from them, returning
+        ``_existing_keys`` as it was before."""
+        with transaction.atomic():
+            existing = self._existing_keys(emails)
+            merged = resolve_thread_ids(emails)
+            Email.objects.bulk_create(
+                emails,
+                update_conflicts=True,
+                unique_fields=UNIQUE_FIELDS,
+                update_fields=UPDATE_FIELDS,
+            )
+            self._save_bodies(emails)
+            save_attachments(emails)
+            index_emails(emails)
+
+            # Threads gaining these emails, any they were moved out of, and
+            # threads merged while resolving
+            threads = defaultdict(set)
+            for user_id, thread_ids in merged.items():
+                threads[user_id].update(thread_ids)
+            stats = StatsDelta()
+            for e in emails:
+                threads[e.user_id].add(e.thread_id)
+                stats.add_email(e)
+                old = existing.get(self._key(e))
+                if old is not None:
+                    old_thread_id, old_flags, old_size = old
+                    threads[e.user_id].add(old_thread_id)
+                    stats.add(
+                        e.user_id, e.imap_server_id, e.folder,
+                        messages=-1, unread=-is_unread(old_flags), size=-old_size
+                    )
+            for user_id, thread_ids in threads.items():
+                refresh_threads(user_id, thread_ids)
+            stats.save()
+            bump_generation(set(e.user_id for e in emails))
+        return existing
+
+    @staticmethod
+    def _forget_rows(emails):
+        """Mark the rows of a rolled back write unsaved again, so the next
+        flush writes all of them."""
+        for e in emails:
+            for row in [e, *(getattr(e, 'pending_attachments', None) or ())]:
+                row.pk = None
+                row._state.adding = True
+            body = e._body()
+            for blob in body.loaded_blobs() if body is not None else ():
+                if blob is not None:
+                    blob._state.adding = True
+
+    def _save_bodies(self, emails):
+        """Store the new blobs of the emails just written and upsert their
+        EmailBody rows."""
+        bodies = []
+        for e in emails:
+            body = e._body(create=True)
+            body.email = e
+            bodies.append(body)
+        Blob.store(blob for body in bodies for blob in body.loaded_blobs())
+        EmailBody.objects.bulk_create(
+            bodies,
+            update_conflicts=True,
+            unique_fields=['email'],
+            update_fields=BODY_UPDATE_FIELDS,
+        )
+
+    def _existing_keys(self, emails):
+        """Map unique keys of the given emails already stored to their
+        ``(thread_id, flags, size)``."""
+        groups = defaultdict(list)
+        for e in emails:
+            groups[(e.user_id, e.imap_server_id, e.folder)].append(e.message_id)
+
+        query = Q()
+        for (user_id, server_id, folder), message_ids in groups.items():
+            query |= Q(
+                user_id=user_id, imap_server_id=server_id,
+                folder=folder, message_id__in=message_ids
+            )
+        return {
+            (user_id, server_id, message_id, folder): (thread_id, flags, size)
+            for user_id, server_id, message_id, folder, thread_id, flags, size
+            in Email.objects.filter(query).values_list(
+                'user_id', 'imap_server_id', 'message_id', 'folder', 'thread_id', 'flags', 'size'
+            )
+        }
+
+    @property
+    def stats(self):
+        return {'inserted': self.inserted, 'updated': self.updated}
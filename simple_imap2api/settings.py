@@ -4,6 +4,7 @@ Django settings for simple_imap2api project.
 
 from pathlib import Path
 from datetime import timedelta
+import importlib.util
 import os
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -75,6 +76,12 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        # Parallel sync workers write concurrently: take the write lock when
+        # a transaction starts and wait for it instead of failing
+        "OPTIONS": {"timeout": 30, "transaction_mode": "IMMEDIATE"},
+        # An in-memory test database fails concurrent writes with "table is
+        # locked" instead of waiting, tests use a file like production
+        "TEST": {"NAME": BASE_DIR / "test_db.sqlite3"},
     }
 }
 
@@ -144,6 +151,61 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 # Email settings (for development)
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
+# Email sync settings
+EMAIL_SYNC_BATCH_SIZE = int(os.environ.get('EMAIL_SYNC_BATCH_SIZE', 500))
+EMAIL_SYNC_TIMEOUT = int(os.environ.get('SYNC_TIMEOUT', 300))
+EMAIL_SYNC_WORKERS = int(os.environ.get('MAX_SYNC_THREADS', 1))
+EMAIL_SYNC_MAX_PER_HOST = int(os.environ.get('EMAIL_SYNC_MAX_PER_HOST', 2))
+# Processes parsing fetched messages, 0 parses them in the sync thread
+EMAIL_SYNC_PARSE_WORKERS = int(os.environ.get('EMAIL_SYNC_PARSE_WORKERS', 0))
+# IMAP timeout of the background download of a body opened while pending
+EMAIL_BODY_FETCH_TIMEOUT = int(os.environ.get('EMAIL_BODY_FETCH_TIMEOUT', 30))
+
+# Background sync jobs: 'celery', 'local' (thread in the web process) or
+# 'auto' to use Celery whenever a broker is configured
+SYNC_JOB_BACKEND = os.environ.get('SYNC_JOB_BACKEND', 'auto')
+# Active jobs without progress for this many seconds are considered dead
+SYNC_JOB_STALE_AFTER = int(os.environ.get('SYNC_JOB_STALE_AFTER', 3600))
+
+# Celery
+CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL', os.environ.get('REDIS_URL', ''))
+# Syncs are long running, take one at a time
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
+# Cache, Redis when configured and django-redis is installed, otherwise
+# local memory (per process)
+REDIS_URL = os.environ.get('REDIS_URL', '')
+if REDIS_URL and importlib.util.find_spec('django_redis'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': REDIS_URL,
+            'OPTIONS': {
+                'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+                # A missing cache should slow requests down, not fail them
+                'IGNORE_EXCEPTIONS': True,
+            },
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'simple-imap2api',
+        }
+    }
+
+# Seconds API responses stay cached, 0 disables the response cache. Entries
+# are invalidated as soon as a sync changes the user's data, the timeout only
+# bounds how long unused ones are kept.
+RESPONSE_CACHE_TIMEOUT = int(os.environ.get('RESPONSE_CACHE_TIMEOUT', 3600))
+
+# Attachments of messages up to this many bytes are read from the stored
+# source, larger ones are streamed from the IMAP server in chunks of
+# ATTACHMENT_CHUNK_SIZE bytes
+ATTACHMENT_LOCAL_MAX_SIZE = int(os.environ.get('ATTACHMENT_LOCAL_MAX_SIZE', 10 * 1024 * 1024))
+ATTACHMENT_CHUNK_SIZE = int(os.environ.get('ATTACHMENT_CHUNK_SIZE', 1024 * 1024))
+
 # Logging Configuration
 LOGGING = {
     'version': 1,